@@ -2,6 +2,9 @@
 #// Wrapping the Lumenera API into a camera-centric class.
 #//
 import platform
+import threading
+
+import numpy as np
 
 from .api import *
 
@@ -90,6 +93,53 @@ class PropertyLimits():
     __repr__ = __str__
 
 
+#//
+#// Preallocated frame buffers, so capturing a frame does not allocate memory.
+#//
+class FrameBufferPool():
+    """
+        Pool of numpy-backed buffers of one image size, filled by the capture methods ending in Into, e.g.
+        Camera.CaptureRawVideoImageInto(pool).
+
+        A buffer taken with Acquire must be given back with Release once nobody uses the image anymore. If all the
+        buffers are in use, Acquire allocates a new one instead of blocking the capture, and Release only keeps up
+        to count buffers. Buffers of a previous image size are dropped when released.
+    """
+
+    def __init__(self, count, imageSizeInBytes = 0):
+        self.count = count
+        self.imageSizeInBytes = 0
+        self._free = []
+        self._lock = threading.Lock()
+        self.Resize(imageSizeInBytes)
+
+    def Resize(self, imageSizeInBytes):
+        """ Allocates the buffers again if the image size changed """
+        with self._lock:
+            if imageSizeInBytes == self.imageSizeInBytes:
+                return
+            self.imageSizeInBytes = imageSizeInBytes
+            self._free = [np.empty(imageSizeInBytes, dtype=np.uint8) for _ in range(self.count)]
+
+    def Acquire(self):
+        """ Returns a free buffer, a 1D uint8 array of imageSizeInBytes """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            imageSizeInBytes = self.imageSizeInBytes
+        return np.empty(imageSizeInBytes, dtype=np.uint8)
+
+    def Release(self, buffer):
+        with self._lock:
+            if buffer.size == self.imageSizeInBytes and len(self._free) < self.count:
+                self._free.append(buffer)
+
+    @staticmethod
+    def AsCtypes(buffer):
+        """ ctypes array sharing the memory of the buffer, to pass it to the API """
+        return (C.c_ubyte * buffer.size).from_buffer(buffer)
+
+
     
 #//
 #// More pythonic wrapper around the API methods that expect a camera handle.
@@ -108,6 +158,10 @@ class Camera():
         self._lib = api.lib
         self._hCamera = hCamera
         self._bitsPer16BitPixel = bitsPer16BitPixel
+        #// Formats cached by the capture methods using a FrameBufferPool, cleared when the format may change
+        self._frameFormat = None
+        self._stillImageFormat = None
+        self._videoImageFormat = None
         
     def __str__(self):
         return "hCamera = {0}\n{1}".format(self._hCamera, self.VersionInfo())
@@ -146,6 +200,7 @@ class Camera():
         raise ApiError(self.LastError(), self._hCamera)
     
     def Reset(self):
+        self.ClearFormatCache()
         success = self._lib.CameraReset(self._hCamera)
         if (0 == success):
             self.RaiseApiError()
@@ -229,6 +284,7 @@ class Camera():
         return (frameFormat, frameRate.value)
 
     def SetFormat(self, frameFormat, frameRate):
+        self.ClearFormatCache()
         success = self._lib.SetFormat(self._hCamera, frameFormat, frameRate)
         if (0 == success):
             self.RaiseApiError()
@@ -238,6 +294,29 @@ class Camera():
         
     def GetFrameRate(self):
         return self.GetFormat()[1]
+
+    def GetCachedFrameFormat(self):
+        """ Frame format, queried from the camera only after it may have changed """
+        if self._frameFormat is None:
+            self._frameFormat = self.GetFrameFormat()
+        return self._frameFormat
+
+    def GetCachedStillImageFormat(self):
+        """ Image format of the fast frames, queried from the camera only after it may have changed """
+        if self._stillImageFormat is None:
+            self._stillImageFormat = self.GetStillImageFormat()
+        return self._stillImageFormat
+
+    def GetCachedVideoImageFormat(self):
+        """ Image format of the video frames, queried from the camera only after it may have changed """
+        if self._videoImageFormat is None:
+            self._videoImageFormat = self.GetVideoImageFormat()
+        return self._videoImageFormat
+
+    def ClearFormatCache(self):
+        self._frameFormat = None
+        self._stillImageFormat = None
+        self._videoImageFormat = None
             
     def GetVideoImageFormat(self):
         (success, imageFormat) = self._lib.GetVideoImageFormat(self._hCamera)
@@ -306,6 +385,23 @@ class Camera():
         self._WriteRawDataToFile(buffer, fileName)
         return (buffer, frameFormat)
     
+    def CaptureRawVideoImageInto(self, pool, timeout = None):
+        """ Same as CaptureRawVideoImage, or CaptureRawVideoImageEx if a timeout is given, but the image is written
+            to a buffer of the pool and the frame format is not queried for every frame.
+            Returns (buffer, frameFormat), the buffer must be released to the pool after use """
+        frameFormat = self.GetCachedFrameFormat()
+        imageSizeInBytes = frameFormat.GetImageSize()
+        pool.Resize(imageSizeInBytes)
+        buffer = pool.Acquire()
+        if timeout is None:
+            success = self._lib.TakeVideo(self._hCamera, 1, pool.AsCtypes(buffer))
+        else:
+            success = self._lib.TakeVideoEx(self._hCamera, pool.AsCtypes(buffer), imageSizeInBytes, timeout)
+        if (0 == success):
+            pool.Release(buffer)
+            self.RaiseApiError()
+        return (buffer, frameFormat)
+
     def CancelVideo(self):
         success = self._lib.CancelTakeVideo(self._hCamera)
         if (0 == success):
@@ -510,6 +606,7 @@ class Camera():
         return (imageBuffer, frameFormat)
 
     def EnableFastFrames(self, snapshotSettings):
+        self.ClearFormatCache()
         success = self._lib.EnableFastFrames(self._hCamera, snapshotSettings)
         if (0 == success):
             self.RaiseApiError()
@@ -526,6 +623,19 @@ class Camera():
             self.RaiseApiError()
         return (buffer)
     
+    def TakeFastFrameInto(self, pool):
+        """ Same as TakeFastFrame, but the image is written to a buffer of the pool and the image format is not
+            queried for every frame.
+            Returns (buffer, imageFormat), the buffer must be released to the pool after use """
+        imageFormat = self.GetCachedStillImageFormat()
+        pool.Resize(imageFormat.imageSize)
+        buffer = pool.Acquire()
+        success = self._lib.TakeFastFrame(self._hCamera, pool.AsCtypes(buffer))
+        if (0 == success):
+            pool.Release(buffer)
+            self.RaiseApiError()
+        return (buffer, imageFormat)
+
     def TakeFastFrameNoTrigger(self):
         """ We return a buffer. """
         (success, imageFormat) = self._lib.GetStillImageFormat(self._hCamera)
@@ -572,6 +682,7 @@ class Camera():
         return (success)        
 
     def DisableFastFrames(self):
+        self.ClearFormatCache()
         success = self._lib.DisableFastFrames(self._hCamera)
         if (0 == success):
             self.RaiseApiError()
@@ -620,6 +731,7 @@ class Camera():
         return (success)
 
     def SetPixelFormat(self, pixelFormat):
+        self.ClearFormatCache()
         (frameFormat, frameRate) = self.GetFormat()
         frameFormat.pixelFormat = pixelFormat
         success = self._lib.SetFormat(self._hCamera, frameFormat, frameRate)
@@ -1041,3 +1153,9 @@ class Camera():
         if (0 == success):
             self.RaiseApiError()
         return frameCounter
+
+    def GetBufferMetadata(self, buffer, imageFormat):
+        """ Returns (timestamp, frameCounter) of a frame captured in a buffer of a FrameBufferPool.
+            Timestamps must be enabled with EnableTimestamp """
+        imageData = (C.c_byte * buffer.size).from_buffer(buffer)
+        return (self.GetMetaDataTimestamp(imageData, imageFormat), self.GetMetaDataFrameCounter(imageData, imageFormat))
@@ -1,13 +1,9 @@
 import time
 
-import pyvisa
-
 from NanoCETPy.dispertech.models.arduino import ArduinoModel
 from experimentor.lib.log import get_logger, log_to_screen
 from experimentor.models import Feature
 
-rm = pyvisa.ResourceManager('@py')
-
 
 class ArduinoExperimental(ArduinoModel):
     '''ArduinoModel with modified initialize routine to enable NanoCET software connection check screen
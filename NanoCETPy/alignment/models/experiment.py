@@ -8,6 +8,8 @@ from experimentor import Q_
 from experimentor.models.action import Action
 from experimentor.models.decorators import make_async_thread
 from experimentor.models.experiments import Experiment
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
+from NanoCETPy.sequential.models.basler import BaslerNanoCET as Camera
 from . import model_utils as ut
 from .arduino import ArduinoExperimental
 from .lumenera_model_draft import LumeneraCamera
@@ -31,6 +33,10 @@ class AlignmentSetup(Experiment):
         self.demo_image = data.colorwheel()
         self.processed_image = self.demo_image
         self.display_image = self.demo_image
+        self.processed_feed = FrameFeed()
+        self.processed_feed.publish(self.processed_image)
+        self.display_feed = FrameFeed()  # Frames of the camera being displayed
+        self.display_feed.publish(self.demo_image)
         self.active = True
         self.now = None
 
@@ -47,10 +53,21 @@ class AlignmentSetup(Experiment):
         config_mic = self.config['camera_microscope']
         self.camera_microscope = Camera(config_mic['init'], initial_config=config_mic['config'])
         for cam in (self.camera_fiber, self.camera_microscope):
+            cam.feed.subscribe(self._display_forwarder(cam))
             self.logger.info(f'Initializing {cam}')
             cam.initialize()
             self.logger.debug(f'Configuring {cam}')
 
+    def _display_forwarder(self, camera):
+        """ :returns: a subscriber to the feed of ``camera`` that publishes its frames on :attr:`display_feed` while it
+            is the camera being displayed
+        """
+        def forward(frame_id, image):
+            if self.display_camera is camera:
+                self.display_image = image
+                self.display_feed.publish(image)
+        return forward
+
     def initialize_electronics(self):
         """ Initializes the electronics associated witht he experiment (but not the cameras).
 
@@ -126,6 +143,7 @@ class AlignmentSetup(Experiment):
         self.processed_image = np.zeros((fiber.shape[0],fiber.shape[1],3))
         self.processed_image[:,:,2] = ut.to_uint8(fiber)
         self.processed_image[:,:,0]= ut.to_uint8(ut.gaussian2d_array(fiber_center,40,fiber.shape))
+        self.processed_feed.publish(self.processed_image)
         # Turn off LED
         self.electronics.fiber_led = 0
         # Set exposure and gain
@@ -161,6 +179,7 @@ class AlignmentSetup(Experiment):
         self.camera_fiber.trigger_camera()
         img = self.camera_fiber.read_camera()[-1]        
         self.processed_image = img
+        self.processed_feed.publish(self.processed_image)
         val_new = np.sum(img > 0.8*np.max(img))
         while self.active:
             val_old = val_new
@@ -199,6 +218,7 @@ class AlignmentSetup(Experiment):
             self.processed_image[:,:,2] = ut.to_uint8((1*mask))
             lc = ut.centroid(img)
             self.processed_image[:,:,1] = ut.to_uint8(ut.gaussian2d_array(lc,60,img.shape))
+            self.processed_feed.publish(self.processed_image)
             val_new = lc[idx]-c
             while self.active:
                 val_old = val_new
@@ -213,6 +233,7 @@ class AlignmentSetup(Experiment):
                 img = 1*(img>0.8*np.max(img))
                 lc = ut.centroid(img)
                 self.processed_image[:,:,1] = ut.to_uint8(ut.gaussian2d_array(lc,60,img.shape))
+                self.processed_feed.publish(self.processed_image)
                 val_new = lc[idx]-c
                 self.logger.info(f'TEST last distances are {val_old}, {val_new} to centroid at {lc}')
                 if np.sign(val_old) != np.sign(val_new): 
@@ -246,6 +267,7 @@ class AlignmentSetup(Experiment):
             val_new = np.max(median)/np.min(median)
             pos = np.argwhere(median==np.max(median))[0,0]
             self.processed_image[:,pos-10:pos+10,1] = 255 
+            self.processed_feed.publish(self.processed_image)
             axis = self.config['electronics']['vertical_axis']
             while self.active:
                 val_old = val_new
@@ -258,6 +280,7 @@ class AlignmentSetup(Experiment):
                 pos = np.argwhere(median==np.max(median))[0,0]
                 self.processed_image[:,:,1] = np.zeros(img.shape)
                 self.processed_image[:,pos-2:pos+2,1] = 255 
+                self.processed_feed.publish(self.processed_image)
                 if val_old > val_new:
                     direction = (direction + 1) % 2
                     if check: 
@@ -279,6 +302,7 @@ class AlignmentSetup(Experiment):
         lc = ut.centroid(img)
         tc = ut.centroid(ut.to_uint8(ut.gaussian2d_array((100,600),1000,img.shape)))
         self.processed_image[:,:,1] = ut.to_uint8(ut.gaussian2d_array(lc,60,img.shape))
+        self.processed_feed.publish(self.processed_image)
         self.logger.info(f'TEST centroid of laser at {lc}, test centroid at {tc}')
 
     @Action
@@ -289,8 +313,8 @@ class AlignmentSetup(Experiment):
             return
         camera.acquisition_mode = camera.MODE_SINGLE_SHOT
         camera.trigger_camera()
-        camera.read_camera()
         self.display_camera = camera
+        camera.read_camera()
         self.logger.info('Snap Image complete')
 
     @Action    
@@ -301,6 +325,7 @@ class AlignmentSetup(Experiment):
             camera.stop_free_run()
             self.logger.info('Continuous reads ended')
             self.display_camera = None
+            self.display_feed.publish(self.demo_image)
         else:
             camera.start_free_run()
             camera.continuous_reads()
@@ -346,6 +371,8 @@ class AlignmentSetup(Experiment):
         power = int(power)
 
         self.electronics.scattering_laser = power
+        # Wait for the new power before anything is acquired with it
+        self.electronics.flush()
         self.config['laser']['power'] = power
 
     @Action
@@ -431,6 +458,8 @@ class CamSetup(Experiment):
 
         self.demo_image = data.colorwheel()
         #self.display_image = self.demo_image
+        self.display_feed = FrameFeed()  # Frames of the camera while it is displayed
+        self.display_feed.publish(self.demo_image)
 
     @Action
     def initialize(self):
@@ -444,11 +473,16 @@ class CamSetup(Experiment):
         self.logger.info('Initializing cameras')
         config_fiber = self.config['camera_lumenera']
         self.camera = LumeneraCamera(config_fiber['init'], initial_config=config_fiber['config'])
+        self.camera.feed.subscribe(self._forward_frame)
         self.logger.info('test after init')
         self.logger.info(f'Initializing {self.camera}')
         self.camera.initialize()
         self.logger.debug(f'Configuring {self.camera}')
         
+    def _forward_frame(self, frame_id, image):
+        if self.display_camera:
+            self.display_feed.publish(image)
+
     @Action
     def snap_image(self):
         self.logger.info('Trying to snap image')
@@ -457,11 +491,12 @@ class CamSetup(Experiment):
             return
         if self.display_camera: 
             self.display_camera = False
+            self.display_feed.publish(self.demo_image)
             return
         self.camera.acquisition_mode = self.camera.MODE_SINGLE_SHOT
         self.camera.trigger_camera()
-        self.camera.read_camera()
         self.display_camera = True
+        self.camera.read_camera()
         self.logger.info('Snap Image complete')
         
     @Action
@@ -472,6 +507,7 @@ class CamSetup(Experiment):
             self.camera.stop_free_run()
             self.logger.info('Continuous reads ended')
             self.display_camera = False
+            self.display_feed.publish(self.demo_image)
         else:
             self.camera.start_free_run()
             self.camera.continuous_reads()
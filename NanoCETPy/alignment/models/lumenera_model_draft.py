@@ -6,10 +6,27 @@
     with the :py:class:`..controller.camera.Camera` class containing the high level pythonic functionality.
     
     API reference manual link: `https://www.lumenera.com/lucam-software.html`
+
+    Frames are captured into a :py:class:`..controller.camera.FrameBufferPool` of preallocated buffers, and the
+    frame format is only queried again after it may have changed, so reading a frame does not allocate memory nor
+    query the camera. The images share the memory of their buffers, and a buffer only goes back to the pool once no array
+    refers to it anymore, so an image kept by a viewer, the saver or the feed is never overwritten by a later frame.
+
+    In continuous mode, a streaming thread captures the frames with ``TakeVideoEx`` as soon as the camera delivers
+    them, and puts them with their frame counter and timestamp, read from the metadata of the frame, in a ring buffer of
+    ``ring_size`` frames. The clock of the camera is offset to the time of the computer at the first frame, so the
+    timestamps are always in seconds since the epoch, also for cameras that don't provide them. Every capture holds
+    the lock of the camera, so the format can't change in the middle of one. :meth:`LumeneraCamera.continuous_reads` emits all the frames waiting in the ring, instead of
+    reading one frame and sleeping for a frame period, which made the real rate lower than the rate of the camera.
+
     .. codeauthor:: Jakob Schröder
 """
 
 import inspect
+import sys
+import threading
+import time
+from collections import deque
 from multiprocessing import Lock
 
 import numpy as np
@@ -22,6 +39,7 @@ from experimentor.models.action import Action
 from experimentor.models.decorators import make_async_thread
 from experimentor.models.devices.cameras.base_camera import BaseCamera
 from experimentor.models.devices.cameras.exceptions import CameraNotFound
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
 from ..controller.lucamapi.camera import *
 
 
@@ -29,6 +47,8 @@ class LumeneraCamera(BaseCamera):
     _acquisition_mode = BaseCamera.MODE_SINGLE_SHOT
     new_image = Signal()
     _lumenera_lock = Lock()
+    buffer_count = 16  # Frame buffers kept in the pool for the captures
+    ring_size = 8  # Frames captured while streaming and not read yet
 
     def __init__(self, camera, initial_config=None):
         super().__init__(camera, initial_config=initial_config)
@@ -40,6 +60,18 @@ class LumeneraCamera(BaseCamera):
         self.keep_reading = False
         self.continuous_reads_running = False
         self.finalized = False
+        self.feed = FrameFeed()
+        self.buffer_pool = FrameBufferPool(self.buffer_count)
+        self._buffers_in_use = []  # Buffers whose images may still be referenced
+        self._ring = deque(maxlen=self.ring_size)  # (image, frame counter, timestamp) captured while streaming
+        self._ring_condition = threading.Condition()
+        self._stream_thread = None
+        self._timestamp_frequency = None
+        self._timestamp_offset = None
+        self._frame_timeout = 1  # s, maximum wait for the next frame while streaming
+        self._last_frame_counter = None
+        self.keep_streaming = False
+        self.dropped_frames = 0
 
     def __str__(self):
         return f'Lumenera {self.camera}'
@@ -170,12 +202,13 @@ class LumeneraCamera(BaseCamera):
     def pixel_format(self, mode):
         self.logger.info(f'Setting pixel format to {mode}')
 
-        if self.acquisition_mode == self.MODE_SINGLE_SHOT:
-            self._camera.DisableFastFrames()
-            self.snapshot_settings.format.pixelFormat = mode
-            self._camera.EnableFastFrames(self.snapshot_settings)
-        
-        self._camera.SetPixelFormat(mode)
+        with self._lumenera_lock:
+            if self.acquisition_mode == self.MODE_SINGLE_SHOT:
+                self._camera.DisableFastFrames()
+                self.snapshot_settings.format.pixelFormat = mode
+                self._camera.EnableFastFrames(self.snapshot_settings)
+
+            self._camera.SetPixelFormat(mode)
 
         if mode == PIXEL_FORMAT_8:
             self.current_dtype = np.uint8
@@ -232,20 +265,21 @@ class LumeneraCamera(BaseCamera):
         height -= height % y_unit
         self.logger.info(f'Updating ROI: (x, y, width, height) = ({x_offset}, {y_offset}, {width}, {height})')
 
-        ff, fr = self._camera.GetFormat()
-        ff.xOffset = int(x_offset)
-        ff.width = int(width)
-        ff.yOffset = int(y_offset)
-        ff.height = int(height)
-        self._camera.SetFormat(ff,fr)
-        if self.acquisition_mode == self.MODE_SINGLE_SHOT:
-            self._camera.DisableFastFrames()
-        self.snapshot_settings.format.xOffset = int(x_offset)
-        self.snapshot_settings.format.width = int(width)
-        self.snapshot_settings.format.yOffset = int(y_offset)
-        self.snapshot_settings.format.height = int(height)
-        if self.acquisition_mode == self.MODE_SINGLE_SHOT: 
-            self._camera.EnableFastFrames(self.snapshot_settings)          
+        with self._lumenera_lock:
+            ff, fr = self._camera.GetFormat()
+            ff.xOffset = int(x_offset)
+            ff.width = int(width)
+            ff.yOffset = int(y_offset)
+            ff.height = int(height)
+            self._camera.SetFormat(ff,fr)
+            if self.acquisition_mode == self.MODE_SINGLE_SHOT:
+                self._camera.DisableFastFrames()
+            self.snapshot_settings.format.xOffset = int(x_offset)
+            self.snapshot_settings.format.width = int(width)
+            self.snapshot_settings.format.yOffset = int(y_offset)
+            self.snapshot_settings.format.height = int(height)
+            if self.acquisition_mode == self.MODE_SINGLE_SHOT:
+                self._camera.EnableFastFrames(self.snapshot_settings)
 
     @Feature()
     def frame_rate(self):
@@ -277,36 +311,158 @@ class LumeneraCamera(BaseCamera):
         elif mode == self.MODE_CONTINUOUS:
             self._camera.SetStreamState(START_STREAMING)
     
+    def _image_from_buffer(self, buffer, width, height, pixel_format):
+        """ Image sharing the memory of a buffer of the pool. The buffer goes back to the pool once the image, and any
+        other array made from it, is not referenced anymore, see :meth:`_recycle_buffers`.
+        """
+        self._recycle_buffers()
+        self._buffers_in_use.append(buffer)
+        dtype = np.uint16 if pixel_format == PIXEL_FORMAT_16 else np.uint8
+        return buffer.view(dtype)[:width * height].reshape((width, height), order='F')
+
+    def _recycle_buffers(self):
+        """ Gives back to the pool the buffers that no image refers to.
+
+        Every array sharing the memory of a buffer keeps a reference to it as its ``base``, so a buffer only referred to
+        by the list of buffers in use, and by the argument of :func:`sys.getrefcount`, can be overwritten.
+        """
+        in_use = []
+        for buffer in self._buffers_in_use:
+            # The list, the loop variable and the argument of getrefcount
+            if sys.getrefcount(buffer) > 3:
+                in_use.append(buffer)
+            else:
+                self.buffer_pool.Release(buffer)
+        self._buffers_in_use = in_use
+
     def read_camera(self) -> list:
+        mode = self.acquisition_mode
+        if mode == self.MODE_CONTINUOUS and self.keep_streaming:
+            # The frames waiting in the ring buffer, stored and published by take_pending_frames. The lock can't be
+            # held while waiting, the streaming thread needs it to capture the next frame
+            return [image for image, _, _ in self.take_pending_frames(timeout=self._frame_timeout)]
         with self._lumenera_lock:
             img = []
-            mode = self.acquisition_mode
             self.logger.debug(f'Grabbing mode: {mode}')
             if mode == self.MODE_SINGLE_SHOT:
                 try:
-                    buffer = self._camera.TakeFastFrame()
+                    buffer, image_format = self._camera.TakeFastFrameInto(self.buffer_pool)
                 except ApiError:
                     self.logger.error('ApiError in read_camera')
-                img.append(np.frombuffer(buffer, dtype=self.current_dtype).reshape((self.width,self.height), order='F'))
+                    return img
+                img.append(self._image_from_buffer(buffer, image_format.width, image_format.height,
+                                                   image_format.pixelFormat))
                 self.temp_image = img[0]
             elif mode == self.MODE_CONTINUOUS:
-                buffer = self._camera.CaptureRawVideoImage()[0]
-                # How to read all of available buffer in the fastest way? 
-                assert buffer is not None
-                img.append(np.frombuffer(buffer, dtype=self.current_dtype).reshape((self.width,self.height), order='F'))
+                buffer, frame_format = self._camera.CaptureRawVideoImageInto(self.buffer_pool)
+                width, height, _ = frame_format.GetImageDimensions()
+                img.append(self._image_from_buffer(buffer, width, height, frame_format.pixelFormat))
                 self.temp_image = img[0]
+            if img:
+                self.feed.publish(img[-1])
             return img
+
+    def take_pending_frames(self, timeout=0):
+        """ Empties the ring buffer filled by the streaming thread.
+
+        :param float timeout: time to wait for a frame if there is none, in seconds
+        :returns: list of (image, frame counter, timestamp), oldest first. The timestamp is in seconds since the
+            epoch. The counter is None and the timestamp is the time of capture if the camera does not provide them.
+        """
+        with self._ring_condition:
+            if not self._ring and timeout:
+                self._ring_condition.wait(timeout)
+            frames = list(self._ring)
+            self._ring.clear()
+        if frames:
+            self.temp_image = frames[-1][0]
+            self.feed.publish(frames[-1][0])
+        return frames
+
+    def _start_streaming(self):
+        self._ring.clear()
+        self._last_frame_counter = None
+        self._timestamp_offset = None
+        self.dropped_frames = 0
+        # Long enough for a frame to arrive, but short enough to stop quickly
+        frame_rate = self.frame_rate or 10
+        self._frame_timeout = min(max(2 / frame_rate, .1), 1)
+        try:
+            self._camera.EnableTimestamp()
+            self._timestamp_frequency = float(self._camera.GetTimestampFreq())
+        except ApiError:
+            self.logger.warning(f'{self} does not provide timestamps, using the time the frames are captured')
+            self._timestamp_frequency = None
+        self.keep_streaming = True
+        self._stream_thread = threading.Thread(target=self._stream, name=f'{self} stream', daemon=True)
+        self._stream_thread.start()
+
+    def _stop_streaming(self):
+        self.keep_streaming = False
+        if self._stream_thread is not None:
+            self._stream_thread.join()
+            self._stream_thread = None
+            if self.dropped_frames:
+                self.logger.warning(f'{self} dropped {self.dropped_frames} frames while streaming')
+
+    def _frame_metadata(self, buffer):
+        """ :returns: frame counter and timestamp in seconds since the epoch, from the metadata of the frame if
+            available. The clock of the camera is offset to the time of the computer at the first frame.
+        """
+        if self._timestamp_frequency:
+            try:
+                image_format = self._camera.GetCachedVideoImageFormat()
+                timestamp, frame_counter = self._camera.GetBufferMetadata(buffer, image_format)
+                timestamp /= self._timestamp_frequency
+                if self._timestamp_offset is None:
+                    self._timestamp_offset = time.time() - timestamp
+                return int(frame_counter), timestamp + self._timestamp_offset
+            except ApiError:
+                pass
+        return None, time.time()
+
+    def _stream(self):
+        """ Captures the frames as soon as the camera delivers them and stores them in the ring buffer. """
+        timeout = int(self._frame_timeout * 1000)
+        while self.keep_streaming:
+            # The format and its cache can't change while a frame is captured and read
+            with self._lumenera_lock:
+                try:
+                    buffer, frame_format = self._camera.CaptureRawVideoImageInto(self.buffer_pool, timeout=timeout)
+                except ApiError as e:
+                    error = e
+                else:
+                    error = None
+                    frame_counter, timestamp = self._frame_metadata(buffer)
+                    width, height, _ = frame_format.GetImageDimensions()
+                    image = self._image_from_buffer(buffer, width, height, frame_format.pixelFormat)
+            if error is not None:
+                if error.errorCode != ERROR_TIMEOUT:
+                    self.logger.error(f'{self} error while streaming: {error}')
+                    time.sleep(.01)
+                continue
+            if frame_counter is not None and self._last_frame_counter is not None:
+                # Frames the camera sent but the driver could not deliver
+                self.dropped_frames += max(frame_counter - self._last_frame_counter - 1, 0)
+            self._last_frame_counter = frame_counter
+            with self._ring_condition:
+                if len(self._ring) == self._ring.maxlen:
+                    self.dropped_frames += 1
+                self._ring.append((image, frame_counter, timestamp))
+                self._ring_condition.notify_all()
     
     @make_async_thread
     def continuous_reads(self):
         self.continuous_reads_running = True
         self.keep_reading = True
         while self.keep_reading:
-            imgs = self.read_camera()
-            if len(imgs) >= 1:
-                for img in imgs:
+            if self.keep_streaming:
+                for img, frame_counter, timestamp in self.take_pending_frames(timeout=self._frame_timeout):
+                    self.new_image.emit(img, meta={'frame_counter': frame_counter, 'timestamp': timestamp})
+            else:
+                # Without streaming, reading in continuous mode waits for the next frame
+                for img in self.read_camera():
                     self.new_image.emit(img)
-            time.sleep(1 / self.frame_rate)
         self.continuous_reads_running = False
 
     def stop_continuous_reads(self):
@@ -328,9 +484,11 @@ class LumeneraCamera(BaseCamera):
         self.logger.debug('First frame of a free_run')
         self.acquisition_mode = self.MODE_CONTINUOUS
         self.trigger_camera()  # Triggers the camera only once
+        self._start_streaming()
     
     @Action
     def stop_free_run(self):
+        self._stop_streaming()
         self._camera.SetStreamState(STOP_STREAMING)
         self.free_run_running = False
 
@@ -1,12 +1,9 @@
 import os
 import time
 
-import numpy as np
-
 BASE_DIR_VIEW = os.path.dirname(os.path.abspath(__file__))
 
 from PyQt5 import uic, QtGui
-from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QMainWindow
 import pyqtgraph as pg
 
@@ -14,6 +11,7 @@ from experimentor import Q_
 from experimentor.lib.log import get_logger
 from experimentor.views.base_view import BaseView
 from experimentor.views.camera.camera_viewer_widget import CameraViewerWidget
+from NanoCETPy.sequential.views.display_feed import DisplayFeed
 
 logger = get_logger(__name__)
 
@@ -57,22 +55,15 @@ class AlignmentWindow(QMainWindow, BaseView):
         #self.camera_gain_line.setText(str(self.experiment.camera.gain))
         #self.camera_exposure_line.setText("{:~}".format(Q_(self.experiment.camera.exposure)))
         
-        self.update_image_timer = QTimer()
-        self.update_image_timer.timeout.connect(self.update_image)
-        self.update_image_timer.start(50)
-        self.update_processed_image_timer = QTimer()
-        self.update_processed_image_timer.timeout.connect(self.update_processed_image)
-        self.update_processed_image_timer.start(200)
-
-    def update_image(self):
-        img = self.experiment.get_latest_image()
-        if np.sum(img) == None: 
-            img = np.zeros((800,800))
-            img[100:700,100:700] += np.ones((600,600))
+        self.display_feed = DisplayFeed(self.experiment.display_feed, parent=self)
+        self.display_feed.new_frame.connect(self.update_image)
+        self.processed_feed = DisplayFeed(self.experiment.processed_feed, interval=200, parent=self)
+        self.processed_feed.new_frame.connect(self.update_processed_image)
+
+    def update_image(self, frame_id, img):
         self.camera_viewer.update_image(img)
 
-    def update_processed_image(self):
-        img = self.experiment.get_processed_image()
+    def update_processed_image(self, frame_id, img):
         self.processing_viewer.update_image(img)
     
     def update_camera(self):
@@ -103,7 +94,8 @@ class AlignmentWindow(QMainWindow, BaseView):
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         logger.info('Alignment Window Closed')
-        self.update_image_timer.stop()
+        self.display_feed.close()
+        self.processed_feed.close()
         super().closeEvent(a0)
 
 
@@ -152,22 +144,15 @@ class CartridgeWindow(QMainWindow, BaseView):
         #self.camera_gain_line.setText(str(self.experiment.camera.gain))
         #self.camera_exposure_line.setText("{:~}".format(Q_(self.experiment.camera.exposure)))
         
-        self.update_image_timer = QTimer()
-        self.update_image_timer.timeout.connect(self.update_image)
-        self.update_image_timer.start(50)
-        self.update_processed_image_timer = QTimer()
-        self.update_processed_image_timer.timeout.connect(self.update_processed_image)
-        self.update_processed_image_timer.start(200)
-
-    def update_image(self):
-        img = self.experiment.get_latest_image()
-        if np.sum(img) == None: 
-            img = np.zeros((800,800))
-            img[100:700,100:700] += np.ones((600,600))
+        self.display_feed = DisplayFeed(self.experiment.display_feed, parent=self)
+        self.display_feed.new_frame.connect(self.update_image)
+        self.processed_feed = DisplayFeed(self.experiment.processed_feed, interval=200, parent=self)
+        self.processed_feed.new_frame.connect(self.update_processed_image)
+
+    def update_image(self, frame_id, img):
         self.camera_viewer.update_image(img)
 
-    def update_processed_image(self):
-        img = self.experiment.get_processed_image()
+    def update_processed_image(self, frame_id, img):
         self.processing_viewer.update_image(img)
 
     def set_illumination_mode(self, mode):
@@ -238,7 +223,8 @@ class CartridgeWindow(QMainWindow, BaseView):
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         logger.info('Alignment Window Closed')
-        self.update_image_timer.stop()
+        self.display_feed.close()
+        self.processed_feed.close()
         super().closeEvent(a0)
 
 
@@ -269,18 +255,14 @@ class CamWindow(QMainWindow, BaseView):
         self.camera_gain_line.setText(str(self.experiment.camera.gain))
         self.camera_exposure_line.setText("{:~}".format(Q_(self.experiment.camera.exposure)))
         
-        self.update_image_timer = QTimer()
-        self.update_image_timer.timeout.connect(self.update_image)
+        self.display_feed = DisplayFeed(self.experiment.display_feed, parent=self)
+        self.display_feed.new_frame.connect(self.update_image)
         #self.update_ui()
-        self.update_image_timer.start(50)
 
-    def update_image(self):
-        """ gets latest camera image and raturns a test image if camera image is None
+    def update_image(self, frame_id, img):
+        """ Displays a frame of :attr:`experiment.display_feed`. The experiment publishes the camera frames on that feed
+        while the camera is displayed, and its demo image when it is not, so the view does not pick the image itself.
         """
-        img = self.experiment.get_latest_image()
-        if np.sum(img) == None: 
-            img = np.zeros((800,800))
-            img[100:700,100:700] += np.ones((600,600))
         self.camera_viewer.update_image(img)
     
     def update_camera(self):
@@ -308,5 +290,5 @@ class CamWindow(QMainWindow, BaseView):
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         logger.info('Cam Window Closed')
-        self.update_image_timer.stop()
+        self.display_feed.close()
         super().closeEvent(a0)
\ No newline at end of file
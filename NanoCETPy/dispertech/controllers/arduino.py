@@ -9,12 +9,10 @@
 """
 from time import sleep
 
-import pyvisa
-
 # TODO: Make more flexible which bacend will be used for PyVisa
 from experimentor.lib.log import get_logger
+from NanoCETPy.dispertech.controllers import resources
 
-rm = pyvisa.ResourceManager('@py')
 logger = get_logger(__name__)
 
 
@@ -31,7 +29,7 @@ class Arduino:
             if not port.startswith('ASRL'):
                 port = 'ASRL' + port
             self.port = port
-            self.rsc = rm.open_resource(self.port, baud_rate=19200)
+            self.rsc = resources.acquire(self.port, baud_rate=19200)
             self.rsc.encoding = 'utf-8'
             sleep(3)
 
@@ -47,11 +45,11 @@ class Arduino:
         if self.closed:
             logger.info('Closing a closed resource')
             return
-        self.rsc.close()
+        resources.release(self.rsc, close=True)
 
     @staticmethod
     def list_devices():
-        return rm.list_resources()
+        return resources.list_resources()
 
 if __name__ == '__main__':
     print(Arduino.list_devices())
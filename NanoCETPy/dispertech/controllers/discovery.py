@@ -0,0 +1,138 @@
+"""
+    discovery.py
+    ============
+
+    Finds the serial port of a device that identifies itself with a known answer to ``IDN``.
+
+    Opening the serial port resets most Arduino boards, and they need about a second before they answer. Probing the
+    ports one after the other therefore costs more than a second per port. :func:`find_device` reduces that by:
+
+    * trying first the port where the device was found the last time,
+    * probing the ports of USB devices with a known vendor/product id before any other port, when pyserial can tell,
+    * probing all the candidates of a group in parallel, each one polling ``IDN`` with a short timeout instead of
+      sleeping a fixed time.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pyvisa import VisaIOError
+
+from experimentor.lib.log import get_logger
+from NanoCETPy.dispertech.controllers import resources
+
+logger = get_logger(__name__)
+
+# (vendor id, product id) of the USB-serial converters used by Arduino boards, None matches any product
+ARDUINO_USB_IDS = (
+    (0x2341, None),  # Arduino
+    (0x2A03, None),  # Arduino (arduino.org)
+    (0x1A86, 0x7523),  # CH340
+    (0x0403, 0x6001),  # FTDI FT232
+)
+
+
+def usb_ports(usb_ids=ARDUINO_USB_IDS):
+    """ Lists the VISA resource names of the serial ports that belong to USB devices with one of the given ids.
+
+    :returns: a set of resource names, empty if pyserial is not available
+    """
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return set()
+    ports = set()
+    for port in list_ports.comports():
+        if port.vid is None:
+            continue
+        if any(port.vid == vid and (pid is None or port.pid == pid) for vid, pid in usb_ids):
+            ports.add(f'ASRL{port.device}::INSTR')
+    return ports
+
+
+def probe(port, idn_prefix, baud_rate=115200, timeout=2.5, query_timeout=200):
+    """ Opens a port and polls ``IDN`` until the answer starts with ``idn_prefix`` or the timeout expires.
+
+    :param str port: VISA resource name
+    :param str idn_prefix: expected beginning of the answer to ``IDN``
+    :param float timeout: maximum time in seconds given to the device to answer, including its reset
+    :param int query_timeout: timeout of each query, in milliseconds
+    :returns: tuple (open resource, answer to IDN) if the device answered, None otherwise, also if the port is
+        already borrowed by someone else. The resource keeps its original timeout.
+    """
+    try:
+        # A port in use by a model is not probed, it would change its settings under it
+        resource = resources.acquire(port, exclusive=True, baud_rate=baud_rate)
+    except resources.ResourceBusy:
+        logger.debug(f'Skipping {port}, it is in use')
+        return None
+    except Exception as e:
+        logger.debug(f'Could not open {port}: {e}')
+        return None
+    original_timeout = resource.timeout
+    resource.timeout = query_timeout
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            idn = resource.query('IDN').strip()
+        except VisaIOError:
+            continue
+        except Exception as e:
+            logger.debug(f'Error probing {port}: {e}')
+            break
+        # The first answer after opening may be garbled, keep polling until the deadline
+        if idn.startswith(idn_prefix):
+            resource.timeout = original_timeout
+            return resource, idn
+    resources.release(resource, close=True)
+    return None
+
+
+def probe_parallel(ports, idn_prefix, **kwargs):
+    """ Probes several ports at the same time, see :func:`probe`.
+
+    :returns: tuple (open resource, answer to IDN) of the first port that answers, None if none does
+    """
+    if not ports:
+        return None
+    found = None
+    with ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix='probe') as executor:
+        futures = [executor.submit(probe, port, idn_prefix, **kwargs) for port in ports]
+        for future in as_completed(futures):
+            result = future.result()
+            if result is None:
+                continue
+            if found is None:
+                found = result
+            else:
+                logger.warning(f'More than one device answered, ignoring {result[0].resource_name}')
+                resources.release(result[0], close=True)
+    return found
+
+
+def find_device(idn_prefix, last_port=None, usb_ids=ARDUINO_USB_IDS, **kwargs):
+    """ Looks for the device answering ``IDN`` with ``idn_prefix``.
+
+    :param str idn_prefix: expected beginning of the answer to ``IDN``
+    :param str last_port: resource name where the device was found the last time, it is tried first
+    :param usb_ids: (vendor id, product id) of the ports probed before the rest
+    :param kwargs: passed to :func:`probe`
+    :returns: tuple (open resource, answer to IDN), None if the device was not found
+    """
+    t0 = time.monotonic()
+    ports = list(resources.list_resources())
+    if not ports:
+        return None
+    groups = []
+    if last_port in ports:
+        groups.append([last_port])
+        ports.remove(last_port)
+    usb = usb_ports(usb_ids)
+    groups.append([port for port in ports if port in usb])
+    groups.append([port for port in ports if port not in usb])
+    for group in groups:
+        result = probe_parallel(group, idn_prefix, **kwargs)
+        if result is not None:
+            logger.info(f'Found {result[1]} on {result[0].resource_name} in {time.monotonic() - t0:.2f}s')
+            return result
+    logger.warning(f'No device answering {idn_prefix} found after {time.monotonic() - t0:.2f}s')
+    return None
@@ -0,0 +1,189 @@
+"""
+    instrumentation.py
+    ==================
+
+    Statistics of the communication over a serial link.
+
+    :class:`InstrumentedResource` wraps a pyvisa resource and records the latency of every command in a
+    :class:`SerialStats`, grouped by command name (the command without its numeric arguments, so ``LED:TOP:1`` and
+    ``LED:TOP:0`` are both counted as ``LED:TOP``). Timeouts and other errors are counted per command as well.
+    :class:`InstrumentedLock` records how long callers wait to get hold of the device. The statistics can be exported
+    as a dictionary with :meth:`SerialStats.snapshot`, or as text with :meth:`SerialStats.summary`.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from pyvisa import VisaIOError
+from pyvisa.constants import StatusCode
+
+
+class LatencyHistogram:
+    """ Histogram of durations with logarithmic bins, in milliseconds. """
+    edges = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration):
+        """ :param float duration: duration in seconds """
+        ms = 1000 * duration
+        self.counts[bisect_left(self.edges, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, q):
+        """ Upper edge of the bin containing the given percentile, in ms (the maximum for the last bin). """
+        if not self.count:
+            return 0.
+        target = q / 100 * self.count
+        accumulated = 0
+        for i, count in enumerate(self.counts):
+            accumulated += count
+            if accumulated >= target:
+                return self.edges[i] if i < len(self.edges) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'mean_ms': self.mean, 'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95), 'max_ms': self.max, 'histogram': list(self.counts)}
+
+
+class SerialStats:
+    """ Latency histograms and error counters of a serial link. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.errors = {}
+            self.timeouts = {}
+            self.lock_wait = LatencyHistogram()
+            self.resyncs = 0
+            self.start = time.time()
+
+    @staticmethod
+    def command_name(command):
+        if isinstance(command, bytes):
+            return 'raw'
+        return re.sub(r'(:[-+\d,.]+)+$', '', command.strip())
+
+    def record(self, name, duration):
+        with self._lock:
+            self.commands.setdefault(name, LatencyHistogram()).add(duration)
+
+    def record_error(self, name, error):
+        with self._lock:
+            if isinstance(error, VisaIOError) and error.error_code == StatusCode.error_timeout:
+                self.timeouts[name] = self.timeouts.get(name, 0) + 1
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def record_lock_wait(self, duration):
+        with self._lock:
+            self.lock_wait.add(duration)
+
+    def record_resync(self):
+        """ To be called when the input buffer had to be cleared because the answers got out of sync. """
+        with self._lock:
+            self.resyncs += 1
+
+    def snapshot(self):
+        """ :returns: a dictionary with all the statistics, that can be serialized to JSON """
+        with self._lock:
+            return {
+                'since': self.start,
+                'commands': {name: hist.to_dict() for name, hist in self.commands.items()},
+                'errors': dict(self.errors),
+                'timeouts': dict(self.timeouts),
+                'lock_wait': self.lock_wait.to_dict(),
+                'resyncs': self.resyncs,
+            }
+
+    def summary(self):
+        """ :returns: one line per command, sorted by total time spent, followed by the lock and error counters """
+        snapshot = self.snapshot()
+        commands = sorted(snapshot['commands'].items(), key=lambda item: -item[1]['count'] * item[1]['mean_ms'])
+        lines = [f"{name:<14} n={stats['count']:<6} mean={stats['mean_ms']:7.1f}ms p95<={stats['p95_ms']:g}ms "
+                 f"max={stats['max_ms']:7.1f}ms timeouts={snapshot['timeouts'].get(name, 0)} "
+                 f"errors={snapshot['errors'].get(name, 0)}" for name, stats in commands]
+        lock = snapshot['lock_wait']
+        lines.append(f"lock wait      n={lock['count']:<6} mean={lock['mean_ms']:7.1f}ms max={lock['max_ms']:7.1f}ms")
+        lines.append(f"resyncs: {snapshot['resyncs']}")
+        return '\n'.join(lines)
+
+
+class InstrumentedLock:
+    """ Re-entrant lock that records in ``stats`` how long it took to acquire it. """
+    def __init__(self, stats):
+        self.stats = stats
+        self._lock = threading.RLock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self.stats.record_lock_wait(time.perf_counter() - t0)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def owned(self):
+        """ :returns: True if the calling thread holds the lock """
+        return self._lock._is_owned()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class InstrumentedResource:
+    """ Wraps a pyvisa resource, recording the duration of ``query``, ``write``, ``write_raw`` and ``read``. Any other
+    attribute is read from, and set on, the wrapped resource.
+    """
+    def __init__(self, resource, stats):
+        object.__setattr__(self, 'resource', resource)
+        object.__setattr__(self, 'stats', stats)
+
+    def _timed(self, name, func, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            self.stats.record_error(name, e)
+            raise
+        finally:
+            self.stats.record(name, time.perf_counter() - t0)
+
+    def query(self, command, *args, **kwargs):
+        return self._timed(self.stats.command_name(command), self.resource.query, command, *args, **kwargs)
+
+    def write(self, command, *args, **kwargs):
+        return self._timed(self.stats.command_name(command), self.resource.write, command, *args, **kwargs)
+
+    def write_raw(self, message, *args, **kwargs):
+        return self._timed('write_raw', self.resource.write_raw, message, *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self._timed('read', self.resource.read, *args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.resource, item)
+
+    def __setattr__(self, key, value):
+        setattr(self.resource, key, value)
@@ -0,0 +1,142 @@
+"""
+    resources.py
+    ============
+
+    Shared access to the serial ports through pyvisa.
+
+    A single ``ResourceManager('@py')`` is created the first time it is needed, instead of one per module at import
+    time, so importing the models (or running the demo) does not initialize the backend. Open sessions are kept in a pool
+    keyed by the resource name: a model borrows a session with :func:`acquire` and gives it back with :func:`release`.
+    Borrowing again a port whose session is still open reuses it, which avoids the reset of the Arduino board that
+    happens every time its port is opened. The borrowers of every port are counted, and a session is closed only when
+    the last of them gives it back. Code that must not share a session, such as the discovery of devices, borrows it
+    with ``exclusive=True`` and skips the ports that are in use.
+"""
+import threading
+
+import pyvisa
+
+from experimentor.lib.log import get_logger
+
+logger = get_logger(__name__)
+
+_rm = None
+_lock = threading.Lock()
+_sessions = {}
+_borrowers = {}  # resource name: number of borrowers of its session
+
+
+class ResourceBusy(Exception):
+    """ The session of a port is already borrowed, raised by :func:`acquire` with ``exclusive=True`` """
+    pass
+
+
+def resource_manager():
+    """ :returns: the shared :class:`pyvisa.ResourceManager`, created on first use """
+    global _rm
+    with _lock:
+        if _rm is None:
+            _rm = pyvisa.ResourceManager('@py')
+        return _rm
+
+
+def list_resources():
+    return resource_manager().list_resources()
+
+
+def _is_open(resource):
+    try:
+        resource.session
+    except pyvisa.errors.InvalidSession:
+        return False
+    return True
+
+
+def acquire(port, exclusive=False, **kwargs):
+    """ Borrows the session of a port, opening it if there is no open session in the pool.
+
+    :param str port: VISA resource name
+    :param bool exclusive: if True, raises :class:`ResourceBusy` instead of sharing a session that is already borrowed
+    :param kwargs: passed to :meth:`pyvisa.ResourceManager.open_resource` when a new session is opened. If the session
+        is reused, the attributes given are applied to it
+    :returns: the open resource
+    """
+    rm = resource_manager()
+    with _lock:
+        resource = _sessions.get(port)
+        if resource is not None and _is_open(resource):
+            if exclusive and _borrowers.get(port, 0):
+                raise ResourceBusy(f'{port} is in use')
+            for key, value in kwargs.items():
+                setattr(resource, key, value)
+            _borrowers[port] = _borrowers.get(port, 0) + 1
+            logger.debug(f'Reusing session of {port}, {_borrowers[port]} borrowers')
+            return resource
+        # Opening can take a while, the port is counted as borrowed meanwhile
+        _sessions.pop(port, None)
+        if exclusive and _borrowers.get(port, 0):
+            raise ResourceBusy(f'{port} is being opened')
+        _borrowers[port] = _borrowers.get(port, 0) + 1
+    try:
+        resource = rm.open_resource(port, **kwargs)
+    except Exception:
+        with _lock:
+            _give_back(port)
+        raise
+    with _lock:
+        current = _sessions.get(port)
+        if current is not None and _is_open(current):
+            # Opened meanwhile by another borrower, the one in the pool is kept
+            resource.close()
+            return current
+        _sessions[port] = resource
+    return resource
+
+
+def _give_back(port):
+    """ Decrements the borrowers of a port, must be called holding the lock.
+
+    :returns: the number of borrowers left
+    """
+    count = _borrowers.get(port, 0) - 1
+    if count > 0:
+        _borrowers[port] = count
+        return count
+    _borrowers.pop(port, None)
+    return 0
+
+
+def release(resource, close=False):
+    """ Gives back a session borrowed with :func:`acquire`. When the last borrower gives it back it stays open for the
+    next :func:`acquire`, unless ``close`` is True. A session still borrowed by someone else is never closed.
+    """
+    if resource is None:
+        return
+    port = resource.resource_name
+    with _lock:
+        pooled = _sessions.get(port) is resource
+        left = _give_back(port) if pooled else 0
+        if left:
+            logger.debug(f'{port} still has {left} borrowers')
+            return
+        if not close:
+            return
+        if pooled:
+            del _sessions[port]
+    try:
+        resource.close()
+    except Exception as e:
+        logger.debug(f'Error closing {port}: {e}')
+
+
+def close_all():
+    """ Closes all the sessions in the pool. """
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+        _borrowers.clear()
+    for resource in sessions:
+        try:
+            resource.close()
+        except Exception:
+            pass
@@ -3,22 +3,36 @@
     =============
     This is an ad-hoc model for controlling an Arduino board, which will in turn control a piezo-mirror, a laser,
     and some LED's.
+
+    The values last confirmed by the board are kept in a write-through cache, so that setting a feature to the value
+    it already has does not cost a serial round trip. The cache is cleared whenever the state of the board is unknown:
+    on (re)initialization and after a communication error.
+
+    Setting a feature does not wait for the board: the command goes to a
+    :class:`~NanoCETPy.dispertech.models.command_queue.CommandQueue` and is sent by its worker thread. Use
+    :meth:`ArduinoModel.flush` where the rest of the setup must see the new value, for example before acquiring an
+    image that needs a LED on. The features only show a new value once the board confirmed it. Switching the laser off
+    is the exception: it waits for the board, and raises if the command failed.
+
+    The latency of every command, the time spent waiting for the lock, and the errors of the serial link are collected
+    in :attr:`ArduinoModel.stats`, see :mod:`~NanoCETPy.dispertech.controllers.instrumentation`.
 """
+from concurrent.futures import Future
+from functools import partial
 from multiprocessing import Event
-from threading import RLock
 from time import sleep
 
-import pyvisa
 from pyvisa import VisaIOError
 
+from NanoCETPy.dispertech.controllers import resources
 from NanoCETPy.dispertech.controllers.arduino import Arduino
+from NanoCETPy.dispertech.controllers.instrumentation import InstrumentedLock, InstrumentedResource, SerialStats
+from NanoCETPy.dispertech.models.command_queue import CommandQueue
 from experimentor.lib.log import get_logger
 from experimentor.models import Feature
 from experimentor.models.decorators import make_async_thread
 from experimentor.models.devices.base_device import ModelDevice
 
-rm = pyvisa.ResourceManager('@py')
-
 
 class ArduinoModel(ModelDevice):
     def __init__(self, port=None, device=0, baud_rate=9600, initial_config=None):
@@ -30,7 +44,9 @@ class ArduinoModel(ModelDevice):
         self._stop_temperature = Event()
         self.temp_electronics = 0
         self.temp_sample = 0
-        self.query_lock = RLock()
+        self.stats = SerialStats()
+        self.query_lock = InstrumentedLock(self.stats)
+        self.commands = CommandQueue(self.query_lock, name='arduino_commands')
         self.driver = None
         self.port = port
         self.device = device
@@ -47,6 +63,90 @@ class ArduinoModel(ModelDevice):
         self._side_led = 0
         self._power_led = 0
         self._measure_led = 0
+        self._state_cache = {}
+
+    def attach(self, resource):
+        """ Uses an open pyvisa resource as the driver, recording the statistics of its commands. The session of the
+        previous driver, if any, is given back to the pool.
+        """
+        self.detach()
+        self.driver = InstrumentedResource(resource, self.stats)
+
+    def detach(self, close=False):
+        """ Gives back the session of the driver to the pool.
+
+        :param bool close: closes the session if nobody else borrowed it
+        """
+        if self.driver is not None:
+            resources.release(self.driver.resource, close=close)
+            self.driver = None
+
+    def cached_query(self, key, value, command):
+        """ Sends ``command`` to the board unless ``value`` is already the last confirmed value of ``key``.
+
+        :param str key: name identifying the setting, normally the name of the feature
+        :param value: value the setting will have after the command
+        :param str command: the command to send
+        :returns: True if the command was sent, False if it was skipped
+        """
+        with self.query_lock:
+            if key in self._state_cache and self._state_cache[key] == value:
+                return False
+            try:
+                self.driver.query(command)
+            except VisaIOError:
+                self.invalidate_cache()
+                raise
+            self._state_cache[key] = value
+            self.logger.info(command)
+            return True
+
+    def send_setting(self, key, value, command, priority=CommandQueue.PRIORITY_NORMAL, attribute=None):
+        """ Queues a :meth:`cached_query`. Pending writes to the same setting are replaced by this one.
+
+        The attribute returned by the feature only takes the new value once the board confirmed it, and becomes None
+        (unknown) if the command failed. Settings with ``PRIORITY_SAFETY``, such as switching the laser off, are not
+        left in the queue: this waits for the board and raises the error if the command failed.
+
+        :param str attribute: name of the attribute holding the value returned by the feature
+        :returns: a :class:`~concurrent.futures.Future` that resolves to the value returned by :meth:`cached_query`
+        """
+        if priority == CommandQueue.PRIORITY_SAFETY:
+            future = Future()
+            try:
+                future.set_result(self.commands.call(self.cached_query, key, value, command, key=key,
+                                                     priority=priority))
+            except Exception:
+                self._confirm_setting(attribute, value, None)
+                raise
+            self._confirm_setting(attribute, value, future)
+            return future
+        future = self.commands.submit(self.cached_query, key, value, command, key=key, priority=priority)
+        if attribute is not None:
+            future.add_done_callback(partial(self._confirm_setting, attribute, value))
+        return future
+
+    def _confirm_setting(self, attribute, value, future):
+        """ Done callback of the setting commands, future is None if the command failed """
+        if attribute is None:
+            return
+        if future is None or future.cancelled() or future.exception() is not None:
+            value = None
+        setattr(self, attribute, value)
+
+    def flush(self, timeout=None):
+        """ Waits until all the queued commands have been sent to the board. """
+        return self.commands.flush(timeout)
+
+    def invalidate_cache(self, *keys):
+        """ Forgets the confirmed values of the given keys, or of all of them if none is given, so that the next
+        write is sent to the board regardless of its value.
+        """
+        with self.query_lock:
+            if not keys:
+                self._state_cache.clear()
+            for key in keys:
+                self._state_cache.pop(key, None)
 
     @make_async_thread
     def initialize(self):
@@ -54,15 +154,17 @@ class ArduinoModel(ModelDevice):
         servo shutter is closed, and LEDs are switched off.
         """
         with self.query_lock:
+            self.invalidate_cache()
             if not self.port:
                 self.port = Arduino.list_devices()[self.device]
-            self.driver = rm.open_resource(self.port)
+            self.attach(resources.acquire(self.port))
             sleep(1)
             self.driver.baud_rate = self.baud_rate
             # This is very silly, but clears the buffer so that next messages are not broken
             try:
                 self.driver.query("IDN")
             except VisaIOError:
+                self.stats.record_resync()
                 try:
                     self.driver.read()
                 except VisaIOError:
@@ -73,6 +175,8 @@ class ArduinoModel(ModelDevice):
                 self.config.apply_all()
 
             self.logger.info(self.driver.query(f'INI'))
+            # INI resets the outputs of the board
+            self.invalidate_cache()
 
     @Feature()
     def scattering_laser(self):
@@ -87,10 +191,9 @@ class ArduinoModel(ModelDevice):
 
     @scattering_laser.setter
     def scattering_laser(self, power):
-        with self.query_lock:
-            self.driver.query(f'laser:{power}')
-            self.logger.info(f'laser:{power}')
-            self._scattering_laser_power = int(power)
+        priority = CommandQueue.PRIORITY_SAFETY if int(power) == 0 else CommandQueue.PRIORITY_NORMAL
+        self.send_setting('scattering_laser', int(power), f'laser:{power}',
+                          priority=priority, attribute='_scattering_laser_power')
 
     @Feature()
     def side_led(self):
@@ -98,10 +201,7 @@ class ArduinoModel(ModelDevice):
 
     @side_led.setter
     def side_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:0:{status}')
-            self._side_led = status
-            self.logger.info(f'LED:0:{status}')
+        self.send_setting('side_led', status, f'LED:0:{status}', attribute='_side_led')
 
     @Feature()
     def top_led(self):
@@ -109,10 +209,7 @@ class ArduinoModel(ModelDevice):
 
     @top_led.setter
     def top_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:TOP:{status}')
-            self._top_led = status
-            self.logger.info(f'LED:TOP:{status}')
+        self.send_setting('top_led', status, f'LED:TOP:{status}', attribute='_top_led')
 
     @Feature()
     def fiber_led(self):
@@ -120,10 +217,7 @@ class ArduinoModel(ModelDevice):
 
     @fiber_led.setter
     def fiber_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:FIBER:{status}')
-            self._fiber_led = status
-            self.logger.info(f'LED:FIBER:{status}')
+        self.send_setting('fiber_led', status, f'LED:FIBER:{status}', attribute='_fiber_led')
 
     @Feature()
     def power_led(self):
@@ -131,10 +225,7 @@ class ArduinoModel(ModelDevice):
 
     @power_led.setter
     def power_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:3:{status}')
-            self._power_led = status
-            self.logger.info(f'LED:3:{status}')
+        self.send_setting('power_led', status, f'LED:3:{status}', attribute='_power_led')
 
     @Feature()
     def processing_led(self):
@@ -142,10 +233,7 @@ class ArduinoModel(ModelDevice):
 
     @processing_led.setter
     def processing_led(self, status: int):
-        with self.query_lock:
-            self.driver.query(f'LED:4:{status}')
-            self._laser_led = status
-            self.logger.info(f'LED:4:{status}')
+        self.send_setting('processing_led', status, f'LED:4:{status}', attribute='_laser_led')
 
     @Feature()
     def initialising_led(self):
@@ -153,10 +241,7 @@ class ArduinoModel(ModelDevice):
 
     @initialising_led.setter
     def initialising_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:5:{status}')
-            self._measure_led = status
-            self.logger.info(f'LED:5:{status}')
+        self.send_setting('initialising_led', status, f'LED:5:{status}', attribute='_measure_led')
 
     @Feature()
     def ready_led(self):
@@ -164,10 +249,7 @@ class ArduinoModel(ModelDevice):
 
     @ready_led.setter
     def ready_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:6:{status}')
-            self._measure_led = status
-            self.logger.info(f'LED:6:{status}')
+        self.send_setting('ready_led', status, f'LED:6:{status}', attribute='_measure_led')
 
     # @make_async_thread
     def move_piezo(self, speed, direction, axis):
@@ -182,14 +264,19 @@ class ArduinoModel(ModelDevice):
         axis : int
             1, 2, or 3 to select the axis. Normally 1 and 2 are the mirror and 3 is the lens
         """
-        # with self.query_lock:
+        self.commands.call(self._move_piezo, speed, direction, axis)
+
+    def _move_piezo(self, speed, direction, axis):
+        """ The three messages of a piezo move are sent while holding the lock, so no other query can end up in
+        between. """
         binary_speed = '{0:06b}'.format(speed)
         binary_speed = str(direction) + str(1) + binary_speed
         number = int(binary_speed, 2)
         bytestring = number.to_bytes(1, 'big')
-        self.driver.query(f"mot{axis}")
-        self.driver.write_raw(bytestring)
-        self.driver.read()
+        with self.query_lock:
+            self.driver.query(f"mot{axis}")
+            self.driver.write_raw(bytestring)
+            self.driver.read()
         self.logger.info('Finished moving')
 
     def finalize(self):
@@ -199,8 +286,9 @@ class ArduinoModel(ModelDevice):
         if self.initial_config is not None:
             self.config.update(self.initial_config)
             self.config.apply_all()
+        self.commands.stop()
         self.clean_up_threads()
         if len(self._threads):
             self.logger.warning(f'There are {len(self._threads)} still alive in Arduino')
-        self.driver.close()
+        self.detach(close=True)
         super().finalize()
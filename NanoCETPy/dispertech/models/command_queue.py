@@ -0,0 +1,162 @@
+"""
+    Command queue
+    =============
+    Serializes the communication with a serial device through a single worker thread.
+
+    Commands are callables submitted from any thread; they are executed one at a time, in order of priority and then of
+    submission, while holding the lock of the device. :meth:`CommandQueue.submit` returns immediately with a
+    :class:`~concurrent.futures.Future`, therefore GUI threads never wait for the serial port unless they need an
+    answer. Commands submitted with the same ``key`` while a previous one is still waiting are coalesced: only the last
+    one is sent to the device, and the futures of all of them get its result. This is what happens, for example, when
+    a slider changes the laser power faster than the device can follow.
+"""
+import itertools
+import threading
+from concurrent.futures import Future
+from queue import PriorityQueue
+
+from experimentor.lib.log import get_logger
+
+
+class CommandQueue:
+    """ Worker thread executing commands for a device.
+
+    :param lock: lock guarding the device, it is held while each command runs so that code still accessing the device
+        directly does not interleave with the queue
+    :param str name: name given to the worker thread
+    """
+    PRIORITY_SAFETY = 0  # for example switching the laser off, sent before anything still waiting
+    PRIORITY_NORMAL = 10
+
+    def __init__(self, lock, name='serial_commands'):
+        self.lock = lock
+        self.name = name
+        self.logger = get_logger(__name__)
+        self._queue = PriorityQueue()
+        self._counter = itertools.count()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._thread = None
+        self._idle = threading.Condition(self._pending_lock)
+        self._unfinished = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, key=None, priority=PRIORITY_NORMAL, **kwargs):
+        """ Queues ``func(*args, **kwargs)`` for execution in the worker thread.
+
+        :param key: commands with the same key replace each other while waiting to be executed, None disables it
+        :param int priority: lower values are executed first
+        :returns: a :class:`~concurrent.futures.Future` with the value returned by ``func``
+        """
+        self.start()
+        future = Future()
+        with self._pending_lock:
+            entry = [func, args, kwargs, [future]]
+            if key is not None and key in self._pending:
+                previous = self._pending[key]
+                # The previous command won't run, its callers get the result of this one
+                entry[3] = previous[3] + entry[3]
+                previous[3] = []
+                previous[0] = None
+            else:
+                self._unfinished += 1
+            if key is not None:
+                self._pending[key] = entry
+            self._queue.put((priority, next(self._counter), key, entry))
+        return future
+
+    def call(self, func, *args, timeout=None, key=None, priority=PRIORITY_NORMAL, **kwargs):
+        """ Submits a command and waits for its result, raising the exception of the command if it failed.
+
+        The worker can't run anything while the calling thread holds the lock, or if it is the worker itself, so the
+        command is then executed right away in the calling thread instead, and replaces the one waiting with the same
+        key.
+
+        :param key: as in :meth:`submit`, None (default) never coalesces the command
+        """
+        if not (threading.current_thread() is self._thread or self._holds_lock()):
+            return self.submit(func, *args, key=key, priority=priority, **kwargs).result(timeout=timeout)
+        futures = self._drop(key)
+        try:
+            with self.lock:
+                result = func(*args, **kwargs)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            raise
+        for future in futures:
+            future.set_result(result)
+        return result
+
+    def _holds_lock(self):
+        owned = getattr(self.lock, 'owned', None)
+        return owned is not None and owned()
+
+    def _drop(self, key):
+        """ Removes the command waiting with the given key.
+
+        :returns: the futures of its callers, they get the result of the command replacing it
+        """
+        if key is None:
+            return []
+        with self._idle:
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                return []
+            futures = entry[3]
+            entry[0] = None
+            entry[3] = []
+            self._unfinished -= 1
+            self._idle.notify_all()
+        return [f for f in futures if f.set_running_or_notify_cancel()]
+
+    def flush(self, timeout=None):
+        """ Blocks until every command submitted so far has been executed.
+
+        :returns: False if the timeout expired before that
+        """
+        if threading.current_thread() is self._thread:
+            return True
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0, timeout=timeout)
+
+    def stop(self, timeout=None):
+        """ Executes the commands still waiting and stops the worker thread. """
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._queue.put((float('inf'), next(self._counter), None, None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            priority, _, key, entry = self._queue.get()
+            if entry is None:
+                return
+            with self._pending_lock:
+                func, args, kwargs, futures = entry
+                if func is None:  # Coalesced into a newer command
+                    continue
+                if key is not None and self._pending.get(key) is entry:
+                    del self._pending[key]
+            futures = [f for f in futures if f.set_running_or_notify_cancel()]
+            try:
+                with self.lock:
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                self.logger.error(f'Command {getattr(func, "__name__", func)}{args} failed: {e}')
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(result)
+            finally:
+                with self._idle:
+                    self._unfinished -= 1
+                    self._idle.notify_all()
@@ -0,0 +1,107 @@
+"""
+    file_naming.py
+    ==============
+
+    Chooses the names of the files where the measurements are saved.
+
+    Finding a free name used to mean checking, one by one, whether every candidate already existed in the folder, and
+    the views listed the folder to find which file was the latest one. The :class:`FileNamer` reads a folder only once
+    per template: a regular expression built from the template finds the highest counter already used, and it is kept
+    in memory, so the next name is known without touching the disk again. The new file is claimed by creating it in
+    exclusive mode, so two savers starting at the same time, even from different processes, never get the same name.
+    The namer also remembers the last name it gave, which is the file the saver actually writes to, so the views can
+    show it without looking at the folder.
+"""
+import os
+import re
+import string
+import threading
+
+from experimentor.lib.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def template_pattern(template, **fields):
+    """ Regular expression matching the names given by a template, with the counter {i} in the group ``i``.
+
+    :param str template: file name with a placeholder {i} for the counter, plus the placeholders given in fields
+    :returns: compiled pattern
+    """
+    formatter = string.Formatter()
+    parts = []
+    counter = False
+    for literal, field, spec, conversion in formatter.parse(template):
+        parts.append(re.escape(literal))
+        if field is None:
+            continue
+        if field == 'i':
+            parts.append(r'(?P=i)' if counter else r'(?P<i>\d+)')
+            counter = True
+        else:
+            value = formatter.format_field(formatter.convert_field(fields[field], conversion), spec)
+            parts.append(re.escape(value))
+    if not counter:
+        raise ValueError(f'The template {template} has no {{i}} placeholder for the counter')
+    return re.compile(''.join(parts) + '$')
+
+
+class FileNamer:
+    """ Gives new file names, keeping in memory the next free counter of every template in every folder. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = {}  # (folder, template, fields): next counter to try
+        self.last_filename = None
+
+    @staticmethod
+    def highest_index(folder, pattern):
+        """ :returns: the highest counter of the files in the folder matching the pattern, or None if there are none """
+        highest = None
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    match = pattern.match(entry.name)
+                    if match is not None:
+                        index = int(match.group('i'))
+                        highest = index if highest is None else max(highest, index)
+        except FileNotFoundError:
+            pass
+        return highest
+
+    def new_filename(self, folder, template, start=0, **fields):
+        """ Creates an empty file with the first counter above the ones used in the folder, so no other saver can take
+        the same name. The saver then overwrites it.
+
+        :param str folder: folder where the file is created
+        :param str template: file name with a placeholder {i} for the counter, plus the placeholders given in fields
+        :param int start: first value of the counter
+        :returns: full path to the new file
+        """
+        key = (folder, template, tuple(sorted(fields.items())))
+        with self._lock:
+            i = self._next.get(key)
+            if i is None:
+                highest = self.highest_index(folder, template_pattern(template, **fields))
+                i = start if highest is None else max(highest + 1, start)
+                logger.debug(f'Next counter for {template} in {folder}: {i}')
+            while True:
+                filename = os.path.join(folder, template.format(i=i, **fields))
+                try:
+                    with open(filename, 'x'):
+                        pass
+                except FileExistsError:
+                    # Created by someone else since the folder was read
+                    i += 1
+                    continue
+                break
+            self._next[key] = i + 1
+            self.last_filename = filename
+            return filename
+
+    def forget(self, folder=None):
+        """ Drops the counters of a folder, or of all of them, so the folder is read again the next time. """
+        with self._lock:
+            if folder is None:
+                self._next.clear()
+            else:
+                self._next = {key: i for key, i in self._next.items() if key[0] != folder}
@@ -0,0 +1,72 @@
+"""
+    frame_feed.py
+    =============
+
+    Latest-value mailbox for images produced by a model, such as the frames of a camera or the waterfall of a
+    measurement.
+
+    The producer calls :meth:`FrameFeed.publish` every time it has a new image. The feed only keeps the latest one, it
+    never queues images, so a slow consumer can not slow down or build up memory on the producer side. Consumers can
+    read the latest image at any time with :meth:`FrameFeed.latest`, or :meth:`FrameFeed.subscribe` to be called on
+    every new image. Subscribers are called from the thread of the producer, so they must return quickly: the display
+    feed of the views, for example, only wakes up the GUI thread, which then reads the latest image.
+
+    A feed can also copy every image to a :class:`~NanoCETPy.dispertech.models.frame_mailbox.FrameMailbox`, so other
+    processes can read the latest image from shared memory.
+"""
+import threading
+import time
+
+from experimentor.lib.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class FrameFeed:
+    """ Holds the latest image of a producer, with its id and the time it was published. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self.frame_id = 0
+        self.image = None
+        self.timestamp = None
+        self.mailbox = None  # Optional FrameMailbox receiving a copy of every image
+
+    def publish(self, image, frame_id=None):
+        """ Stores a new image and notifies the subscribers.
+
+        :param image: the new image, it is stored by reference and should not be modified afterwards
+        :param int frame_id: id of the image, by default the id of the previous image plus one
+        """
+        with self._lock:
+            self.frame_id = self.frame_id + 1 if frame_id is None else frame_id
+            self.image = image
+            self.timestamp = time.time()
+            frame_id = self.frame_id
+            timestamp = self.timestamp
+            subscribers = list(self._subscribers)
+            mailbox = self.mailbox
+        if mailbox is not None:
+            mailbox.publish(image, frame_id, timestamp)
+        for callback in subscribers:
+            try:
+                callback(frame_id, image)
+            except Exception:
+                logger.exception(f'Error in subscriber {callback} of a frame feed')
+
+    def latest(self):
+        """ :returns: tuple (frame id, image, timestamp) of the latest image, the image is None if nothing was
+            published yet
+        """
+        with self._lock:
+            return self.frame_id, self.image, self.timestamp
+
+    def subscribe(self, callback):
+        """ :param callback: called as ``callback(frame_id, image)`` from the producer thread for every new image """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
@@ -0,0 +1,174 @@
+"""
+    frame_mailbox.py
+    ================
+
+    Latest frame of a camera in shared memory, readable from other threads and processes without tearing.
+
+    The :class:`~NanoCETPy.dispertech.models.frame_feed.FrameFeed` hands out references to the frames, which is enough
+    within a process as long as nobody modifies them. The :class:`FrameMailbox` keeps a copy of the latest frame, with
+    its id and timestamp, in a block of shared memory, so processes such as the saver or an analysis worker can read it
+    by name instead of receiving every frame over ZMQ.
+
+    The block holds two slots (double buffer): the producer always writes the slot that is not the latest one, and then
+    marks it as the latest. Every slot has a sequence counter (seqlock) that is odd while the slot is written. A reader
+    copies the latest slot and checks that the counter was even and did not change meanwhile, otherwise it reads again.
+    Readers therefore never block the producer, and only have to retry if the producer wrote two frames during a
+    single copy.
+"""
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from experimentor.lib.log import get_logger
+
+logger = get_logger(__name__)
+
+_HEADER = np.dtype([('latest', '<i8'), ('capacity', '<i8')])
+_SLOT = np.dtype([
+    ('seq', '<u8'),
+    ('frame_id', '<i8'),
+    ('timestamp', '<f8'),
+    ('ndim', '<i8'),
+    ('shape', '<i8', (4,)),
+    ('dtype', 'S16'),
+])
+_HEADER_SIZE = 64
+_SLOTS = 2
+
+
+def _aligned(size, alignment=64):
+    return -(-size // alignment) * alignment
+
+
+class FrameMailbox:
+    """ Shared-memory mailbox with the latest frame of a producer.
+
+    The producer creates it with the size of the largest frame it can publish; other processes attach to it with
+    :meth:`attach` and the :attr:`name` of the block. The mailbox can also be given directly to a process, it is then
+    attached by name when unpickled.
+
+    :param int capacity: maximum size of a frame, in bytes
+    :param str name: name of the shared memory block to create, a random one by default
+    """
+    def __init__(self, capacity, name=None, _shm=None):
+        self.owner = _shm is None
+        if self.owner:
+            self._data_size = _aligned(capacity)
+            size = _HEADER_SIZE + _aligned(_SLOTS * _SLOT.itemsize) + _SLOTS * self._data_size
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._shm = _shm
+        self._header = np.ndarray((1,), dtype=_HEADER, buffer=self._shm.buf)
+        if self.owner:
+            self._header['latest'] = -1
+            self._header['capacity'] = self._data_size
+        self._data_size = int(self._header['capacity'][0])
+        self._slots = np.ndarray((_SLOTS,), dtype=_SLOT, buffer=self._shm.buf, offset=_HEADER_SIZE)
+        self._data_offset = _HEADER_SIZE + _aligned(_SLOTS * _SLOT.itemsize)
+        self._lock = threading.Lock()
+        self._too_large = False
+
+    @classmethod
+    def attach(cls, name):
+        """ Opens the mailbox created by another process. """
+        shm = shared_memory.SharedMemory(name=name, create=False)
+        try:
+            # Only the producer should remove the block, not the tracker of the reading process when it exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return cls(0, _shm=shm)
+
+    def __reduce__(self):
+        return self.attach, (self.name,)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def capacity(self):
+        """ Maximum size of a frame, in bytes """
+        return self._data_size
+
+    @property
+    def frame_id(self):
+        """ Id of the latest frame, 0 if nothing was published yet. It is cheap, to check for new frames. """
+        slot = int(self._header['latest'][0])
+        return 0 if slot < 0 else int(self._slots['frame_id'][slot])
+
+    def _view(self, slot, shape, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self._shm.buf,
+                          offset=self._data_offset + slot * self._data_size)
+
+    def publish(self, image, frame_id, timestamp=None):
+        """ Copies a frame to the mailbox.
+
+        :param image: array with at most 4 dimensions, it is stored in C order
+        :param int frame_id: id of the frame
+        :param float timestamp: time of the frame, now by default
+        :returns: False if the frame is larger than the capacity and was not stored
+        """
+        image = np.asarray(image)
+        if image.nbytes > self._data_size or image.ndim > 4:
+            if not self._too_large:
+                logger.warning(f'Frame of shape {image.shape} does not fit in the mailbox {self.name}')
+                self._too_large = True
+            return False
+        with self._lock:
+            latest = int(self._header['latest'][0])
+            slot = 0 if latest < 0 else (latest + 1) % _SLOTS
+            self._slots['seq'][slot] += 1  # Odd: being written
+            np.copyto(self._view(slot, image.shape, image.dtype), image)
+            self._slots['frame_id'][slot] = frame_id
+            self._slots['timestamp'][slot] = time.time() if timestamp is None else timestamp
+            self._slots['ndim'][slot] = image.ndim
+            self._slots['shape'][slot] = image.shape + (0,) * (4 - image.ndim)
+            self._slots['dtype'][slot] = image.dtype.str.encode()
+            self._slots['seq'][slot] += 1
+            self._header['latest'] = slot
+        return True
+
+    def read(self, out=None):
+        """ Copies the latest frame.
+
+        :param out: array where to copy the frame, used only if it has the shape and type of the frame
+        :returns: tuple (frame id, timestamp, image), the image is None if nothing was published yet
+        """
+        while True:
+            slot = int(self._header['latest'][0])
+            if slot < 0:
+                return 0, None, None
+            seq = int(self._slots['seq'][slot])
+            if seq % 2:
+                # The producer went around the two slots while this one was read
+                time.sleep(0)
+                continue
+            ndim = int(self._slots['ndim'][slot])
+            shape = tuple(int(n) for n in self._slots['shape'][slot][:ndim])
+            dtype = np.dtype(self._slots['dtype'][slot].decode())
+            frame_id = int(self._slots['frame_id'][slot])
+            timestamp = float(self._slots['timestamp'][slot])
+            source = self._view(slot, shape, dtype)
+            if out is not None and out.shape == shape and out.dtype == dtype:
+                np.copyto(out, source)
+                image = out
+            else:
+                image = source.copy()
+            del source
+            if int(self._slots['seq'][slot]) == seq:
+                return frame_id, timestamp, image
+
+    def close(self):
+        """ Releases the shared memory in this process, and removes it if this process created it. """
+        if self._shm is None:
+            return
+        self._header = None
+        self._slots = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+        self._shm = None
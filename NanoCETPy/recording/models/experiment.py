@@ -4,19 +4,18 @@ from datetime import datetime
 from multiprocessing import Event
 
 import numpy as np
-from scipy import optimize
 from skimage import data
 
 from NanoCETPy.dispertech.models.arduino import ArduinoModel
 from experimentor import Q_
 from experimentor.models.action import Action
 from experimentor.models.decorators import make_async_thread
-from experimentor.models.devices.cameras.basler.basler import BaslerCamera as Camera
 from experimentor.models.experiments import Experiment
+from NanoCETPy.dispertech.models.file_naming import FileNamer
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
 from NanoCETPy.recording.models.movie_saver import WaterfallSaver
-
-
-# from . import model_utils as ut
+from NanoCETPy.sequential.models.basler import BaslerNanoCET as Camera
+from NanoCETPy.sequential.models import model_utils as ut
 
 
 class RecordingSetup(Experiment):
@@ -33,11 +32,17 @@ class RecordingSetup(Experiment):
         self.saving_event = Event()
         self.saving = False
         self.saving_process = None
-        
+        self.file_namer = FileNamer()
+        self.current_file = None  # File where the last movie was saved
+
 
         self.demo_image = data.colorwheel()
         self.waterfall_image = self.demo_image
         self.display_image = self.demo_image
+        self.display_feed = FrameFeed()  # Frames of the camera being displayed
+        self.display_feed.publish(self.demo_image)
+        self.waterfall_feed = FrameFeed()
+        self.waterfall_feed.publish(self.waterfall_image)
         self.active = True
         self.now = None
 
@@ -55,10 +60,21 @@ class RecordingSetup(Experiment):
         self.logger.info('Initializing cameras')
         config_mic = self.config['camera_microscope']
         self.camera_microscope = Camera(config_mic['init'], initial_config=config_mic['config'])
+        self.camera_microscope.feed.subscribe(self._display_forwarder(self.camera_microscope))
         self.logger.info(f'Initializing {self.camera_microscope}')
         self.camera_microscope.initialize()
         self.logger.debug(f'Configuring {self.camera_microscope}')
 
+    def _display_forwarder(self, camera):
+        """ :returns: a subscriber to the feed of ``camera`` that publishes its frames on :attr:`display_feed` while it
+            is the camera being displayed
+        """
+        def forward(frame_id, image):
+            if self.display_camera is camera:
+                self.display_image = image
+                self.display_feed.publish(image)
+        return forward
+
     def initialize_electronics(self):
         """ Initializes the electronics associated witht he experiment (but not the cameras).
 
@@ -81,15 +97,18 @@ class RecordingSetup(Experiment):
         time.sleep(1)
         self.snap_image(self.camera_microscope)
         time.sleep(1)
-        img = self.camera_microscope.temp_image
+        _, _, img = self.camera_microscope.latest_frame()
         measure = np.sum(img, axis=0)
         cx = np.argwhere(measure == np.max(measure))[0][0]
-        measure = measure[cx-100:cx+100]
-        xvals = np.arange(0,measure.shape[0],1)
-        gaussian1d = lambda x, mean, var, A, bg: A * np.exp(-(x-mean)**2 / (2 *var)) + bg
-        popt, pcov = optimize.curve_fit(gaussian1d, xvals, measure, p0=[0, 50, np.max(measure)-np.min(measure), np.min(measure)])
-        cx += int(popt[0])
-        width = 2 * int(2 * np.sqrt(popt[1]))    
+        start = max(cx - 100, 0)
+        centers, sigmas, confidence = ut.fit_gaussian_profiles(measure[start:cx+100], refine=True)
+        self.logger.info(f'Fitted core with confidence {confidence[0]:.2f}')
+        if not np.isfinite(centers[0]):
+            self.logger.warning('Could not find the fiber core, keeping the current ROI')
+            self.toggle_live(self.camera_microscope)
+            return
+        cx = start + int(centers[0])
+        width = 2 * int(2 * sigmas[0])
 
         current_roi = self.camera_microscope.ROI
         new_roi = (current_roi[0], (cx-width, 2*width))
@@ -103,13 +122,14 @@ class RecordingSetup(Experiment):
         """Assuming a set ROI, this function calculates a waterfall slice per image frame and sends it to a MovieSaver instance
         """
         self.start_saving_images()
-        img = self.camera_microscope.temp_image
+        _, _, img = self.camera_microscope.latest_frame()
         self.waterfall_image = np.zeros((img.shape[0],1000)) #MAKE CONFIG PARAMETER
         while self.active:
-            img = self.camera_microscope.temp_image
+            _, _, img = self.camera_microscope.latest_frame(out=img)
             new_slice = np.sum(img, axis=1)
             self.waterfall_image = np.roll(self.waterfall_image, -1, 1)
             self.waterfall_image[:,-1] = new_slice
+            self.waterfall_feed.publish(self.waterfall_image)
             time.sleep(.1)
         self.stop_saving_images()
         
@@ -123,6 +143,7 @@ class RecordingSetup(Experiment):
         self.saving = True
         base_filename = self.config['info']['filename_movie']
         file = self.get_filename(base_filename)
+        self.current_file = file
         self.saving_event.clear()
         self.saving_process = WaterfallSaver(
             file,
@@ -154,8 +175,8 @@ class RecordingSetup(Experiment):
             return
         camera.acquisition_mode = camera.MODE_SINGLE_SHOT
         camera.trigger_camera()
-        camera.read_camera()
         self.display_camera = camera
+        camera.read_camera()
         self.logger.info('Snap Image complete')
 
     @Action    
@@ -166,6 +187,7 @@ class RecordingSetup(Experiment):
             camera.stop_free_run()
             self.logger.info('Continuous reads ended')
             self.display_camera = None
+            self.display_feed.publish(self.demo_image)
         else:
             camera.start_free_run()
             camera.continuous_reads()
@@ -190,6 +212,8 @@ class RecordingSetup(Experiment):
         power = int(power)
 
         self.electronics.scattering_laser = power
+        # Wait for the new power before anything is acquired with it
+        self.electronics.flush()
         self.config['laser']['power'] = power
 
     @Action
@@ -226,21 +250,15 @@ class RecordingSetup(Experiment):
         return folder
 
     def get_filename(self, base_filename: str) -> str:
-        """Checks if the given filename exists in the given folder and increments a counter until the first non-used
-        filename is available.
+        """Creates an empty file in the folder of the day, with the counter following the highest one already used.
+        The folder is read only the first time, then :attr:`file_namer` keeps the next counter in memory.
 
         :param base_filename: must have two placeholders {cartridge_number} and {i}
         :returns: full path to the file where to save the data
         """
         folder = self.prepare_folder()
-        i = 0
         cartridge_number = self.config['info']['cartridge_number']
-        while os.path.isfile(os.path.join(folder, base_filename.format(
-                cartridge_number=cartridge_number,
-                i=i))):
-            i += 1
-
-        return os.path.join(folder, base_filename.format(cartridge_number=cartridge_number, i=i))
+        return self.file_namer.new_filename(folder, base_filename, start=0, cartridge_number=cartridge_number)
 
     def finalize(self):
         if self.finalized:
@@ -127,7 +127,8 @@ class WaterfallSaver(ExperimentorProcess):
         socket.connect(self.url)
         socket.setsockopt(zmq.SUBSCRIBE, self.topic.encode('utf-8'))
 
-        with h5py.File(self.file, "a") as f:
+        # The file was claimed empty when choosing its name, see FileNamer.new_filename
+        with h5py.File(self.file, "w") as f:
             g = f.create_group('data')
             i = 0
             j = 0
@@ -1,17 +1,15 @@
 import os
 import time
 
-import numpy as np
-
 BASE_DIR_VIEW = os.path.dirname(os.path.abspath(__file__))
 
 from PyQt5 import uic, QtGui
-from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QMainWindow
 
 from experimentor.lib.log import get_logger
 from experimentor.views.base_view import BaseView
 from experimentor.views.camera.camera_viewer_widget import CameraViewerWidget
+from NanoCETPy.sequential.views.display_feed import DisplayFeed
 
 logger = get_logger(__name__)
 
@@ -36,25 +34,19 @@ class WaterfallWindow(QMainWindow, BaseView):
         while self.experiment.camera_microscope.config['exposure'] is None:
             time.sleep(.1)
         
-        self.update_image_timer = QTimer()
-        self.update_image_timer.timeout.connect(self.update_image)
-        self.update_image_timer.start(50)
-        self.update_processed_image_timer = QTimer()
-        self.update_processed_image_timer.timeout.connect(self.update_waterfall)
-        self.update_processed_image_timer.start(50)
-
-    def update_image(self):
-        img = self.experiment.get_latest_image()
-        if np.sum(img) == None: 
-            img = np.zeros((800,800))
-            img[100:700,100:700] += np.ones((600,600))
+        self.display_feed = DisplayFeed(self.experiment.display_feed, parent=self)
+        self.display_feed.new_frame.connect(self.update_image)
+        self.waterfall_feed = DisplayFeed(self.experiment.waterfall_feed, parent=self)
+        self.waterfall_feed.new_frame.connect(self.update_waterfall)
+
+    def update_image(self, frame_id, img):
         self.camera_viewer.update_image(img)
 
-    def update_waterfall(self):
-        img = self.experiment.get_waterfall_image()
+    def update_waterfall(self, frame_id, img):
         self.waterfall_viewer.update_image(img)
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         logger.info('Alignment Window Closed')
-        self.update_image_timer.stop()
+        self.display_feed.close()
+        self.waterfall_feed.close()
         super().closeEvent(a0)
\ No newline at end of file
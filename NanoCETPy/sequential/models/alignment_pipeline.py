@@ -0,0 +1,131 @@
+"""
+    Pipelined execution of the alignment routines.
+
+    Every step of the alignment is a piezo move, a settling time, an exposure and the analysis of the frame. The
+    :class:`AlignmentPipeline` runs the analysis on a worker thread, so that the acquisition thread can continue with
+    whatever does not depend on its result (switching LEDs, changing the exposure, moving to the next position of a
+    sweep). The settling time is counted from the moment the firmware reports the end of the piezo motion, therefore
+    any work done in between is not added on top of it, as it happened with the fixed sleeps. Its length depends on the
+    routine, and is by default the one of the sleeps it replaces (:attr:`AlignmentPipeline.SETTLE_TIMES`); it can be
+    changed in the configuration once measured on the hardware.
+
+    Each routine chooses its next move from the analysis of the last frame, so the analysis can't overlap with the next
+    move or exposure of the same search; it only overlaps with other work, such as reconfiguring the cameras while the
+    fiber center is computed.
+
+    Every step is recorded, with its timings, in an :class:`~NanoCETPy.sequential.models.alignment_trace.AlignmentTrace`.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from experimentor.lib.log import get_logger
+from .alignment_trace import AlignmentTrace
+
+
+class AlignmentPipeline:
+    """ Executes the move/acquire/analyse steps of the alignment routines.
+
+    :param electronics: the Arduino model controlling the piezos
+    :param float settle_time: time in seconds the piezos need to settle after the end of a motion
+    :param dict settle_times: settling time of the steps of specific routines, keyed by the name of the section of the
+        trace they run in; they override ``settle_time``. :attr:`SETTLE_TIMES` by default
+    :param trace: :class:`~NanoCETPy.sequential.models.alignment_trace.AlignmentTrace` where the steps are recorded, a
+        new one is created if not given
+    """
+    # Former fixed sleeps of the routines, in seconds
+    SETTLE_TIMES = {
+        'find_focus': 0.05,
+        'align_laser_coarse': 0.1,
+        'align_laser_fine': 0.1,
+    }
+
+    def __init__(self, electronics, settle_time=0.1, settle_times=None, trace=None):
+        self.electronics = electronics
+        self.settle_time = settle_time
+        self.settle_times = dict(self.SETTLE_TIMES if settle_times is None else settle_times)
+        self.trace = trace if trace is not None else AlignmentTrace()
+        self.logger = get_logger(__name__)
+        self.motion_times = []
+        self._last_motion_end = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='alignment_analysis')
+
+    def move(self, speed, direction, axis):
+        """ Moves a piezo and blocks until the firmware acknowledges the end of the motion. The duration of the motion
+        is stored in :attr:`motion_times`.
+        """
+        t0 = time.perf_counter()
+        self.electronics.move_piezo(speed, direction, axis)
+        self._last_motion_end = time.perf_counter()
+        self.motion_times.append(self._last_motion_end - t0)
+        return self.motion_times[-1]
+
+    def settle(self):
+        """ Waits until the settling time of the current routine has passed since the end of the last motion.
+
+        :returns: the time waited, in seconds
+        """
+        settle_time = self.settle_times.get(self.trace.phase, self.settle_time)
+        remaining = self._last_motion_end + settle_time - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+            return remaining
+        return 0.
+
+    def acquire(self, camera):
+        """ Waits for the piezos to settle and acquires a single frame. """
+        self.settle()
+        self.electronics.flush()
+        camera.trigger_camera()
+        return camera.read_camera()[-1]
+
+    def submit(self, analysis, *args, **kwargs):
+        """ Runs ``analysis`` on the worker thread.
+
+        :returns: a :class:`concurrent.futures.Future` with its result
+        """
+        return self._executor.submit(analysis, *args, **kwargs)
+
+    def measure(self, camera, analysis, merit=None, _command=None, _move=0.):
+        """ Acquires a frame and analyses it on the worker thread. The step is added to :attr:`trace`.
+
+        :param camera: camera to trigger and read
+        :param analysis: function that takes the frame and returns the result of the step
+        :param merit: function that converts the result of the analysis to the scalar recorded in the trace, by default
+            the result itself is recorded if it is a scalar
+        :returns: a future with the tuple (frame, result of the analysis)
+        """
+        settle = self.settle()
+        t1 = time.perf_counter()
+        self.electronics.flush()  # LEDs and laser changes are queued, they must be applied before acquiring
+        camera.trigger_camera()
+        img = camera.read_camera()[-1]
+        acquisition = time.perf_counter() - t1
+        phase = self.trace.phase
+
+        def analyse():
+            t2 = time.perf_counter()
+            result = analysis(img)
+            duration = time.perf_counter() - t2
+            if merit is not None:
+                value = merit(result)
+            else:
+                value = result if np.ndim(result) == 0 else np.nan
+            self.trace.record(getattr(analysis, '__name__', ''), img, command=_command, move=_move, settle=settle,
+                              acquisition=acquisition, analysis=duration, merit=float(value), phase=phase)
+            return img, result
+        return self._executor.submit(analyse)
+
+    def step(self, speed, direction, axis, camera, analysis, merit=None):
+        """ Moves a piezo, then acquires and analyses a frame. See :meth:`measure`. """
+        move = self.move(speed, direction, axis)
+        return self.measure(camera, analysis, merit=merit, _command=(axis, direction, speed), _move=move)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.trace.finish()
+        if self.motion_times:
+            self.logger.info(f'{len(self.motion_times)} piezo moves, '
+                             f'average duration {1000 * sum(self.motion_times) / len(self.motion_times):.1f}ms')
+        self.logger.info(self.trace.format_summary())
@@ -0,0 +1,125 @@
+"""
+    Structured record of the alignment procedure.
+
+    Every move/acquire/analyse step executed by the :class:`~NanoCETPy.sequential.models.alignment_pipeline.AlignmentPipeline`
+    is stored as one row of an :class:`AlignmentTrace`, together with a small thumbnail of the frame it analysed. The
+    trace is saved next to the alignment images in the measurement file, as a compound dataset that can be read
+    directly with ``h5py`` or ``pandas``, and it keeps the time spent in each phase of the alignment, which is logged as
+    a summary once the alignment finishes.
+"""
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class AlignmentTrace:
+    """ Collects the steps of an alignment.
+
+    :param int thumbnail_size: side, in pixels, of the square thumbnails stored with every step
+    """
+    dtype = np.dtype([
+        ('phase', 'S32'),
+        ('step', 'S32'),
+        ('time', 'f8'),
+        ('axis', 'i2'),
+        ('direction', 'i2'),
+        ('speed', 'i2'),
+        ('move', 'f4'),
+        ('settle', 'f4'),
+        ('acquisition', 'f4'),
+        ('analysis', 'f4'),
+        ('merit', 'f8'),
+    ])
+
+    def __init__(self, thumbnail_size=64):
+        self.thumbnail_size = thumbnail_size
+        self.records = []
+        self.thumbnails = []
+        self.phases = {}
+        self.phase = ''
+        self.start = time.time()
+        self.end = None  # Set by finish, when the alignment is over
+
+    @contextmanager
+    def section(self, name):
+        """ Context manager that labels the steps recorded inside it with ``name`` and accumulates its duration. """
+        previous, self.phase = self.phase, name
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - t0
+            self.phase = previous
+
+    def record(self, step, image=None, command=None, move=0., settle=0., acquisition=0., analysis=0., merit=np.nan,
+               phase=None):
+        """ Adds a step to the trace.
+
+        :param str step: name of the step, for example the merit function used
+        :param image: frame acquired in the step, stored as a thumbnail
+        :param command: tuple (axis, direction, speed) of the piezo move preceding the acquisition, if any
+        :param float move: duration of the piezo move in seconds
+        :param float settle: time waited for the piezos to settle, in seconds
+        :param float acquisition: time spent triggering and reading the camera, in seconds
+        :param float analysis: time spent analysing the frame, in seconds
+        :param float merit: value of the figure of merit for the frame
+        :param str phase: phase of the alignment the step belongs to, by default the current :meth:`section`
+        """
+        axis, direction, speed = command if command is not None else (-1, -1, 0)
+        phase = self.phase if phase is None else phase
+        self.records.append((phase.encode('ascii', 'replace'), step.encode('ascii', 'replace'),
+                             time.time() - self.start, axis, direction, speed, move, settle, acquisition, analysis,
+                             merit))
+        self.thumbnails.append(self.make_thumbnail(image))
+
+    def finish(self):
+        """ Marks the end of the alignment, so the total time does not include what happens afterwards. """
+        if self.end is None:
+            self.end = time.time()
+
+    def make_thumbnail(self, image):
+        """ Subsamples a frame to a square 8-bit thumbnail, scaled to its own maximum. """
+        thumbnail = np.zeros((self.thumbnail_size, self.thumbnail_size), dtype=np.uint8)
+        if image is None or np.ndim(image) != 2:
+            return thumbnail
+        rows = np.linspace(0, image.shape[0] - 1, self.thumbnail_size).astype(int)
+        cols = np.linspace(0, image.shape[1] - 1, self.thumbnail_size).astype(int)
+        sub = np.asarray(image[np.ix_(rows, cols)], dtype=float)
+        mx = sub.max()
+        if mx > 0:
+            thumbnail[:] = np.clip(sub * 255 / mx, 0, 255)
+        return thumbnail
+
+    def to_array(self):
+        """ :returns: the steps as a structured array with :attr:`dtype` """
+        return np.array(self.records, dtype=self.dtype)
+
+    def summary(self):
+        """ Time spent in every phase of the alignment and in every kind of operation of its steps.
+
+        :returns: a dictionary with the times in seconds
+        """
+        records = self.to_array()
+        summary = {f'phase/{name}': duration for name, duration in self.phases.items()}
+        for field in ('move', 'settle', 'acquisition', 'analysis'):
+            summary[f'steps/{field}'] = float(np.sum(records[field])) if len(records) else 0.
+        summary['steps/count'] = len(records)
+        summary['total'] = (self.end if self.end is not None else time.time()) - self.start
+        return summary
+
+    def format_summary(self):
+        summary = self.summary()
+        phases = ', '.join(f'{key[6:]}: {value:.2f}s' for key, value in summary.items() if key.startswith('phase/'))
+        return (f"Alignment took {summary['total']:.1f}s ({phases}). {summary['steps/count']} steps spent "
+                f"{summary['steps/move']:.2f}s moving, {summary['steps/settle']:.2f}s settling, "
+                f"{summary['steps/acquisition']:.2f}s acquiring and {summary['steps/analysis']:.2f}s analysing")
+
+    def save(self, group):
+        """ Stores the trace in an HDF5 group, as the datasets ``steps`` and ``thumbnails``. The time summary is
+        stored in the attributes of the group.
+        """
+        group.create_dataset('steps', data=self.to_array())
+        if self.thumbnails:
+            group.create_dataset('thumbnails', data=np.stack(self.thumbnails), compression='gzip', compression_opts=1)
+        group.attrs.update(self.summary())
@@ -3,18 +3,19 @@
 
 """
 
+import re
 import time
 
-import pyvisa
 from pyvisa import VisaIOError
 
+from NanoCETPy.dispertech.controllers import resources
+from NanoCETPy.dispertech.controllers.discovery import find_device
 from NanoCETPy.dispertech.models.arduino import ArduinoModel
+from NanoCETPy.dispertech.models.command_queue import CommandQueue
 from experimentor.lib.log import get_logger
 from experimentor.models import Feature
 from experimentor.models.decorators import make_async_thread
 
-rm = pyvisa.ResourceManager('@py')
-
 
 class ArduinoNanoCET(ArduinoModel):
     """
@@ -25,12 +26,28 @@ class ArduinoNanoCET(ArduinoModel):
     otherwise it raises an error.
 
     The device is found by querying any connected serial devices for their name and expecting 'Dispertech' as the beginning.
+    The port where it was found is kept in :attr:`last_port` and is tried first the next time, see
+    :func:`~NanoCETPy.dispertech.controllers.discovery.find_device`.
 
     Additional getters and setters for laser and LEDs have been added as the query string was changed in the Arduino firmware.
+
+    The four status LEDs can be set at once with :meth:`state`. Firmware from version :attr:`STATE_FIRMWARE` on accepts
+    them in a single ``STATE:power,cartridge,sample,measuring`` command, older firmware gets one ``LED`` command per
+    LED that actually changes.
     """
-    def __init__(self, port=None, device=0, baud_rate=9600, initial_config=None):
+    STATE_FIRMWARE = (1, 1)  # first firmware version that understands the STATE command
+    STATUS_LEDS = ('power_led', 'cartridge_led', 'sample_led', 'measuring_led')
+    MOVE_FIRMWARE = (1, 1)  # first firmware version that understands the MOVE command
+    MAX_MOVE = 1800  # ms, longest motion of a single command, limited by the piezo driver
+    MOTION_TIMEOUT_MARGIN = 500  # ms, added to the duration of a motion to get the timeout of its query
+    HOME_TIMEOUT = 30000  # ms
+
+    IDN_PREFIX = 'Dispertech nanoCET FW'
+
+    def __init__(self, port=None, device=0, baud_rate=9600, initial_config=None, last_port=None):
         super().__init__(port=port, device=device, baud_rate=baud_rate, initial_config=initial_config)
         self.logger = get_logger(__name__)
+        self.last_port = last_port
         self.initialized = False
         self.initializing = False
         self.led_states = {
@@ -46,14 +63,15 @@ class ArduinoNanoCET(ArduinoModel):
         }
 
         self.last_state_set = 'standby'
-        self._cartridge_led = 0
         self._scattering_laser_power = 0
         self._top_led = 0
         self._fiber_led = 0
         self._side_led = 0
         self._power_led = 0
+        self._cartridge_led = 0
         self._sample_led = 0
         self._measuring_led = 0
+        self.firmware_version = (0, 0)
         self.driver = None
 
     def serial_number(self):
@@ -67,24 +85,67 @@ class ArduinoNanoCET(ArduinoModel):
             self.factory_piezo = factory[:3]
             self.factory_cam = factory[3:]
 
-    def home_piezo(self):
-        timeout = self.driver.timeout
-        self.driver.timeout = 30000
+    def timed_query(self, command, timeout):
+        """ Sends a query that takes longer than the usual VISA timeout to be answered, such as a motion that only
+        gets its answer once it is complete.
+
+        :param str command: the query
+        :param float timeout: timeout in milliseconds for this query only
+        """
         with self.query_lock:
-            self.driver.query('HOME')
-        self.driver.timeout = timeout
+            original_timeout = self.driver.timeout
+            self.driver.timeout = timeout
+            try:
+                return self.driver.query(command)
+            finally:
+                self.driver.timeout = original_timeout
+
+    def home_piezo(self, wait=True):
+        """ Homes the piezos. The firmware answers once the homing is complete.
+
+        :param bool wait: if False, returns a :class:`~concurrent.futures.Future` instead of blocking
+        """
+        if wait:
+            return self.commands.call(self.timed_query, 'HOME', self.HOME_TIMEOUT)
+        return self.commands.submit(self.timed_query, 'HOME', self.HOME_TIMEOUT)
 
     def move_piezo_to_factory(self):
         self.home_piezo()
-        x, y, z = self.factory_piezo
-        self.long_move_piezo('X', x)
-        time.sleep(0.01)
-        self.long_move_piezo('Y', y)
-        while z:
-            z_step = min(1000, z)
-            z -= z_step
-            time.sleep(0.01)
-            self.long_move_piezo('Z', z_step)
+        self.move_piezos(*self.factory_piezo)
+
+    def move_piezos(self, x=0, y=0, z=0, wait=True):
+        """ Moves the three piezos for the given durations, at the fixed speed of the firmware. Durations longer than
+        :attr:`MAX_MOVE` are split in several moves.
+
+        Firmware from version :attr:`MOVE_FIRMWARE` moves the three axes with a single ``MOVE:x,y,z`` command, older
+        firmware gets one ``PIEZO`` command per axis. In both cases the firmware answers once the motion is complete,
+        and the timeout of each query is computed from the duration of the motion instead of using a fixed sleep.
+
+        :param int x: duration in ms of the motion of the X axis, negative values move in the negative direction
+        :param int y: same for the Y axis
+        :param int z: same for the Z axis
+        :param bool wait: if False, returns a :class:`~concurrent.futures.Future` that is done when the motion is
+            complete, instead of blocking
+        """
+        if not all(isinstance(d, int) for d in (x, y, z)):
+            raise ValueError('Piezo durations must be integers (ms)')
+        if wait:
+            return self.commands.call(self._move_piezos, x, y, z)
+        return self.commands.submit(self._move_piezos, x, y, z)
+
+    def _move_piezos(self, x, y, z):
+        remaining = [x, y, z]
+        while any(remaining):
+            chunk = [max(-self.MAX_MOVE, min(self.MAX_MOVE, d)) for d in remaining]
+            remaining = [d - c for d, c in zip(remaining, chunk)]
+            if self.firmware_version >= self.MOVE_FIRMWARE:
+                # The axes are moved one after the other by the firmware
+                timeout = sum(abs(c) for c in chunk) + self.MOTION_TIMEOUT_MARGIN
+                self.timed_query('MOVE:{},{},{}'.format(*chunk), timeout)
+                continue
+            for axis, duration in zip(('X', 'Y', 'Z'), chunk):
+                if duration:
+                    self.timed_query(f'PIEZO:{axis}:{duration}', abs(duration) + self.MOTION_TIMEOUT_MARGIN)
 
     def long_move_piezo(self, axis, duration):
         """
@@ -94,55 +155,99 @@ class ArduinoNanoCET(ArduinoModel):
         A negative duration moves negative direction, positive duration moves in positive direction.
         The maximum duration is limited to 1800ms, (to account for the piezo driver limitation and the serial timeout)
         """
-        if axis not in ('X', 'Y', 'Z') or not isinstance(duration, int) or abs(duration) > 1800:
+        if axis not in ('X', 'Y', 'Z') or not isinstance(duration, int) or abs(duration) > self.MAX_MOVE:
             self.logger.warning('Invalid axis or value for long_move_piezo')
             return
-        with self.query_lock:
-            self.driver.query(f'PIEZO:{axis}:{duration}')
+        self.move_piezos(**{axis.lower(): duration})
+
+    @property
+    def led_state(self):
+        """ Last values of the (power, cartridge, sample, measuring) LEDs confirmed by the device, None for the ones
+        that are unknown.
+        """
+        return tuple(self._state_cache.get(led) for led in self.STATUS_LEDS)
 
     def state(self, name, state=(0, 0, 0, 0)):
+        """ Sets the four status LEDs to one of the predefined :attr:`led_states`, or to an arbitrary ``state`` if name
+        is ``'manual'``. Nothing is sent to the device if the LEDs are already in the requested state. That is checked
+        by the worker of the command queue when the command is sent, as a different state may still be waiting in it.
+
+        :param str name: name of the state, a key of :attr:`led_states` or ``'manual'``
+        :param state: tuple with the values of the (power, cartridge, sample, measuring) LEDs, used only in manual mode
+        """
         if name in self.led_states:
             state = self.led_states[name]
         elif not (name == 'manual' and type(state) in (list, tuple) and len(state)==4):
             self.logger.warning(f'Invalid state [{name}]')
             return
         self.last_state_set = name
-        self.power_led, self.cartridge_led, self.sample_led, self.measuring_led = state
+        state = tuple(state)
+        if self.firmware_version < self.STATE_FIRMWARE:
+            for led, value in zip(self.STATUS_LEDS, state):
+                setattr(self, led, value)  # unchanged LEDs are skipped by the cache when sent
+            return
+        self.commands.submit(self._send_state, state, key='state')
+
+    def _send_state(self, state):
+        command = 'STATE:{},{},{},{}'.format(*state)
+        with self.query_lock:
+            if state == self.led_state:
+                return
+            try:
+                self.driver.query(command)
+            except VisaIOError:
+                self.invalidate_cache()
+                raise
+            self._state_cache.update(zip(self.STATUS_LEDS, state))
+            # Only what the device confirmed is shown by the features
+            self._power_led, self._cartridge_led, self._sample_led, self._measuring_led = state
+            self.config.upgrade(dict(zip(self.STATUS_LEDS, state)), force=True)
+        self.logger.info(command)
+
+    def parse_firmware_version(self, idn):
+        """ Extracts the firmware version from the answer to ``IDN``, for example ``Dispertech nanoCET FW 1.0``.
+
+        :returns: tuple (major, minor), (0, 0) if the version can't be read
+        """
+        match = re.search(r'FW\s*(\d+)\.(\d+)', idn)
+        if match is None:
+            return 0, 0
+        return int(match.group(1)), int(match.group(2))
 
     @make_async_thread
     def initialize(self):
+        """ Runs :meth:`connect` on a separate thread. """
+        try:
+            self.connect()
+        finally:
+            self.initializing = False
+
+    def connect(self):
+        """ Opens the connection to the board, blocking until it is ready. Raises an exception if the board is not
+        found.
+        """
         with self.query_lock:
             if self.initialized:
                 return
             self.initializing = True
+            self.invalidate_cache()
+            # A failed attempt may have left a session borrowed, discovery would skip its port
+            self.detach()
             if self.port:
-                self.driver = rm.open_resource(self.port)
+                self.attach(resources.acquire(self.port))
                 self.driver.baud_rate = self.baud_rate
-            else:    
-                device_ports = rm.list_resources()
-                if len(device_ports) == 0:
+            else:
+                found = find_device(self.IDN_PREFIX, last_port=self.last_port, baud_rate=115200)
+                if found is None:
                     raise Exception('No devices detected')
-                for port in device_ports:
-                    try:
-                        self.driver = rm.open_resource(port, baud_rate=115200)
-                        time.sleep(1)
-                        self.driver.query('IDN')
-                        if self.driver.query('IDN').startswith('Dispertech nanoCET FW 1.0'):
-                            break
-                        # self.driver.close()
-                    except:
-                        try:
-                            self.driver.close()
-                        except:
-                            pass
-                try:
-                    self.driver.session
-                except pyvisa.errors.InvalidSession:
-                    raise
+                self.attach(found[0])
+                self.last_port = self.driver.resource_name
             # This is very silly, but clears the buffer so that next messages are not broken
             try:
-                self.driver.query("IDN")
+                self.firmware_version = self.parse_firmware_version(self.driver.query("IDN"))
+                self.logger.info(f'Firmware version {self.firmware_version}')
             except VisaIOError:
+                self.stats.record_resync()
                 try:
                     self.driver.read()
                 except VisaIOError:
@@ -150,6 +255,8 @@ class ArduinoNanoCET(ArduinoModel):
                     pass
             self.config.fetch_all()
             print(self.driver.query('INI'))
+            # INI resets the outputs of the board
+            self.invalidate_cache()
             if self.initial_config is not None:
                 self.config.update(self.initial_config)
                 self.config.apply_all()
@@ -170,33 +277,10 @@ class ArduinoNanoCET(ArduinoModel):
 
     @scattering_laser.setter
     def scattering_laser(self, power):
-        with self.query_lock:
-            power = int(power * 4095 / 100)
-            self.driver.query(f'LASER:{power}')
-            self.logger.info(f'LASER:{power}')
-            self._scattering_laser_power = int(power)
-
-    def move_piezo(self, speed, direction, axis):
-        """ Moves the mirror connected to the board
-
-        Parameters
-        ----------
-        speed : int
-            Speed, from 0 to 2^6-1
-        direction : int
-            0 or 1, depending on which direction to move the mirror
-        axis : int
-            1, 2, or 3 to select the axis. Normally 1 and 2 are the mirror and 3 is the lens
-        """
-        # with self.query_lock:
-        binary_speed = '{0:06b}'.format(speed)
-        binary_speed = str(direction) + str(1) + binary_speed
-        number = int(binary_speed, 2)
-        bytestring = number.to_bytes(1, 'big')
-        self.driver.query(f"mot{axis}")
-        self.driver.write_raw(bytestring)
-        self.driver.read()
-        self.logger.info('Finished moving')
+        power = int(power * 4095 / 100)
+        priority = CommandQueue.PRIORITY_SAFETY if power == 0 else CommandQueue.PRIORITY_NORMAL
+        self.send_setting('scattering_laser', power, f'LASER:{power}',
+                          priority=priority, attribute='_scattering_laser_power')
 
     @Feature()
     def top_led(self):
@@ -204,10 +288,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @top_led.setter
     def top_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:TOP:{status}')
-            self._top_led = status
-            self.logger.info(f'LED:TOP:{status}')
+        self.send_setting('top_led', status, f'LED:TOP:{status}', attribute='_top_led')
 
     @Feature()
     def fiber_led(self):
@@ -215,10 +296,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @fiber_led.setter
     def fiber_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:FIBER:{status}')
-            self._fiber_led = status
-            self.logger.info(f'LED:FIBER:{status}')
+        self.send_setting('fiber_led', status, f'LED:FIBER:{status}', attribute='_fiber_led')
 
     @Feature()
     def side_led(self):
@@ -226,10 +304,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @side_led.setter
     def side_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:SIDE:{status}')
-            self._side_led = status
-            self.logger.info(f'LED:SIDE:{status}')
+        self.send_setting('side_led', status, f'LED:SIDE:{status}', attribute='_side_led')
 
     @Feature()
     def power_led(self):
@@ -237,10 +312,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @power_led.setter
     def power_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:POWER:{status}')
-            self._power_led = status
-            self.logger.info(f'LED:POWER:{status}')
+        self.send_setting('power_led', status, f'LED:POWER:{status}', attribute='_power_led')
 
     @Feature()
     def cartridge_led(self):
@@ -248,10 +320,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @cartridge_led.setter
     def cartridge_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:CARTRIDGE:{status}')
-            self._cartridge_led = status
-            self.logger.info(f'LED:CARTRIDGE:{status}')
+        self.send_setting('cartridge_led', status, f'LED:CARTRIDGE:{status}', attribute='_cartridge_led')
 
     @Feature()
     def sample_led(self):
@@ -259,10 +328,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @sample_led.setter
     def sample_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:SAMPLE:{status}')
-            self._sample_led = status
-            self.logger.info(f'LED:SAMPLE:{status}')
+        self.send_setting('sample_led', status, f'LED:SAMPLE:{status}', attribute='_sample_led')
 
     @Feature()
     def measuring_led(self):
@@ -270,10 +336,7 @@ class ArduinoNanoCET(ArduinoModel):
 
     @measuring_led.setter
     def measuring_led(self, status):
-        with self.query_lock:
-            self.driver.query(f'LED:MEASURING:{status}')
-            self._measuring_led = status
-            self.logger.info(f'LED:MEASURING:{status}')
+        self.send_setting('measuring_led', status, f'LED:MEASURING:{status}', attribute='_measuring_led')
 
     @Feature()
     def lid(self):
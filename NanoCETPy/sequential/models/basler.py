@@ -1,6 +1,18 @@
 """
     Modified Basler model to acommodate peculiarities of NanoCET operation
+
+    Enumerating the pylon devices over USB3 and GigE is slow, therefore it is done once and shared by all the cameras
+    through :data:`device_registry`. The list is enumerated again only when a camera is not found in it, which covers
+    cameras plugged in after the first enumeration, or when it is explicitly refreshed.
+
+    Every frame stored in ``temp_image`` gets a new :attr:`BaslerNanoCET.frame_id`, so the viewers can tell whether
+    there is a new image to display without comparing the images themselves, and is published to
+    :attr:`BaslerNanoCET.feed`. Once the camera is initialized, the feed also copies every frame to a shared-memory
+    :class:`~NanoCETPy.dispertech.models.frame_mailbox.FrameMailbox`: :meth:`BaslerNanoCET.latest_frame` reads a
+    consistent copy of the latest frame from it, and other processes can attach to it by its name.
 """
+import threading
+import time
 
 from pypylon import pylon
 
@@ -8,6 +20,61 @@ from experimentor.lib.log import get_logger
 from experimentor.models import Feature
 from experimentor.models.devices.cameras.basler.basler import BaslerCamera
 from experimentor.models.devices.cameras.exceptions import CameraNotFound
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
+from NanoCETPy.dispertech.models.frame_mailbox import FrameMailbox
+
+
+class DeviceRegistry:
+    """ Cached list of the pylon devices, looked up by serial number or friendly name.
+
+    :param float min_interval: minimum time in seconds between two enumerations triggered by a failed lookup, so a
+        missing camera does not cause an enumeration on every retry
+    """
+    def __init__(self, min_interval=1.):
+        self.min_interval = min_interval
+        self.logger = get_logger(__name__)
+        self._lock = threading.Lock()
+        self._devices = None
+        self._by_serial = {}
+        self._last_enumeration = 0
+
+    def refresh(self):
+        """ Enumerates the devices again. """
+        with self._lock:
+            self._enumerate()
+
+    def _enumerate(self):
+        t0 = time.monotonic()
+        self._devices = list(pylon.TlFactory.GetInstance().EnumerateDevices())
+        self._by_serial = {device.GetSerialNumber(): device for device in self._devices}
+        self._last_enumeration = time.monotonic()
+        self.logger.info(f'Enumerated {len(self._devices)} pylon devices in {self._last_enumeration - t0:.2f}s')
+
+    def _lookup(self, camera):
+        if camera in self._by_serial:
+            return self._by_serial[camera]
+        for device in self._devices:
+            if camera in device.GetFriendlyName():
+                return device
+        return None
+
+    def find(self, camera):
+        """ Finds a device, enumerating the devices if they were not yet or if the camera is not among them.
+
+        :param str camera: serial number, or part of the friendly name, of the camera
+        :returns: the pylon device info, or None if no device matches
+        """
+        with self._lock:
+            if self._devices is None:
+                self._enumerate()
+            device = self._lookup(camera)
+            if device is None and time.monotonic() - self._last_enumeration > self.min_interval:
+                self._enumerate()
+                device = self._lookup(camera)
+            return device
+
+
+device_registry = DeviceRegistry()
 
 
 class BaslerNanoCET(BaslerCamera):
@@ -17,8 +84,11 @@ class BaslerNanoCET(BaslerCamera):
     triggering the device initialization methods, this :meth:`initialize` only completes if a device is found,
     otherwise it raises an error.
     '''
+    frame_id = 0  # Incremented every time a new frame is stored in temp_image
+    _temp_image = None
 
     def __init__(self, camera, initial_config=None):
+        self.feed = FrameFeed()  # Before the base class stores the first temp_image
         super().__init__(camera, initial_config=initial_config)
         self.logger = get_logger(__name__)
         self.initialized = False
@@ -26,36 +96,71 @@ class BaslerNanoCET(BaslerCamera):
     #@Action
     def initialize(self):
         self.logger.debug('Initializing Basler Camera')
-        tl_factory = pylon.TlFactory.GetInstance()
-        devices = tl_factory.EnumerateDevices()
-        if len(devices) == 0:
-            msg = f'Basler {self.camera} not found. Please check if the camera is connected'
-            self.logger.error(msg)
-            raise CameraNotFound('No camera found')
-
-        for device in devices:
-            if self.camera in device.GetFriendlyName():
-                self._driver = pylon.InstantCamera()
-                self._driver.Attach(tl_factory.CreateDevice(device))
-                self._driver.Open()
-                self.friendly_name = device.GetFriendlyName()
-
-        if not self._driver:
+        device = device_registry.find(self.camera)
+        if device is None:
             msg = f'Basler {self.camera} not found. Please check if the camera is connected'
             self.logger.error(msg)
             raise CameraNotFound(msg)
 
+        try:
+            self._driver = pylon.InstantCamera()
+            self._driver.Attach(pylon.TlFactory.GetInstance().CreateDevice(device))
+            self._driver.Open()
+        except Exception:
+            # The cached device may be gone, e.g. the camera was unplugged
+            self._driver = None
+            device_registry.refresh()
+            raise
+        self.friendly_name = device.GetFriendlyName()
+
         self.logger.info(f'Loaded camera {self._driver.GetDeviceInfo().GetModelName()}')
 
         # self._driver.RegisterConfiguration(pylon.SoftwareTriggerConfiguration(), pylon.RegistrationMode_ReplaceAll,
         #                                    pylon.Cleanup_Delete)
 
+        if self.feed.mailbox is None:
+            # Large enough for a full frame of the sensor with up to 16 bits per pixel
+            capacity = self._driver.WidthMax.Value * self._driver.HeightMax.Value * 2
+            self.feed.mailbox = FrameMailbox(capacity)
+            self.logger.info(f'Latest frames of {self.camera} shared as {self.feed.mailbox.name}')
+
         self.config.fetch_all()
         if self.initial_config is not None:
             self.config.update(self.initial_config)
             self.config.apply_all()
         self.initialized = True
 
+    @property
+    def temp_image(self):
+        """ Latest frame read from the camera. """
+        return self._temp_image
+
+    @temp_image.setter
+    def temp_image(self, image):
+        self._temp_image = image
+        self.frame_id += 1
+        if image is not None:
+            self.feed.publish(image, self.frame_id)
+
+    def latest_frame(self, out=None):
+        """ Copy of the latest frame, that the continuous reads can not modify or replace while it is being used.
+
+        :param out: array where to copy the frame, reused if it has the shape and type of the frame
+        :returns: tuple (frame id, timestamp, image), the image is None if there is no frame yet
+        """
+        if self.feed.mailbox is not None:
+            frame_id, timestamp, image = self.feed.mailbox.read(out)
+            if image is not None:
+                return frame_id, timestamp, image
+        frame_id, image, timestamp = self.feed.latest()
+        return frame_id, timestamp, None if image is None else image.copy()
+
+    def finalize(self):
+        super().finalize()
+        if self.feed.mailbox is not None:
+            mailbox, self.feed.mailbox = self.feed.mailbox, None
+            mailbox.close()
+
     def clear_ROI(self):
         self._driver.OffsetX.SetValue(0)
         self._driver.OffsetY.SetValue(0)
@@ -111,6 +216,24 @@ class BaslerNanoCET(BaslerCamera):
         self.Y = (y_off, height)
         self.logger.info(f'ROI updated to {(self.X, self.Y)}')
 
+    def shift_ROI(self, shift):
+        """ Moves the ROI along the vertical axis without changing its size. Contrary to setting the :attr:`ROI`, the
+        offset can be changed while the camera is grabbing, so this can be used to follow a drifting sample.
+
+        :param shift: requested shift in pixels, it is rounded to the offset increment and limited to the sensor
+        :returns: the shift that was actually applied
+        """
+        offset = self._driver.OffsetY.Value
+        increment = self._driver.OffsetY.Inc
+        max_offset = self._driver.HeightMax.Value - self._driver.Height.Value
+        new_offset = int(round((offset + shift) / increment) * increment)
+        new_offset = min(max(new_offset, 0), max_offset - max_offset % increment)
+        if new_offset != offset:
+            self._driver.OffsetY.SetValue(new_offset)
+            self.Y = (new_offset, self._driver.Height.Value)
+            self.logger.info(f'ROI vertical offset moved to {new_offset}')
+        return new_offset - offset
+
     # @Feature()
     # def ROI(self):
     #     """
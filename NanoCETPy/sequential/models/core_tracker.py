@@ -0,0 +1,56 @@
+"""
+    Tracking of the fiber core position while measuring.
+
+    After :py:meth:`~NanoCETPy.sequential.models.experiment.MainSetup.find_ROI` the ROI of the microscope camera is
+    centered on the core, but thermal drift slowly moves the core within the crop during long measurements. The
+    :class:`CoreTracker` estimates the position of the core from the frames that are already being acquired, using only
+    a projection and a closed-form profile fit every few frames, so it can run inside the waterfall loop without
+    affecting acquisition.
+"""
+import numpy as np
+
+from . import model_utils as ut
+
+
+class CoreTracker:
+    """ Estimates the drift of the fiber core with respect to the center of the ROI.
+
+    :param float reference: position of the core across the ROI (axis 1 of the frames) right after finding the ROI
+    :param int interval: number of updates between two estimates of the core position
+    :param float threshold: drift, in pixels, above which :meth:`update` reports it
+    :param float smoothing: weight of a new estimate in the running average of the core position (between 0 and 1)
+    :param float min_confidence: estimates from fits with a lower confidence are discarded
+    """
+    def __init__(self, reference, interval=20, threshold=3, smoothing=0.5, min_confidence=0.3):
+        self.reference = reference
+        self.interval = interval
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.min_confidence = min_confidence
+        self.position = reference
+        self.updates = 0
+
+    @property
+    def drift(self):
+        return self.position - self.reference
+
+    def update(self, image):
+        """ Feeds a new frame to the tracker. Only every ``interval`` calls the frame is actually analysed.
+
+        :param image: frame of the microscope camera, with the core along axis 0
+        :returns: the current drift in pixels if it exceeds the threshold, None otherwise
+        """
+        self.updates += 1
+        if self.updates % self.interval:
+            return None
+        centers, widths, confidence = ut.fit_gaussian_profiles(np.mean(image, axis=0))
+        if not np.isfinite(centers[0]) or confidence[0] < self.min_confidence:
+            return None
+        self.position = (1 - self.smoothing) * self.position + self.smoothing * centers[0]
+        if abs(self.drift) >= self.threshold:
+            return self.drift
+        return None
+
+    def shifted(self, shift):
+        """ To be called after the ROI was moved by ``shift`` pixels, so the estimate follows the new frames. """
+        self.position -= shift
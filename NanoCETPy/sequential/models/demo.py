@@ -7,6 +7,8 @@ from skimage import io
 
 from experimentor.models.action import Action
 from experimentor.models.experiments import Experiment
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
+from .waterfall import WaterfallBuffer
 
 BASE_DIR_VIEW = os.path.dirname(os.path.abspath(__file__))
 
@@ -23,9 +25,15 @@ class DemoExperiment(Experiment):
         self.aligned = True
         self.active = True
         self.saving = False
+        self.current_file = None  # File shown by the measurement screen, nothing is written in the demo
         self.microscope_image = io.imread(os.path.join(BASE_DIR_VIEW, 'mic_demo.png'), as_gray=True)
         self.waterfall_image = io.imread(os.path.join(BASE_DIR_VIEW, 'wat_demo.png'), as_gray=True)
         self.logger.info(f'SHAPES {self.microscope_image.shape}, {self.waterfall_image.shape}')
+        self.camera_microscope.feed.publish(self.microscope_image.T)
+        self.waterfall_feed = FrameFeed()
+        self.waterfall = WaterfallBuffer.from_image(self.waterfall_image.T)
+        self.waterfall_feed.publish(self.waterfall, self.waterfall.count)
+        self.waterfall_image_limits = [self.waterfall_image.min(), self.waterfall_image.max()]
         pass
 
     def toggle_active(self):
@@ -42,9 +50,19 @@ class DemoExperiment(Experiment):
     def get_latest_image(self):
         return self.microscope_image.T
 
+    @property
+    def microscope_feed(self):
+        return self.camera_microscope.feed
+
+    def get_latest_frame(self):
+        return 0, self.get_latest_image()
+
     def get_waterfall_image(self):
         return self.waterfall_image.T
 
+    def get_waterfall_frame(self):
+        return 0, self.get_waterfall_image()
+
     def focus_stop(self):
         pass
 
@@ -65,7 +83,10 @@ class DemoExperiment(Experiment):
     
     @Action
     def save_waterfall(self):
+        self.current_file = os.path.join(self.config['info']['files']['folder'], 'demo_measurement.h5')
         self.saving=True
+        if getattr(self, 'parent', None) is not None:
+            self.parent.saving_file.emit(self.current_file)
         while self.active:
             time.sleep(.1)
         self.saving=False
@@ -90,6 +111,7 @@ class DemoCam:
         self.camera = 'DemoCam'
         self.ROI = ((0,1000),(0,1000))
         self.config = {'exposure': 10, 'gain': 0}
+        self.feed = FrameFeed()
 
 class DemoElectronics:
     def __init__(self):
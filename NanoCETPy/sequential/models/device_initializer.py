@@ -0,0 +1,94 @@
+"""
+    Concurrent initialization of the devices of the setup.
+
+    Each device is initialized on its own thread. A failed attempt is retried after a delay that doubles every time (up
+    to a maximum), until the device is ready or its timeout expires. Progress is reported through a callback, which
+    :py:meth:`~NanoCETPy.sequential.models.experiment.MainSetup.initialize` connects to a Qt signal of the main window,
+    so the GUI does not need to poll the devices.
+"""
+import threading
+import time
+
+from experimentor.lib.log import get_logger
+
+
+class DeviceInitializer:
+    """ Initializes devices concurrently, with retries and a timeout per device.
+
+    :param callback: called as ``callback(name, status)`` every time the status of a device changes, status is one of
+        :attr:`WAITING`, :attr:`INITIALIZING`, :attr:`RETRYING`, :attr:`INITIALIZED` or :attr:`FAILED`
+    :param float first_delay: seconds to wait before the first retry
+    :param float max_delay: maximum seconds between retries
+    """
+    WAITING = 'waiting'
+    INITIALIZING = 'initializing'
+    RETRYING = 'retrying'
+    INITIALIZED = 'initialized'
+    FAILED = 'failed'
+
+    def __init__(self, callback=None, first_delay=0.2, max_delay=2.):
+        self.callback = callback
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.logger = get_logger(__name__)
+        self.devices = {}
+        self.status = {}
+        self._stop = threading.Event()
+
+    def add(self, name, initialize, timeout=30):
+        """ Registers a device.
+
+        :param str name: name used to report the progress
+        :param initialize: callable that initializes the device, blocking until it is ready and raising an exception
+            if it fails
+        :param float timeout: seconds after which the device is considered not available
+        """
+        self.devices[name] = (initialize, timeout)
+        self._report(name, self.WAITING)
+
+    def run(self):
+        """ Initializes all the registered devices and waits for them.
+
+        :returns: True if all the devices were initialized
+        """
+        threads = [threading.Thread(target=self._initialize, args=(name, ), name=f'initialize_{name}', daemon=True)
+                   for name in self.devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return all(status == self.INITIALIZED for status in self.status.values())
+
+    def stop(self):
+        """ Stops retrying, devices not initialized yet are reported as failed. """
+        self._stop.set()
+
+    def _report(self, name, status):
+        self.status[name] = status
+        if self.callback is not None:
+            self.callback(name, status)
+
+    def _initialize(self, name):
+        initialize, timeout = self.devices[name]
+        t0 = time.monotonic()
+        delay = self.first_delay
+        attempt = 0
+        while not self._stop.is_set():
+            attempt += 1
+            self._report(name, self.INITIALIZING)
+            try:
+                initialize()
+            except Exception:
+                self.logger.info(f'Init exception {name} (attempt {attempt}):', exc_info=True)
+            else:
+                self.logger.info(f'{name} initialized in {time.monotonic() - t0:.2f}s')
+                self._report(name, self.INITIALIZED)
+                return
+            remaining = t0 + timeout - time.monotonic()
+            if remaining <= 0:
+                break
+            self._report(name, self.RETRYING)
+            self._stop.wait(min(delay, remaining))
+            delay = min(2 * delay, self.max_delay)
+        self.logger.error(f'{name} could not be initialized')
+        self._report(name, self.FAILED)
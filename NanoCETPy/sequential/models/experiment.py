@@ -14,21 +14,25 @@ USE_TEST_DATA = False
 import os
 import time
 from datetime import datetime
-from multiprocessing import Event
+from multiprocessing import Event, Queue
 
 import numpy as np
 import yaml
-from scipy import optimize
-from skimage import data
 
 from experimentor import Q_
 from experimentor.models.action import Action
 from experimentor.models.decorators import make_async_thread
 from experimentor.models.experiments import Experiment
+from NanoCETPy.dispertech.models.file_naming import FileNamer
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
 from . import model_utils as ut
+from .alignment_pipeline import AlignmentPipeline
 from .arduino import ArduinoNanoCET
 from .basler import BaslerNanoCET as Camera
+from .core_tracker import CoreTracker
+from .device_initializer import DeviceInitializer
 from .movie_saver import WaterfallSaver
+from .waterfall import WaterfallBuffer
 
 
 class MainSetup(Experiment):
@@ -56,20 +60,37 @@ class MainSetup(Experiment):
         self.saving_event = Event()
         self.saving = False
         self.saving_process = None
+        self.roi_events = None
+        self.file_namer = FileNamer()
+        self.current_file = None  # File where the last measurement was saved
+        self.alignment_trace = None
+        self.device_initializer = None
         self.aligned = False
         
-        self.demo_image = data.colorwheel()
-        self.waterfall_image = np.array([[0,2**12-1],[0,2**8-1]])
-        self.waterfall_image = np.zeros((2,2))
+        self._demo_image = None
+        self.waterfall = WaterfallBuffer(2, 2)
         self.waterfall_image_limits = [0, 1]
-        self.display_image = self.demo_image
+        self.waterfall_feed = FrameFeed()  # Publishes the waterfall buffer every time a line is added
         self.active = True
         self.now = None
 
+    @property
+    def demo_image(self):
+        """ Placeholder image, loaded on first use because importing skimage is slow. """
+        if self._demo_image is None:
+            from skimage import data
+            self._demo_image = data.colorwheel()
+        return self._demo_image
+
+    @property
+    def display_image(self):
+        return self.demo_image
+
     @Action
     def initialize(self):
         """ Initializes the cameras and Arduino objects. 
-        Runs in a loop until every device is connected and initialized.
+        Each device is retried until it is initialized or the devices_loading_timeout expires, see
+        :class:`~NanoCETPy.sequential.models.device_initializer.DeviceInitializer`.
 
         :return: None
         """
@@ -89,35 +110,18 @@ class MainSetup(Experiment):
             devices_loading_timeout = 30
             self.logger.info(f'default/devices_loading_timeout parameter not found in config: using {devices_loading_timeout}s')
 
-        #Loop over instances until all are initialized
-        t0 = time.time()
-        loading_timed_out = False
-        while self.active and not loading_timed_out:
-            #self.logger.info('TEST init loop')
-            initialized = [self.camera_fiber.initialized, self.camera_microscope.initialized, self.electronics.initialized]
-            if all(initialized): return
-            if not initialized[0]: 
-                try:
-                    self.camera_fiber.initialize()
-                except:
-                    self.logger.info('Init Exception camera_fiber:', exc_info=True)
-            if not initialized[1]: 
-                try:
-                    self.camera_microscope.initialize()
-                except:
-                    self.logger.info('Init Exception camera_microscope:', exc_info=True)
-            if not initialized[2]:
-                try:
-                    if not self.electronics.initializing: self.electronics.initialize()
-                except:
-                    self.electronics.initializing = False 
-                    self.logger.info('Init Exception electronics:', exc_info=True)
-            loading_timed_out = time.time() > t0 + devices_loading_timeout
-        if loading_timed_out:
-            self.logger.error('Loading devices timed out')
-            self.parent.init_failed.emit()
+        # Every device is initialized on its own thread, and the progress is reported to the startup screen
+        self.device_initializer = DeviceInitializer(callback=self.parent.device_status.emit)
+        self.device_initializer.add('camera_fiber', self.camera_fiber.initialize, devices_loading_timeout)
+        self.device_initializer.add('camera_microscope', self.camera_microscope.initialize, devices_loading_timeout)
+        self.device_initializer.add('electronics', self.electronics.connect, devices_loading_timeout)
+        if not self.device_initializer.run():
+            if self.active:
+                self.logger.error('Loading devices timed out')
+                self.parent.init_failed.emit()
             return
-        self.logger.info('TEST init loop exit')
+        # Stored in config_user.yml when finalizing, so the next start tries this port first
+        self.config['electronics']['arduino']['last_port'] = self.electronics.last_port
 
 
     def focus_start(self):
@@ -137,7 +141,7 @@ class MainSetup(Experiment):
     def focus_stop(self):
         self.set_live(self.camera_microscope, False)
         self.electronics.top_led = 0
-        self.img_focus_microscope = self.camera_microscope.temp_image.copy()
+        _, _, self.img_focus_microscope = self.camera_microscope.latest_frame()
     
     @make_async_thread
     def start_alignment(self):
@@ -150,71 +154,67 @@ class MainSetup(Experiment):
         self.active = True
         self.now = datetime.now()
         self.saving_images = True
-
-        if False: # TESTING
-            time.sleep(5)
-            self.aligned = True
-            self.toggle_live(self.camera_microscope)
+        alignment_config = self.config['defaults'].get('alignment') or {}
+        settle_times = dict(AlignmentPipeline.SETTLE_TIMES)
+        configured = alignment_config.get('settle_time') or {}
+        if not isinstance(configured, dict):  # A single value for all the routines
+            configured = {routine: configured for routine in settle_times}
+        settle_times.update({routine: Q_(value).m_as('s') for routine, value in configured.items()})
+        self.alignment_pipeline = AlignmentPipeline(self.electronics, settle_times=settle_times)
+        self.alignment_trace = self.alignment_pipeline.trace
+        trace = self.alignment_trace
+
+        # The worker thread of the pipeline is stopped even if a step fails or the alignment is aborted
+        try:
+            # Set camera mode
+            self.set_live(self.camera_fiber, False)
+            self.set_live(self.camera_microscope, False)
+            self.camera_fiber.acquisition_mode = self.camera_fiber.MODE_SINGLE_SHOT
+            self.camera_microscope.acquisition_mode = self.camera_microscope.MODE_SINGLE_SHOT
+            # Set exposure and gain
+            self.update_camera(self.camera_fiber, self.config['defaults']['laser_focusing']['low'])
+            # Turn on Laser
+            self.electronics.fiber_led = 0
+            self.electronics.top_led = 0
+            self.electronics.side_led = 0
+            laser_focussing_power = self.config['defaults']['laser_focusing'].get('laser_power', 3)  # Get power for laser focussing from config, use 3 if it's not present
+            img = self.set_laser_power(laser_focussing_power)
+            # Find focus function
+            with trace.section('find_focus'):
+                self.find_focus()
+            self.logger.info('TEST focus done')
+            # Turn off laser
+            self.set_laser_power(0)
+            # Turn on fiber LED
+            self.electronics.fiber_led = 1
+            # Set exposure and gain
+            self.update_camera(self.camera_fiber, self.config['defaults']['laser_focusing']['high'])
+
+            # Find center
+            with trace.section('fiber_center'):
+                # The fiber center is computed on the worker thread while the fiber camera is reconfigured for the laser
+                fiber_center = self.alignment_pipeline.measure(self.camera_fiber, ut.fiber_center)
+                # Turn off LED
+                self.electronics.fiber_led = 0
+                # Set exposure and gain
+                self.update_camera(self.camera_fiber, self.config['defaults']['laser_focusing']['low'])
+
+                # Turn on Laser
+                self.set_laser_power(laser_focussing_power)
+                self.img_fiber_facet, fiber_center = fiber_center.result()
+            self.logger.info(f'TEST fiber center is {fiber_center}')
+            time.sleep(.05)
+            # Find alignment function
+            with trace.section('align_laser_coarse'):
+                self.align_laser_coarse(fiber_center)
             self.set_laser_power(99)
+            time.sleep(.05)
             self.update_camera(self.camera_microscope, self.config['defaults']['microscope_focusing']['high'])
-            return
-
-        # Set camera mode
-        self.set_live(self.camera_fiber, False)
-        self.set_live(self.camera_microscope, False)
-        self.camera_fiber.acquisition_mode = self.camera_fiber.MODE_SINGLE_SHOT
-        self.camera_microscope.acquisition_mode = self.camera_microscope.MODE_SINGLE_SHOT
-        # Set exposure and gain
-        self.update_camera(self.camera_fiber, self.config['defaults']['laser_focusing']['low'])
-        # Turn on Laser
-        self.electronics.fiber_led = 0
-        self.electronics.top_led = 0
-        self.electronics.side_led = 0
-        laser_focussing_power = self.config['defaults']['laser_focusing'].get('laser_power', 3)  # Get power for laser focussing from config, use 3 if it's not present
-        img = self.set_laser_power(laser_focussing_power)
-        # Find focus function
-        self.find_focus()
-        self.logger.info('TEST focus done')
-        # Turn off laser
-        self.set_laser_power(0)
-        # Turn on fiber LED
-        self.electronics.fiber_led = 1
-        # Set exposure and gain
-        self.update_camera(self.camera_fiber, self.config['defaults']['laser_focusing']['high'])
-
-        # Find center
-        self.camera_fiber.trigger_camera()
-        self.img_fiber_facet = self.camera_fiber.read_camera()[-1]
-        img = self.img_fiber_facet
-        #fiber = ut.image_convolution(img, kernel = np.ones((3,3)))
-        #mask = ut.gaussian2d_array((int(fiber.shape[0]/2),int(fiber.shape[1]/2)),20000,fiber.shape)
-        #fibermask = fiber * mask
-        ksize = 15
-        kernel = ut.circle2d_array((int(ksize/2), int(ksize/2)), 5, (ksize,ksize)) * 5.01
-        kernel = (kernel - np.mean(kernel)) / np.std(kernel)
-
-        fiber = (img - np.mean(img)) / np.std(img)
-        fibermask = ut.image_convolution(fiber, kernel=kernel)
-
-        fiber_center = np.argwhere(fibermask==np.max(fibermask))[0]
-        # print(fiber_center, [389, 595])
-
-        self.logger.info(f'TEST fiber center is {fiber_center}')
-        # Turn off LED
-        self.electronics.fiber_led = 0
-        # Set exposure and gain
-        self.update_camera(self.camera_fiber, self.config['defaults']['laser_focusing']['low'])
-
-        # Turn on Laser
-        self.set_laser_power(laser_focussing_power)
-        time.sleep(.05)
-        # Find alignment function
-        self.align_laser_coarse(fiber_center)
-        self.set_laser_power(99)
-        time.sleep(.05)
-        self.update_camera(self.camera_microscope, self.config['defaults']['microscope_focusing']['high'])
-        time.sleep(1)
-        self.align_laser_fine()
+            time.sleep(1)
+            with trace.section('align_laser_fine'):
+                self.align_laser_fine()
+        finally:
+            self.alignment_pipeline.close()
         self.set_live(self.camera_microscope, True)
         self.aligned = True
 
@@ -278,7 +278,7 @@ class MainSetup(Experiment):
             dark = int((bright - dark) * 0.1 + dark)  # the 10% value between "bright" and the min value: i.e. 9%
             fom = (img < dark).sum() - (img > bright).sum()
             fom2 = ((img < dark).sum() - (img > bright).sum()) * mx
-            print(dark, bright, fom, fom2)
+            self.logger.debug(f'Focus merit: dark {dark}, bright {bright}, fom {fom}, fom2 {fom2}')
             return fom2
 
         current = focus_merit(img)
@@ -287,11 +287,8 @@ class MainSetup(Experiment):
         while self.active:
             previous = current
             self.logger.info(f'TEST moving with speed {speed} in direction {direction}')
-            self.electronics.move_piezo(speed, direction, self.config['electronics']['focus_axis'])
-            time.sleep(.05)
-            self.camera_fiber.trigger_camera()
-            img = self.camera_fiber.read_camera()[-1]
-            current = focus_merit(img)
+            img, current = self.alignment_pipeline.step(
+                speed, direction, self.config['electronics']['focus_axis'], self.camera_fiber, focus_merit).result()
             if current < previous:
                 if not speeds:
                     break
@@ -325,18 +322,24 @@ class MainSetup(Experiment):
             self.camera_fiber.trigger_camera()
             img = self.camera_fiber.read_camera()[-1]
 
+        # Half size of the window around the fiber center in which the laser spot is searched (it covers the same
+        # area as the gaussian mask used before)
+        spot_window = 125
+        def locate_spot(frame):
+            return ut.spot_position(frame, center=fiber_center, half_width=spot_window, saturation=255, refine=True)
+
+        def distance(lc):
+            return np.hypot(*(np.asarray(lc) - fiber_center))
+
         axis = self.config['electronics']['horizontal_axis']
         for idx, c in enumerate(fiber_center):
             self.logger.info(f'TEST start aligning axis {axis} at index {idx}')
             direction = 0
             speed = 5
-            self.camera_fiber.trigger_camera()
-            img = self.camera_fiber.read_camera()[-1]
-            mask = ut.gaussian2d_array(fiber_center, 19000, img.shape)
-            mask = mask > 0.66*np.max(mask)
-            img = img * mask
-            img = 1*(img > 0.8*np.max(img))
-            lc = ut.centroid(img)
+            img, lc = self.alignment_pipeline.measure(self.camera_fiber, locate_spot, merit=distance).result()
+            if not np.all(np.isfinite(lc)):
+                self.logger.warning('Laser spot not found around the fiber center')
+                break
             val_new = lc[idx]-c
             while self.active:
                 val_old = val_new
@@ -345,13 +348,11 @@ class MainSetup(Experiment):
                 elif val_new < 0:
                     direction = 1
                 self.logger.info(f'TEST moving with speed {speed} in direction {direction}')
-                self.electronics.move_piezo(speed, direction,axis)
-                time.sleep(.1)
-                self.camera_fiber.trigger_camera()
-                img = self.camera_fiber.read_camera()[-1]
-                img = img * mask
-                img = 1*(img > 0.8*np.max(img))
-                lc = ut.centroid(img)
+                img, lc = self.alignment_pipeline.step(
+                    speed, direction, axis, self.camera_fiber, locate_spot, merit=distance).result()
+                if not np.all(np.isfinite(lc)):
+                    self.logger.warning('Lost the laser spot while aligning')
+                    break
                 val_new = lc[idx]-c
                 self.logger.info(f'TEST last distances are {val_old}, {val_new} to centroid at {lc}')
                 if np.sign(val_old) != np.sign(val_new): 
@@ -412,14 +413,12 @@ class MainSetup(Experiment):
         maximum encountered on a previous sweep.
 
         """
-        def figure_of_merit():
-            self.camera_microscope.trigger_camera()
-            time.sleep(0.1)  # For debugging
-            img = self.camera_microscope.read_camera()[-1]
+        def merit(img):
             median = np.median(img, axis=0)
-            figure = np.max(median)/np.min(median)
-            # self.logger.info(f'Figure of merit: {figure}')
-            return img, figure
+            return np.max(median)/np.min(median)
+
+        def figure_of_merit():
+            return self.alignment_pipeline.measure(self.camera_microscope, merit).result()
 
         if SKIP_ALIGNING:
             self.img_align_laser_fine, _ = figure_of_merit()
@@ -432,13 +431,13 @@ class MainSetup(Experiment):
         for iteration in range(N):
             for axis in [0, 1]:
                 for i, direction in enumerate([0, 1, 0, 1]):
-                    print(step)
+                    self.logger.debug(f'Fine alignment axis {axis}, direction {direction}, last sweep took {step} steps')
                     highest_values.append(current)
                     passed_optimum = False
                     for step in range(6 + 4*direction):  # put some kind of limit on the number of steps, just in case
                         previous = current
-                        self.electronics.move_piezo(1, direction, axis)
-                        img, current = figure_of_merit()
+                        img, current = self.alignment_pipeline.step(
+                            1, direction, axis, self.camera_microscope, merit).result()
                         highest_values[-1] = max(highest_values[-1], current)
                         # On the last sweep in "positive" direction, exit loop also if figure of merit reaches 99% of the maximum
                         # found so far. (This is to reduce the chance of stepping over the optimum)
@@ -451,7 +450,7 @@ class MainSetup(Experiment):
                             break
         img, current = figure_of_merit()
         highest_values.append(current)
-        print(highest_values)
+        self.logger.debug(f'Highest figures of merit of each sweep: {highest_values}')
         self.img_align_laser_fine = img
 
 
@@ -461,7 +460,7 @@ class MainSetup(Experiment):
         """
         self.update_camera(self.camera_microscope, self.config['defaults']['microscope_focusing']['high'])
         self.set_laser_power(99)
-        img = self.camera_microscope.temp_image
+        _, _, img = self.camera_microscope.latest_frame()
         self.img_microscope_before_final_alignment = img
         self.set_live(self.camera_microscope, False)
         while self.camera_microscope.continuous_reads_running:
@@ -492,32 +491,13 @@ class MainSetup(Experiment):
         # Another approach, would be to fit on multiple sections,
         # and then take the median of the fitting results:
         # (the objective is to discard sections that don't contribute to a proper fit due to dust/air)
-        fitted_centers = []
-        sections = 9  # recommend an odd number
-        for i in range(sections):
-            section = img[int(round(img.shape[0]/sections*i)):int(round(img.shape[0]/sections*(i+1))), :]
-            measure = section.mean(axis=0)
-            argmax_measure = np.argwhere(measure == np.max(measure))[0][0]
-            argmax_measure = (argmax_measure + measure.shape[0]/2)/2  # bias it towards the center
-            cx = int(measure.shape[0] / 2)
-            measure = measure / np.max(measure)
-            xvals = np.linspace(0,1,measure.shape[0]) - 0.5
-            gaussian1d = lambda x, mean, var, A, bg: A * np.exp(-(x-mean)**2 / (2 *var)) + bg
-            popt, pcov = optimize.curve_fit(
-                gaussian1d,
-                xvals,
-                measure,
-                p0=[argmax_measure/measure.shape[0] - 0.5, 0.1, np.max(measure)-np.min(measure), np.min(measure)],
-                bounds=([-0.5, 0, 0, 0],[0.5, 1, 1,1]))
-            # self.logger.info(f'TEST {popt}')
-            cx += int(popt[0] * measure.shape[0])
-            # width = 2 * int(2 * np.sqrt(popt[1] * measure.shape[0]))
-            fitted_centers.append(cx)
-
-        # self.logger.info(f'ROI optimized with width {width}')
-        self.logger.info(f'Fitted centers: {fitted_centers}')
-        cx = np.median(fitted_centers)
-        self.logger.info(f'Median fit of center: {cx}')
+        # All sections are fitted at once, see model_utils.find_core
+        cx, core_sigma, confidence = ut.find_core(img, sections=9, refine=True)
+        self.logger.info(f'Fitted core center: {cx:.1f}, width: {core_sigma:.1f}, confidence: {confidence:.2f}')
+        if not np.isfinite(cx):
+            self.logger.warning('Could not find the fiber core, keeping the current ROI')
+            self.set_live(self.camera_microscope, True)
+            return
         width = self.config['defaults']['core_width']
         current_roi = self.camera_microscope.ROI
         new_y_offset = current_roi[1][0]+cx-width
@@ -537,7 +517,7 @@ class MainSetup(Experiment):
         """Assuming a set ROI, this function calculates a waterfall slice per image frame and sends it to a MovieSaver instance
         """
         self.start_saving_images()
-        img = self.camera_microscope.temp_image
+        _, _, img = self.camera_microscope.latest_frame()
 
         smooth = lambda line: line[1:-1:2] * 2 + line[:-2:2] + line[2::2]
 
@@ -552,7 +532,7 @@ class MainSetup(Experiment):
             img = f['data']['timelapse'][:, :3]
 
         # img.shape[0]
-        self.waterfall_image = np.zeros((len(smooth(img[:, 1])), self.config['GUI']['length_waterfall']))#, dtype=np.int32)
+        self.waterfall = WaterfallBuffer(len(smooth(img[:, 1])), self.config['GUI']['length_waterfall'])
         # median = np.zeros((img.shape[0],))
         N_median = 10
         buffer = np.tile(img[:, [0]], (1, N_median))
@@ -563,10 +543,20 @@ class MainSetup(Experiment):
         # self.reset_waterfall()
         refresh_time_s = self.config['GUI']['refresh_time'] / 1000
 
+        tracking = self.config['defaults'].get('roi_tracking') or {}
+        tracker = None
+        if tracking.get('enabled', False) and not USE_TEST_DATA:
+            tracker = CoreTracker(img.shape[1] / 2, interval=tracking.get('interval', 20),
+                                  threshold=tracking.get('threshold', 3))
 
         while self.active:
-            img = self.camera_microscope.temp_image
+            # Reuses the array of the previous frame, the frames are copied from the mailbox of the camera
+            _, _, img = self.camera_microscope.latest_frame(out=img)
             new_slice = np.sum(img, axis=1)
+            if tracker is not None:
+                drift = tracker.update(img)
+                if drift is not None:
+                    self.correct_drift(tracker, drift, recenter=tracking.get('recenter', True))
             if USE_TEST_DATA:
                 new_slice = f['data']['timelapse'][:, i]
                 i = (i + increment) % frames
@@ -577,21 +567,42 @@ class MainSetup(Experiment):
             buffer[:, buffer_index] = new_slice
             buffer_index = (buffer_index + 1) % N_median
 
-            self.waterfall_image = np.roll(self.waterfall_image, shift=-1, axis=1)
             div = (div + np.maximum(0.5, np.sqrt(avg_median / np.median(avg_median))))/2
             new_line = (new_slice - avg_median) / div  # np.sqrt(np.maximum(avg_median, 1.0))  # np.sqrt(1+avg_std)
-            self.waterfall_image[:, -1] = smooth(new_line)#[::2] + new_line[1::2]  # bin in horizontal direction in 2 pixels
+            self.waterfall.append(smooth(new_line))#[::2] + new_line[1::2]  # bin in horizontal direction in 2 pixels
 
-            _min, _max = self.waterfall_image[:, -20:].min(), self.waterfall_image[:, -20:].max()
+            last_lines = self.waterfall.last(20)
+            _min, _max = last_lines.min(), last_lines.max()
             dif = (_max - _min)/10
             self.waterfall_image_limits[0] = self.waterfall_image_limits[0] * 0.97 + 0.03 * _min
             self.waterfall_image_limits[1] = self.waterfall_image_limits[1] * 0.97 + 0.03 * (_max+2*dif)
+            self.waterfall_feed.publish(self.waterfall, self.waterfall.count)
             time.sleep(refresh_time_s - time.time() % refresh_time_s)
 
         self.stop_saving_images()
         if USE_TEST_DATA:
             f.close()
-        
+
+    def correct_drift(self, tracker, drift, recenter=True):
+        """ Handles a drift of the fiber core reported by the :class:`CoreTracker` while measuring. The ROI of the
+        microscope camera is moved with the core without stopping the acquisition, and the event is sent to the saving
+        process to be stored with the data.
+
+        :param tracker: the tracker that reported the drift
+        :param float drift: drift of the core with respect to the center of the ROI, in pixels
+        :param bool recenter: if False, the drift is only recorded
+        """
+        shift = 0
+        if recenter:
+            try:
+                shift = self.camera_microscope.shift_ROI(drift)
+            except Exception:
+                self.logger.exception('Could not move the ROI to follow the fiber core')
+            tracker.shifted(shift)
+        self.logger.info(f'Fiber core drifted {drift:.1f}px, ROI moved {shift}px')
+        if self.roi_events is not None:
+            self.roi_events.put((time.time(), self.camera_microscope.ROI[1][0], drift, shift))
+
     def start_saving_images(self):
         if self.saving:
             self.logger.warning('Saving process still running: self.saving is true')
@@ -602,7 +613,12 @@ class MainSetup(Experiment):
         self.saving = True
         base_filename = self.config['info']['files']['filename']
         file = self.get_filename(base_filename)
+        self.current_file = file
+        self.logger.info(f'Saving the measurement to {file}')
+        if getattr(self, 'parent', None) is not None:
+            self.parent.saving_file.emit(file)
         self.saving_event.clear()
+        self.roi_events = Queue()
         if self.saving_images:
             alignment_images = {'focus_microscope': self.img_focus_microscope,
                                 'focus_laser': self.img_find_focus,
@@ -619,6 +635,8 @@ class MainSetup(Experiment):
             self.camera_microscope.new_image.url,
             topic='new_image',
             alignment_images=alignment_images,
+            alignment_trace=self.alignment_trace if self.saving_images else None,
+            roi_events=self.roi_events,
             metadata=self.camera_microscope.config.all(),
             versions = {'software_version': self.VERSION, 'firmware_version': self.electronics.driver.query('IDN')}
         )
@@ -682,14 +700,37 @@ class MainSetup(Experiment):
         power = int(power)
 
         self.electronics.scattering_laser = power
+        # Wait for the new power before anything is acquired with it
+        self.electronics.flush()
         self.config['electronics']['laser']['power'] = power
 
     def get_latest_image(self):
         return self.camera_microscope.temp_image
 
+    @property
+    def microscope_feed(self):
+        """ :class:`~NanoCETPy.dispertech.models.frame_feed.FrameFeed` of the microscope camera """
+        return self.camera_microscope.feed
+
+    def get_latest_frame(self):
+        """ :returns: tuple (frame id, image) of the latest image of the microscope camera. The id is read before the
+            image, so at worst an image is paired with the id of the previous frame and displayed twice.
+        """
+        frame_id = getattr(self.camera_microscope, 'frame_id', None)
+        return frame_id, self.camera_microscope.temp_image
+
+    @property
+    def waterfall_image(self):
+        """ Copy of the waterfall as an image (rows, length), the last column being the newest line """
+        return self.waterfall.image()
+
     def get_waterfall_image(self):
         return self.waterfall_image
 
+    def get_waterfall_frame(self):
+        """ :returns: tuple (id, image) of the waterfall, the id changes every time a line is added """
+        return self.waterfall.count, self.waterfall_image
+
     def load_configuration(self, *args, **kwargs):
         super().load_configuration(*args, **kwargs)
         # To allow the use of environmental variables like %HOMEPATH%
@@ -708,8 +749,8 @@ class MainSetup(Experiment):
         return folder
 
     def get_filename(self, base_filename: str) -> str:
-        """Checks if the given filename exists in the given folder and increments a counter until the first non-used
-        filename is available.
+        """Creates an empty file in the folder of the day, with the counter following the highest one already used.
+        The folder is read only the first time, then :attr:`file_namer` keeps the next counter in memory.
 
         :param base_filename: must have two placeholders {description} and {i}
         :returns: full path to the file where to save the data
@@ -717,17 +758,16 @@ class MainSetup(Experiment):
         if base_filename == "":
             base_filename = self.config['info']['files']['filename']
         folder = self.prepare_folder()
-        i = 1
         description = self.config['info']['files']['description']
-        while os.path.isfile(os.path.join(folder, base_filename.format(description=description, i=i))):
-            i += 1
-        return os.path.join(folder, base_filename.format(description=description, i=i))
+        return self.file_namer.new_filename(folder, base_filename, start=1, description=description)
 
     def finalize(self):
         if self.finalized:
            return
         self.logger.info('Finalizing calibration experiment')
         self.active = False
+        if self.device_initializer is not None:
+            self.device_initializer.stop()
         
         if self.saving:
             self.logger.debug('Finalizing the saving images')
@@ -3,7 +3,6 @@
 """
 
 import numpy as np
-from scipy import ndimage
 
 def centroid(image):
     m00 = np.sum(image)
@@ -28,5 +27,234 @@ def to_uint8(image):
         return image
 
 def image_convolution(image, kernel=np.ones((5,5))):
+    from scipy import ndimage  # imported here, it is only needed while aligning and slows down the startup
     convolution = ndimage.convolve(image, kernel, mode='reflect')
-    return convolution    
\ No newline at end of file
+    return convolution    
+
+
+def fiber_center(image, ksize=15, radius=5):
+    """ Finds the center of the fiber in an image of the fiber facet illuminated with the fiber LED, by convolving the
+    normalized image with a normalized disk.
+
+    :returns: (row, column) of the maximum of the convolution
+    """
+    kernel = circle2d_array((int(ksize/2), int(ksize/2)), radius, (ksize,ksize)) * 5.01
+    kernel = (kernel - np.mean(kernel)) / np.std(kernel)
+    fiber = (image - np.mean(image)) / np.std(image)
+    fibermask = image_convolution(fiber, kernel=kernel)
+    return np.argwhere(fibermask==np.max(fibermask))[0]
+
+
+def crop_window(images, center, half_width):
+    """ Crops a square window around ``center`` from a single image or from a stack of images, shifting the window
+    inwards when it would fall outside of the frame.
+
+    :param images: array of shape (rows, columns) or (frames, rows, columns)
+    :param center: (row, column) around which to crop
+    :param int half_width: the window spans ``2*half_width + 1`` pixels in each direction
+    :returns: the cropped view and the (row, column) offset of its first pixel in the original image
+    """
+    offset = []
+    slices = []
+    for c, size in zip(center, images.shape[-2:]):
+        length = min(2 * half_width + 1, size)
+        start = int(min(max(round(c) - half_width, 0), size - length))
+        offset.append(start)
+        slices.append(slice(start, start + length))
+    return images[(..., *slices)], np.array(offset, dtype=float)
+
+
+def _profile_moments(profiles):
+    """ First moment along the last axis of an array of non-negative profiles. NaN where a profile is empty. """
+    coords = np.arange(profiles.shape[-1])
+    total = profiles.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (profiles * coords).sum(axis=-1) / total
+
+
+def _log_parabola_fit(profiles):
+    """ Gaussian fitted to each profile (last axis) with the weighted log-parabola method: a parabola is fitted to
+    ``ln(p)`` with weights ``p**2``, which needs a single 3x3 linear solve per profile and no iterations.
+
+    :returns: centers and standard deviations, NaN where the fit fails or the center falls outside of the profile
+    """
+    length = profiles.shape[-1]
+    half = (length - 1) / 2
+    scale = max(half, 1)
+    coords = (np.arange(length) - half) / scale  # Scaled to [-1, 1] to keep the system well conditioned
+    valid = profiles > 0
+    weights = np.where(valid, profiles, 0.) ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = weights / weights.sum(axis=-1, keepdims=True)
+    weights = np.nan_to_num(weights)
+    log_p = np.log(np.where(valid, profiles, 1.))
+    powers = coords ** np.arange(5)[:, np.newaxis]  # x^0 ... x^4
+    sums = weights @ powers.T
+    normal = np.stack([sums[..., i:i + 3] for i in range(3)], axis=-2)
+    rhs = (weights * log_p) @ powers[:3].T
+
+    centers = np.full(profiles.shape[:-1], np.nan)
+    sigmas = np.full(profiles.shape[:-1], np.nan)
+    solvable = np.abs(np.linalg.det(normal)) > 1e-12
+    if np.any(solvable):
+        _, b, c = np.linalg.solve(normal[solvable], rhs[solvable][..., np.newaxis])[..., 0].T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centers[solvable] = np.where(c < 0, -b / (2 * c), np.nan) * scale + half
+            sigmas[solvable] = np.sqrt(np.where(c < 0, -1 / (2 * c), np.nan)) * scale
+    inside = (centers >= 0) & (centers <= length - 1)
+    return np.where(inside, centers, np.nan), np.where(inside, sigmas, np.nan)
+
+
+def spot_position(images, center=None, half_width=None, saturation=None, refine=False, noise_factor=3):
+    """ Sub-pixel position of a bright spot, such as the laser reflection on the fiber camera. It replaces thresholding
+    the full frame followed by :func:`centroid`.
+
+    The background level and its noise are estimated from the border of the (cropped) window and subtracted; only
+    pixels above ``background + noise_factor*noise`` contribute to the intensity-weighted centroid. If any pixel of a
+    frame reaches ``saturation``, the centroid of the saturated plateau is used for that frame, since the intensity
+    profile is clipped. With ``refine``, the centroid is improved by fitting a Gaussian to the row and column
+    profiles of the spot (not applied to saturated frames).
+
+    :param images: a single image (rows, columns) or a stack of frames (frames, rows, columns), for example from a
+        calibration sweep
+    :param center: (row, column) of the expected spot. Together with ``half_width`` it restricts the analysis to a
+        window around it, which is both faster and more robust against stray light
+    :param int half_width: half size of the analysis window, in pixels
+    :param saturation: pixel value at which the camera saturates, e.g. 255 for Mono8
+    :param bool refine: whether to refine the centroid with a Gaussian fit
+    :param float noise_factor: threshold above the background, in units of the background noise
+    :returns: (row, column) as floats, or an array of shape (frames, 2) for a stack. NaN if no spot was found
+    """
+    images = np.asarray(images)
+    single = images.ndim == 2
+    if single:
+        images = images[np.newaxis]
+    offset = np.zeros(2)
+    if center is not None and half_width is not None:
+        images, offset = crop_window(images, center, half_width)
+    frames = images.astype(float)
+
+    border = np.concatenate((frames[:, 0, :], frames[:, -1, :], frames[:, 1:-1, 0], frames[:, 1:-1, -1]), axis=1)
+    background = np.median(border, axis=1)
+    noise = 1.4826 * np.median(np.abs(border - background[:, np.newaxis]), axis=1)
+    weights = frames - (background + noise_factor * noise)[:, np.newaxis, np.newaxis]
+    np.clip(weights, 0, None, out=weights)
+
+    saturated_frames = np.zeros(len(frames), dtype=bool)
+    if saturation is not None:
+        saturated = images >= saturation
+        saturated_frames = saturated.any(axis=(1, 2))
+        weights[saturated_frames] = saturated[saturated_frames]
+
+    row_profiles = weights.sum(axis=2)
+    column_profiles = weights.sum(axis=1)
+    positions = np.stack((_profile_moments(row_profiles), _profile_moments(column_profiles)), axis=-1)
+
+    if refine:
+        refined = np.stack((_log_parabola_fit(row_profiles)[0], _log_parabola_fit(column_profiles)[0]), axis=-1)
+        use_refined = np.isfinite(refined) & ~saturated_frames[:, np.newaxis]
+        positions = np.where(use_refined, refined, positions)
+
+    positions = positions + offset
+    return positions[0] if single else positions
+
+
+def fit_gaussian_profiles(profiles, refine=False, iterations=8):
+    """ Fits a Gaussian on top of a constant background to many profiles at once, for example the cross sections of
+    the fiber core in different parts of the microscope image.
+
+    The starting values come from a closed-form estimate (background from a low percentile, center and width from a
+    log-parabola fit of the background-subtracted profile). With ``refine``, they are improved with a few
+    Levenberg-Marquardt iterations that are solved for all profiles simultaneously.
+
+    :param profiles: array of shape (profiles, length), or a single profile
+    :param bool refine: whether to run the least-squares refinement
+    :param int iterations: number of refinement iterations
+    :returns: centers, widths (standard deviation) and confidence (coefficient of determination of the fit, between 0
+        and 1), one value per profile. Centers and widths are NaN where no peak was found
+    """
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    length = profiles.shape[-1]
+    x = np.arange(length, dtype=float)
+
+    background = np.percentile(profiles, 10, axis=-1)
+    signal = np.clip(profiles - background[:, np.newaxis], 0, None)
+    amplitude = signal.max(axis=-1)
+    # Only the part of each profile above half the maximum is used for the starting values, to keep noise and
+    # neighbouring features from pulling the estimate
+    signal = np.where(signal >= amplitude[:, np.newaxis] / 2, signal, 0)
+    centers, widths = _log_parabola_fit(signal)
+    missing = ~np.isfinite(centers)
+    centers[missing] = np.argmax(profiles[missing], axis=-1)
+    widths = np.where(np.isfinite(widths) & (widths > 0), widths, length / 20)
+    params = np.stack((amplitude, centers, widths, background), axis=-1)
+
+    def model(p):
+        A, mu, sigma, bg = (p[:, i:i+1] for i in range(4))
+        e = np.exp(-(x - mu) ** 2 / (2 * sigma ** 2))
+        return A * e + bg, e
+
+    def cost(p):
+        return ((model(p)[0] - profiles) ** 2).sum(axis=-1)
+
+    if refine:
+        damping = np.full(len(profiles), 1e-3)
+        current_cost = cost(params)
+        for _ in range(iterations):
+            fitted, e = model(params)
+            A, mu, sigma = (params[:, i:i+1] for i in range(3))
+            dx = x - mu
+            jacobian = np.stack((e, A * e * dx / sigma ** 2, A * e * dx ** 2 / sigma ** 3, np.ones_like(e)), axis=-1)
+            jtj = np.einsum('nli,nlj->nij', jacobian, jacobian)
+            jtr = np.einsum('nli,nl->ni', jacobian, profiles - fitted)
+            diagonal = np.einsum('nii->ni', jtj)
+            lhs = jtj + damping[:, np.newaxis, np.newaxis] * np.einsum('ni,ij->nij', diagonal, np.eye(4))
+            try:
+                step = np.linalg.solve(lhs, jtr[..., np.newaxis])[..., 0]
+            except np.linalg.LinAlgError:
+                break
+            candidate = params + step
+            candidate[:, 2] = np.abs(candidate[:, 2])
+            with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+                candidate_cost = cost(candidate)
+            better = candidate_cost < current_cost
+            params = np.where(better[:, np.newaxis], candidate, params)
+            current_cost = np.where(better, candidate_cost, current_cost)
+            damping = np.where(better, damping / 10, damping * 10)
+
+    fitted = model(params)[0]
+    total = ((profiles - profiles.mean(axis=-1, keepdims=True)) ** 2).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        confidence = np.clip(1 - ((profiles - fitted) ** 2).sum(axis=-1) / total, 0, 1)
+    confidence = np.nan_to_num(confidence)
+    centers, widths = params[:, 1], params[:, 2]
+    found = (params[:, 0] > 0) & (centers >= 0) & (centers <= length - 1)
+    centers = np.where(found, centers, np.nan)
+    widths = np.where(found, widths, np.nan)
+    return centers, widths, np.where(found, confidence, 0)
+
+
+def find_core(image, sections=9, refine=False):
+    """ Locates the fiber core in a microscope image in which the core runs along the first axis.
+
+    The image is cut into ``sections`` along the core, each section is averaged into a cross section, and all the
+    cross sections are fitted at once with :func:`fit_gaussian_profiles`. Taking the median of the results discards
+    sections that don't contribute to a proper fit due to dust or air.
+
+    :param image: 2D array with the core along axis 0
+    :param int sections: number of sections, an odd number is recommended
+    :param bool refine: passed to :func:`fit_gaussian_profiles`
+    :returns: center and width (standard deviation) of the core along axis 1 in pixels, and a confidence between 0 and
+        1 combining the quality of the fits with how well the sections agree with each other
+    """
+    image = np.asarray(image, dtype=float)
+    edges = np.round(np.linspace(0, image.shape[0], sections + 1)).astype(int)
+    profiles = np.add.reduceat(image, edges[:-1], axis=0) / np.diff(edges)[:, np.newaxis]
+    centers, widths, confidence = fit_gaussian_profiles(profiles, refine=refine)
+    found = np.isfinite(centers)
+    if not np.any(found):
+        return np.nan, np.nan, 0.
+    center = np.median(centers[found])
+    width = np.median(widths[found])
+    agreement = np.sum(np.abs(centers[found] - center) <= width) / sections
+    return center, width, float(np.median(confidence) * agreement)
@@ -1,4 +1,5 @@
 import json
+import queue
 import time
 
 import h5py
@@ -105,7 +106,8 @@ class MovieSaver(ExperimentorProcess):
 class WaterfallSaver(ExperimentorProcess):
     """ Modified version of the MovieSaver that processes the each movieframe into a waterfall slice
     """
-    def __init__(self, file, max_memory, frame_rate, saving_event, url, topic='', alignment_images={}, metadata=None, versions={}):
+    def __init__(self, file, max_memory, frame_rate, saving_event, url, topic='', alignment_images={}, metadata=None,
+                 versions={}, roi_events=None, alignment_trace=None):
         super().__init__()
         self.file = file
         self.max_memory = max_memory
@@ -122,6 +124,8 @@ class WaterfallSaver(ExperimentorProcess):
                 metadata[key] = str(value)
         self.metadata = metadata
         self.alignment_images = alignment_images
+        self.alignment_trace = alignment_trace
+        self.roi_events = roi_events
         self.start()
 
     def run(self) -> None:
@@ -131,7 +135,8 @@ class WaterfallSaver(ExperimentorProcess):
         socket.connect(self.url)
         socket.setsockopt(zmq.SUBSCRIBE, self.topic.encode('utf-8'))
 
-        with h5py.File(self.file, "a") as f:
+        # The file was claimed empty when choosing its name, see FileNamer.new_filename
+        with h5py.File(self.file, "w") as f:
             f.attrs.update(self.versions)
             g = f.create_group('data')
             i = 0
@@ -179,6 +184,8 @@ class WaterfallSaver(ExperimentorProcess):
                         alignment_group = g.create_group('alignment_images')
                         for name, array in self.alignment_images.items():
                             alignment_group.create_dataset(name, data=array)
+                    if self.alignment_trace is not None:
+                        self.alignment_trace.save(g.create_group('alignment_trace'))
 
                 d[:, i] = img
                 i += 1
@@ -194,6 +201,8 @@ class WaterfallSaver(ExperimentorProcess):
                 self.logger.info(f'Saving last {i} frames')
                 dset[:, j:j + i] = d[:, :i]
 
+            self.save_roi_events(g)
+
             meta.update({
                 'end': time.time(),
                 'frames': j+i,
@@ -203,3 +212,21 @@ class WaterfallSaver(ExperimentorProcess):
             mdset[()] = metadata.encode("utf-8", "ignore")
             self.logger.info(f'Saver finished, total acquired frames: {j+i}')
 
+    def save_roi_events(self, group):
+        """ Stores the corrections of the ROI made while measuring (see
+        :py:meth:`~NanoCETPy.sequential.models.experiment.MainSetup.correct_drift`) as a dataset with one row per
+        event.
+        """
+        if self.roi_events is None:
+            return
+        events = []
+        while True:
+            try:
+                events.append(self.roi_events.get(timeout=0.1))
+            except queue.Empty:
+                break
+        if not events:
+            return
+        self.logger.info(f'Saving {len(events)} ROI drift events')
+        dset = group.create_dataset('roi_drift', data=np.array(events, dtype=float))
+        dset.attrs['columns'] = 'time, y_offset, drift, shift'
@@ -0,0 +1,61 @@
+"""
+    Ring buffer holding the last lines of the waterfall shown during a measurement.
+
+    Adding a line used to roll the whole image, copying all of it for every new line, and the views then had to display
+    the whole image again. The :class:`WaterfallBuffer` writes every line in place and counts the lines added, so a view
+    can ask only for the lines it did not display yet with :meth:`WaterfallBuffer.lines_since`.
+"""
+import threading
+
+import numpy as np
+
+
+class WaterfallBuffer:
+    """ The last ``length`` lines of a waterfall, each one with ``rows`` values.
+
+    :param int rows: number of values of each line
+    :param int length: number of lines kept
+    """
+    def __init__(self, rows, length, dtype=float):
+        self.rows = rows
+        self.length = length
+        self.data = np.zeros((length, rows), dtype=dtype)  # One line per row, so every line is contiguous
+        self.count = 0  # Lines added since the buffer was created
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_image(cls, image):
+        """ Creates a buffer with the lines of an image (rows, length), the first column being the oldest line. """
+        buffer = cls(image.shape[0], image.shape[1], dtype=image.dtype)
+        for line in image.T:
+            buffer.append(line)
+        return buffer
+
+    @property
+    def shape(self):
+        """ Shape of the waterfall image, see :meth:`image` """
+        return self.rows, self.length
+
+    def append(self, line):
+        with self._lock:
+            self.data[self.count % self.length] = line
+            self.count += 1
+
+    def lines_since(self, count):
+        """ Lines added after the first ``count`` ones, at most :attr:`length`.
+
+        :returns: tuple (number of lines added so far, array (new lines, rows) with the oldest line first)
+        """
+        with self._lock:
+            new = min(self.count - count, self.length)
+            index = np.arange(self.count - new, self.count) % self.length
+            return self.count, self.data[index]
+
+    def last(self, n):
+        """ :returns: the last n lines (at most :attr:`length`), as an array (n, rows). Lines not added yet are zeros. """
+        return self.lines_since(self.count - n)[1]
+
+    def image(self):
+        """ :returns: a copy of the waterfall as an array (rows, length), the last column being the newest line """
+        with self._lock:
+            return np.roll(self.data, -(self.count % self.length), axis=0).T
@@ -1,12 +1,19 @@
+import json
 import sys
 import time
 
 import pyqtgraph as pg
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QFont
-from PyQt5.QtWidgets import (QApplication, QGridLayout, QGroupBox, QPushButton, QSlider, QSpinBox, QWidget)
+from PyQt5.QtWidgets import (QApplication, QFileDialog, QGridLayout, QGroupBox, QLabel, QPushButton, QSlider, QSpinBox,
+                             QWidget)
 from pyqtgraph import GraphicsLayoutWidget
 
+from experimentor.lib.log import get_logger
+from .display_feed import DisplayFeed
+
+logger = get_logger(__name__)
+
 
 # class LedSlider(QSlider):
 #     def __init__(self, arduino, name, arduino_command, states=('off', 'on', 'blink'), *args, **kwargs):
@@ -90,11 +97,13 @@ class Window(QWidget):
 
         grid.addWidget(box_speed, 3, 3)
 
+        grid.addWidget(self.serial_stats(), 4, 0, 1, 4)
+
         grid.addWidget(self.imv, 0, 4, 4, 5)
         grid.setColumnStretch(4, 9)
 
         if self.show_plot:
-            grid.addWidget(self.graph, 4, 0, 4, grid.columnCount())
+            grid.addWidget(self.graph, 5, 0, 4, grid.columnCount())
             self.curves = [self.graph.plot([0])]
             self.curves.append(self.graph.plot([0]))
             self.gr = self.graph.getPlotItem()
@@ -109,13 +118,11 @@ class Window(QWidget):
         self.camera_fiber.initialize()
         self.camera_fiber.start_free_run()
         self.camera_fiber.continuous_reads()
-        self.timer_fiber = QTimer()
-        self.timer_fiber.timeout.connect(self.update_fiber_image)
-        time.sleep(0.2)
-        self.timer_fiber.start(50)
+        self.fiber_feed = DisplayFeed(self.camera_fiber.feed, parent=self)
+        self.fiber_feed.new_frame.connect(self.update_fiber_image)
 
-    def update_fiber_image(self):
-        self.img = self.camera_fiber.temp_image
+    def update_fiber_image(self, frame_id, img):
+        self.img = img
         self.imv.setImage(self.img)#, autoLevels=auto_levels, autoRange=auto_range, autoHistogramRange=auto_histogram_range)
 
     def process_fiber_image(self):
@@ -181,6 +188,33 @@ class Window(QWidget):
             # self.timer.start(1000)
 
 
+    def serial_stats(self):
+        """ Box showing the latency of the commands sent to the Arduino, refreshed every second """
+        groupBox = QGroupBox('Serial link')
+        label = QLabel()
+        label.setFont(QFont('Courier'))
+        label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        layout = QGridLayout()
+        layout.addWidget(label, 0, 0, 1, 2)
+        layout.addWidget(QPushButton('Reset', clicked=lambda: self.arduino.stats.reset()), 1, 0)
+        layout.addWidget(QPushButton('Export', clicked=self.export_serial_stats), 1, 1)
+        groupBox.setLayout(layout)
+        self.timer_stats = QTimer()
+        self.timer_stats.timeout.connect(lambda: label.setText(self.arduino.stats.summary()))
+        self.timer_stats.start(1000)
+        return groupBox
+
+    def export_serial_stats(self):
+        """ Saves the statistics of the serial link to a JSON file chosen by the user """
+        snapshot = self.arduino.stats.snapshot()
+        filename, _ = QFileDialog.getSaveFileName(self, 'Export serial statistics', 'serial_stats.json',
+                                                  'JSON files (*.json)')
+        if not filename:
+            return
+        with open(filename, 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        logger.info(f'Serial statistics exported to {filename}')
+
     def piezo(self, axis, name):
         groupBox = QGroupBox('Piezo '+name)
         layout = QGridLayout()
@@ -253,6 +287,7 @@ class Window(QWidget):
 
     def closeEvent(self, event):
         self.timer.stop()
+        self.timer_stats.stop()
         self.camera_fiber.stop_continuous_reads()
         self.camera_fiber.stop_free_run()
         if self.connected:
@@ -6,12 +6,15 @@ Wrapper around PyQtGraph ImageView.
 """
 import numpy as np
 import pyqtgraph as pg
-from PyQt5.QtCore import pyqtSignal, QRect, Qt, QTimer
+from PyQt5.QtCore import pyqtSignal, QRect, QRectF, Qt, QTimer
 from PyQt5.QtWidgets import QAction, QApplication
 from pyqtgraph import GraphicsLayoutWidget
 
 from experimentor.lib.log import get_logger
 from experimentor.views.data_view_widget import DataViewWidget
+from .display_feed import DisplayFeed
+from .levels import LevelsEstimator
+from .preview import PreviewWorker, gradient_lut
 
 
 class CameraViewerWidget(DataViewWidget):
@@ -20,6 +23,8 @@ class CameraViewerWidget(DataViewWidget):
     and vertical lines to define a ROI, and it allows to draw on top of the image. The core idea is to make these options
     explicit, in order to systematize them in one place.
 
+    Large images can be displayed through a preview generated in a worker thread, see :meth:`start_preview`.
+
     Signals
     -------
     clicked_on_image: Emits [float, float] with the coordinates where the mouse was clicked on the image. Does not
@@ -74,6 +79,9 @@ class CameraViewerWidget(DataViewWidget):
         self.logger = get_logger()
 
         self.last_image = None
+        self.last_frame_id = None
+        self.preview_worker = None
+        self.levels_estimator = LevelsEstimator()
 
         self.add_actions_to_menu()
         self.setup_mouse_tracking()
@@ -82,32 +90,85 @@ class CameraViewerWidget(DataViewWidget):
         """ Shortcut to getting the image scene"""
         return self.img.scene()
 
-    def update_image(self, image, auto_range=False, auto_histogram_range=False):
+    def update_image(self, image, frame_id=None, auto_range=False, auto_histogram_range=False):
         """ Updates the image being displayed with some sensitive defaults, which can be over written if needed.
+
+        :param image: image to display
+        :param frame_id: identifier of the frame, if it is the same as the one of the image already displayed, nothing
+            is done. None always updates the image
         """
-        auto_levels = self.auto_levels_action.isChecked()
-        self.logger.debug(f'Updating image with auto_levels: {auto_levels}')
-        if image is not None:
-            self.imv.setImage(image, autoLevels=auto_levels, autoRange=auto_range, autoHistogramRange=auto_histogram_range)
-            # self.img.setImage(image, autoHisogramRange=True)
-            #self.view.setRange(yRange=(0,image.shape[1]), padding=0)
-            # self.imv.autoLevels()
-            if self.first_image:
-
-                self.do_auto_range()
-                
-                #self.view.invertY(True)
-                #self.view.setLimits(xMin=-image.shape[0]*0.05, xMax=image.shape[0]*1.05,
-                #                    minXRange=1, maxXRange=image.shape[0],
-                #                    yMin=-image.shape[1]*0.05, yMax=image.shape[1]*1.05,
-                #                    minYRange=0.1*image.shape[1], maxYRange=4*image.shape[1])
-                #self.view.setRange(yRange=(0,image.shape[1]), padding=0)
-                self.view.autoRange(padding=0)
-                self.first_image -= 1
-            self.last_image = image
-        else:
+        if image is None:
             self.logger.debug(f'No new image to update')
-    
+            return
+        if frame_id is not None and frame_id == self.last_frame_id:
+            return
+        self.last_frame_id = frame_id
+        kwargs = {}
+        if self.auto_levels_action.isChecked():
+            # Sampled estimate instead of the statistics of every pixel
+            kwargs['levels'] = self.levels_estimator.update(image)
+        self.imv.setImage(image, autoLevels=False, autoRange=auto_range, autoHistogramRange=auto_histogram_range,
+                          **kwargs)
+        # self.img.setImage(image, autoHisogramRange=True)
+        # self.imv.autoLevels()
+        shape_changed = self.last_image is None or image.shape != self.last_image.shape
+        self.last_image = image
+        if shape_changed:
+            # The view only needs to adapt when the size of the image changes, e.g. after setting the ROI
+            self.view.autoRange(padding=0)
+            self.levels_estimator.reset()
+            self.first_image = 8
+        if self.first_image:
+            self.do_auto_range()
+            self.first_image -= 1
+
+    def start_preview(self, feed, gradient='thermal', interval=50):
+        """ Displays the images of a feed through a :class:`~NanoCETPy.sequential.views.preview.PreviewWorker`, which
+        reduces them to their resolution on screen and applies the levels and the gradient in a worker thread. The
+        GUI thread then only displays the resulting RGBA image, which keeps the coordinates of the full image.
+
+        :param feed: :class:`~NanoCETPy.dispertech.models.frame_feed.FrameFeed` with the images
+        :param str gradient: name of a predefined pyqtgraph gradient
+        :param int interval: minimum time between two images, in milliseconds
+        """
+        self.imv.setPredefinedGradient(gradient)
+        # The histogram of the colored preview is meaningless, and it would override the levels of the image item
+        try:
+            self.img.sigImageChanged.disconnect(self.imv.ui.histogram.imageChanged)
+        except TypeError:
+            pass  # Not connected
+        self.preview_worker = PreviewWorker(feed, gradient_lut(gradient), interval=interval)
+        self.preview_worker.auto_levels = self.auto_levels_action.isChecked()
+        self.auto_levels_action.toggled.connect(self.set_preview_auto_levels)
+        self.preview_feed = DisplayFeed(self.preview_worker.output, interval=interval, parent=self)
+        self.preview_feed.new_frame.connect(self.update_preview)
+        self.destroyed.connect(lambda *args, worker=self.preview_worker: worker.stop())
+
+    def stop_preview(self):
+        if self.preview_worker is not None:
+            self.preview_feed.close()
+            self.preview_worker.stop()
+            self.preview_worker = None
+
+    def set_preview_auto_levels(self, checked):
+        if self.preview_worker is not None:
+            self.preview_worker.auto_levels = checked
+
+    def update_preview(self, frame_id, preview):
+        """ Displays a :class:`~NanoCETPy.sequential.views.preview.Preview` generated by :meth:`start_preview`. """
+        if frame_id == self.last_frame_id or self.preview_worker is None:
+            return
+        self.last_frame_id = frame_id
+        shape = preview.image.shape
+        self.img.setImage(preview.rgba, levels=(0, 255))
+        self.img.setRect(QRectF(0, 0, shape[0], shape[1]))
+        if self.last_image is None or shape != self.last_image.shape:
+            self.view.autoRange(padding=0)
+        self.last_image = preview.image
+        # Image pixels per physical screen pixel, the next previews are reduced accordingly
+        pixel_size = min(self.view.viewPixelSize()) / self.devicePixelRatioF()
+        self.preview_worker.factor = max(1, int(pixel_size))
+
     def setup_roi_box(self):
         """ Setup a ROI box to drag over the fiber core in the sequential window
         """
@@ -211,14 +272,16 @@ class CameraViewerWidget(DataViewWidget):
                 self.crossCut.setValue(int(self.img.mapFromScene(arg).y()))
 
     def do_auto_range(self, ignore_zeros=False):
-        """ Sets the levels of the image based on the maximum and minimum. This is useful when auto-levels are off
-        (the default behavior), and one needs to quickly adapt the histogram.
+        """ Sets the levels of the image based on percentiles of a sample of its pixels, see
+        :class:`~NanoCETPy.sequential.views.levels.LevelsEstimator`. This is useful when auto-levels are off (the default
+        behavior), and one needs to quickly adapt the histogram.
         """
-
-        h, y = self.img.getHistogram()
-        if ignore_zeros:
-            h = h[h > 0]
-        self.imv.setLevels(min(h), max(h))
+        if self.preview_worker is not None:
+            self.preview_worker.adjust_levels()
+            return
+        if self.last_image is None:
+            return
+        self.imv.setLevels(*self.levels_estimator.estimate(self.last_image, ignore_zeros=ignore_zeros))
 
     def draw_target_pointer(self, locations):
         """gets an image and draws a circle around the target locations.
@@ -294,10 +357,11 @@ class CameraViewerWidget(DataViewWidget):
     @classmethod
     def connect_to_camera(cls, camera, refresh_time=50, parent=None):
         """ Instantiate the viewer using connect_to_camera in order to get some functionality out of the box. It will
-        create a timer to automatically update the image
+        create a timer to automatically update the image, which is only redrawn when the camera has a new frame
         """
         instance = cls(parent=parent)
         instance.timer = QTimer()
-        instance.timer.timeout.connect(lambda: instance.update_image(camera.temp_image))
+        instance.timer.timeout.connect(
+            lambda: instance.update_image(camera.temp_image, frame_id=getattr(camera, 'frame_id', None)))
         instance.timer.start(refresh_time)
         return instance
\ No newline at end of file
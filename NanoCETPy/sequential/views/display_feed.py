@@ -0,0 +1,74 @@
+"""
+    Display Feed
+    ============
+    Delivers the images of a :class:`~NanoCETPy.dispertech.models.frame_feed.FrameFeed` to the GUI thread.
+
+    Instead of polling the experiment with a timer, a view creates a :class:`DisplayFeed` and connects its
+    :attr:`~DisplayFeed.new_frame` signal to the method that updates the viewer. When the producer publishes an image,
+    the display feed wakes up the GUI thread through a queued signal, and only the latest image is delivered: images
+    published while the GUI is busy, or faster than the refresh interval, are coalesced. The views therefore refresh at
+    the real frame rate, capped by the interval, and do nothing while no new images arrive.
+"""
+import threading
+import time
+
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal
+
+
+class DisplayFeed(QObject):
+    """ Rate-limited delivery of the latest image of a feed to the GUI thread. It must be created in the GUI thread.
+
+    Signals
+    -------
+    new_frame: Emits [object, object] with the id and the latest image of the feed
+
+    :param feed: the :class:`~NanoCETPy.dispertech.models.frame_feed.FrameFeed` to follow
+    :param int interval: minimum time between two deliveries, in milliseconds
+    """
+    new_frame = pyqtSignal(object, object)
+    _wake = pyqtSignal()
+
+    def __init__(self, feed, interval=50, parent=None):
+        super().__init__(parent=parent)
+        self.feed = feed
+        self.interval = interval / 1000
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._last_delivery = 0
+        self._last_id = None
+        self._wake.connect(self._deliver, Qt.QueuedConnection)
+        feed.subscribe(self._on_publish)
+        self.destroyed.connect(lambda *args, feed=feed, callback=self._on_publish: feed.unsubscribe(callback))
+        # Deliver what was published before the view existed
+        self._on_publish(None, None)
+
+    def close(self):
+        """ Stops following the feed. """
+        self.feed.unsubscribe(self._on_publish)
+
+    def _on_publish(self, frame_id, image):
+        """ Called from the thread of the producer, it only schedules a delivery if there is none pending. """
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        try:
+            self._wake.emit()
+        except RuntimeError:
+            # The Qt object was deleted together with its parent
+            self.feed.unsubscribe(self._on_publish)
+
+    def _deliver(self):
+        wait = self._last_delivery + self.interval - time.monotonic()
+        if wait > 0:
+            QTimer.singleShot(int(wait * 1000) + 1, self._deliver)
+            return
+        with self._lock:
+            # Images published from now on need a new delivery
+            self._scheduled = False
+        frame_id, image, _ = self.feed.latest()
+        if image is None or frame_id == self._last_id:
+            return
+        self._last_id = frame_id
+        self._last_delivery = time.monotonic()
+        self.new_frame.emit(frame_id, image)
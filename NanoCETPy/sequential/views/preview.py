@@ -0,0 +1,150 @@
+"""
+Preview
+=======
+Prepares the images to display in a worker thread.
+
+Giving a full 1920x1200 frame to a pyqtgraph ImageView on every refresh means that the GUI thread scales, and converts
+to RGBA, more pixels than the screen can show. The :class:`PreviewWorker` does that work in its own thread. It reduces
+the frame to the resolution it has on screen, scales it with the levels, applies the lookup table of a gradient and
+publishes a :class:`Preview` with an RGBA ``uint8`` image ready to be displayed. The viewer only hands that image to its
+ImageItem, see :meth:`~NanoCETPy.sequential.views.camera_viewer_widget.CameraViewerWidget.start_preview`.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from experimentor.lib.log import get_logger
+from NanoCETPy.dispertech.models.frame_feed import FrameFeed
+from .levels import LevelsEstimator
+
+logger = get_logger(__name__)
+
+Preview = namedtuple('Preview', ['image', 'rgba', 'levels'])
+Preview.__doc__ = """ Image ready to be displayed: ``rgba`` is the reduced image after the lookup table, ``image`` the
+original frame and ``levels`` the (min, max) used to scale it. """
+
+
+def gradient_lut(name='thermal', points=256):
+    """ :returns: the lookup table of one of the predefined pyqtgraph gradients, as an array (points, 4) of uint8 """
+    import pyqtgraph as pg
+    from pyqtgraph.graphicsItems.GradientEditorItem import Gradients
+
+    ticks = sorted(Gradients[name]['ticks'])
+    color_map = pg.ColorMap([pos for pos, _ in ticks], [color for _, color in ticks])
+    return color_map.getLookupTable(0., 1., points, alpha=True).astype(np.uint8)
+
+
+def downsample(image, factor):
+    """ Reduces an image by an integer factor, keeping the maximum of every block of factor x factor pixels, so
+    isolated bright particles stay visible. The pixels that do not fill a whole block are dropped.
+    """
+    if factor <= 1:
+        return image
+    width = image.shape[0] // factor * factor
+    height = image.shape[1] // factor * factor
+    # Strided views avoid copying the frame, which is usually transposed, to reshape it in blocks
+    reduced = image[:width:factor, :height:factor].copy()
+    for i in range(factor):
+        for j in range(factor):
+            if i or j:
+                np.maximum(reduced, image[i:width:factor, j:height:factor], out=reduced)
+    return reduced
+
+
+def apply_lut(image, levels, lut):
+    """ Scales an image between the levels and converts it to colors with a lookup table.
+
+    :param image: 2D array
+    :param levels: (min, max) values mapped to the first and last entries of the table
+    :param lut: array (n, 4) of uint8
+    :returns: array with the shape of the image plus one last axis with the 4 channels, uint8
+    """
+    low, high = levels
+    last = len(lut) - 1
+    scale = np.float32(last / (high - low) if high > low else 0.)
+    index = np.clip((image - np.float32(low)) * scale, 0, last).astype(np.intp)
+    return lut[index]
+
+
+class PreviewWorker:
+    """ Renders the latest image of a feed in a thread and publishes the result on :attr:`output`.
+
+    The levels are estimated from a sample of the pixels of the full image, see
+    :class:`~NanoCETPy.sequential.views.levels.LevelsEstimator`, for the first ``auto_level_frames`` frames and again
+    every time the shape of the images changes. If :attr:`auto_levels` is True they follow every frame, with
+    hysteresis. In between they are kept, as the viewer did before.
+
+    :param feed: :class:`~NanoCETPy.dispertech.models.frame_feed.FrameFeed` with the images to display
+    :param lut: lookup table, see :func:`gradient_lut`
+    :param int interval: minimum time between two previews, in milliseconds
+    :param int auto_level_frames: number of frames used to set the levels
+    """
+    def __init__(self, feed, lut, interval=50, auto_level_frames=8):
+        self.feed = feed
+        self.lut = lut
+        self.interval = interval / 1000
+        self.auto_level_frames = auto_level_frames
+        self.output = FrameFeed()
+        self.factor = 1  # Set by the viewer to the number of image pixels per screen pixel
+        self.levels = None
+        self.auto_levels = False
+        self.levels_estimator = LevelsEstimator()
+        self._auto_frames = auto_level_frames
+        self._shape = None
+        self._last_id = None
+        self._new_frame = threading.Event()
+        self._stop = threading.Event()
+        feed.subscribe(self._on_publish)
+        self._thread = threading.Thread(target=self._run, name='preview', daemon=True)
+        self._thread.start()
+        self._on_publish(None, None)
+
+    def adjust_levels(self, frames=None):
+        """ Computes the levels again over the next frames. """
+        self._auto_frames = frames or self.auto_level_frames
+
+    def stop(self):
+        self.feed.unsubscribe(self._on_publish)
+        self._stop.set()
+        self._new_frame.set()
+
+    def _on_publish(self, frame_id, image):
+        self._new_frame.set()
+
+    def render(self, image):
+        """ :returns: the :class:`Preview` of an image """
+        if image.shape != self._shape:
+            self._shape = image.shape
+            self.levels_estimator.reset()
+            self.adjust_levels()
+        data = downsample(image, self.factor)
+        if self.auto_levels:
+            self.levels = self.levels_estimator.update(image)
+        elif self._auto_frames or self.levels is None:
+            self.levels = self.levels_estimator.estimate(image)
+            self._auto_frames = max(self._auto_frames - 1, 0)
+        return Preview(image, apply_lut(data, self.levels, self.lut), self.levels)
+
+    def _run(self):
+        last_render = 0
+        while not self._stop.is_set():
+            self._new_frame.wait()
+            if self._stop.is_set():
+                break
+            wait = last_render + self.interval - time.monotonic()
+            if wait > 0 and self._stop.wait(wait):
+                break
+            self._new_frame.clear()
+            frame_id, image, _ = self.feed.latest()
+            if image is None or frame_id == self._last_id:
+                continue
+            last_render = time.monotonic()
+            try:
+                preview = self.render(image)
+            except Exception:
+                logger.exception('Error rendering the preview')
+                continue
+            self._last_id = frame_id
+            self.output.publish(preview, frame_id)
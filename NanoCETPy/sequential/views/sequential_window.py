@@ -13,8 +13,8 @@ from PyQt5.QtWidgets import QMainWindow, QWidget, QFileDialog, QLabel, QSizePoli
 from experimentor import Q_
 from experimentor.lib.log import get_logger
 from experimentor.views.base_view import BaseView
-from .camera_viewer_widget import CameraViewerWidget
 from ..views import BASE_DIR_VIEW
+from .display_feed import DisplayFeed
 
 logger = get_logger(__name__)
 
@@ -23,6 +23,8 @@ class SequentialMainWindow(QMainWindow, BaseView):
     '''Main Window of the Application with current UI being displayed on the main_widget.
     Listens to signals from this widget to change views'''
     init_failed = pyqtSignal()
+    device_status = pyqtSignal(str, str)  # device name and status, emitted while initializing the devices
+    saving_file = pyqtSignal(str)  # full path of the file chosen to save a measurement, emitted when saving starts
 
     def __init__(self, experiment=None):
         super(SequentialMainWindow, self).__init__()
@@ -194,8 +196,9 @@ class Label(QLabel):
 
 class StartupWidget(QWidget, BaseView):
     '''Widget to check for connections to NanoCET and then emit signal
-    
-    TODO: Make it respond to status of hardware'''
+
+    Shows the progress reported by the experiment through the device_status signal of the main window while the
+    devices initialize'''
     ready_signal = pyqtSignal()
 
     def __init__(self, experiment, parent=None):
@@ -203,23 +206,35 @@ class StartupWidget(QWidget, BaseView):
         uic.loadUi(BASE_DIR_VIEW / 'GUI' / 'Startup_Widget.ui', self)
         self.experiment = experiment
 
-        self.intialized = [False, False, False]
-        self.check_string = {True: 'initialized.', False: '...'}
-        #self.device_label.setText(f' {self.experiment.camera_fiber.camera} \n\n {self.experiment.camera_microscope.camera} \n\n Electronics ')
-
-        if self.experiment.electronics is None: self.experiment.initialize()
-        self.check_connections_timer = QTimer()
-        self.check_connections_timer.timeout.connect(self.check_connections)
-        self.check_connections_timer.start(100)
-
-    def check_connections(self):
-        if self.experiment.electronics is None: return # to wait for initialize function of experiment
-        initialized = [self.experiment.camera_fiber.initialized, self.experiment.camera_microscope.initialized, self.experiment.electronics.initialized]
-        self.device_label.setText(f' {self.experiment.camera_fiber.camera} \n\n {self.experiment.camera_microscope.camera} \n\n Electronics ')
-        self.check_label.setText(f' {self.check_string[initialized[0]]} \n\n {self.check_string[initialized[1]]} \n\n {self.check_string[initialized[2]]}')
-        if all(initialized):
+        self.check_string = {'waiting': '...', 'initializing': '...', 'retrying': 'retrying...',
+                             'initialized': 'initialized.', 'failed': 'not found.'}
+        self.devices = {
+            'camera_fiber': self.experiment.config['camera_fiber']['init'],
+            'camera_microscope': self.experiment.config['camera_microscope']['init'],
+            'electronics': 'Electronics',
+        }
+        self.status = {name: 'waiting' for name in self.devices}
+        self.device_label.setText(' \n\n '.join(f'{label}' for label in self.devices.values()))
+
+        self.experiment.parent.device_status.connect(self.update_status)
+        if self.experiment.electronics is None:
+            self.experiment.initialize()
+        else:
+            for name in self.devices:
+                device = getattr(self.experiment, name)
+                self.status[name] = 'initialized' if device.initialized else 'failed'
+            QTimer.singleShot(0, self.show_status)
+
+    @pyqtSlot(str, str)
+    def update_status(self, name, status):
+        self.status[name] = status
+        self.show_status()
+
+    def show_status(self):
+        self.check_label.setText(' \n\n '.join(self.check_string[status] for status in self.status.values()))
+        if all(status == 'initialized' for status in self.status.values()):
+            self.experiment.parent.device_status.disconnect(self.update_status)
             self.ready_signal.emit()
-            self.check_connections_timer.stop()
             logger.info('Ready')
 
 
@@ -276,10 +291,9 @@ class FocusWidget(QWidget, BaseView):
         uic.loadUi(BASE_DIR_VIEW / 'GUI' / 'Focus_Widget.ui', self)
         self.experiment = experiment
 
+        from .camera_viewer_widget import CameraViewerWidget  # pyqtgraph is not needed on the startup screen
         self.microscope_viewer = CameraViewerWidget(parent=self)
         self.microscope_widget.layout().addWidget(self.microscope_viewer)
-        self.microscope_timer = QTimer()
-        self.microscope_timer.timeout.connect(self.update_microscope_viewer)
 
         self.experiment.focus_start() #Unset ROI also
         self.ROI_button.clicked.connect(self.set_ROI)
@@ -289,11 +303,11 @@ class FocusWidget(QWidget, BaseView):
         while not self.experiment.camera_microscope.continuous_reads_running:
             time.sleep(.1)
         self.resized = False
-        self.microscope_timer.start(50)
+        self.microscope_feed = DisplayFeed(self.experiment.microscope_feed, parent=self)
+        self.microscope_feed.new_frame.connect(self.update_microscope_viewer)
 
-    def update_microscope_viewer(self):
-        img = self.experiment.get_latest_image()
-        if img is not None: self.microscope_viewer.update_image(img)
+    def update_microscope_viewer(self, frame_id, img):
+        self.microscope_viewer.update_image(img, frame_id=frame_id)
         if not self.resized: 
             self.resize(self.width()+1, self.height()+1)
             self.resized = True
@@ -373,11 +387,10 @@ class ParametersWidget(QWidget, BaseView):
         uic.loadUi(BASE_DIR_VIEW / 'GUI/Parameters_Widget.ui', self)
         self.experiment = experiment
 
+        from .camera_viewer_widget import CameraViewerWidget
         self.microscope_viewer = CameraViewerWidget(parent=self)
         self.microscope_widget.layout().addWidget(self.microscope_viewer)
         self.microscope_viewer.imv.setPredefinedGradient('thermal')
-        self.microscope_timer = QTimer()
-        self.microscope_timer.timeout.connect(self.update_microscope_viewer)
 
         self.name_line.setText(str(self.experiment.config['info']['files']['description']))
         expt = self.experiment.config['camera_microscope']['config']['exposure']
@@ -394,12 +407,12 @@ class ParametersWidget(QWidget, BaseView):
         self.start_button.clicked.connect(self.start)
 
         self.resized = False
-        self.microscope_timer.start(50)
+        self.microscope_feed = DisplayFeed(self.experiment.microscope_feed, parent=self)
+        self.microscope_feed.new_frame.connect(self.update_microscope_viewer)
         self.update_parameters()
 
-    def update_microscope_viewer(self):
-        img = self.experiment.get_latest_image()
-        self.microscope_viewer.update_image(img)
+    def update_microscope_viewer(self, frame_id, img):
+        self.microscope_viewer.update_image(img, frame_id=frame_id)
         if not self.resized: 
             self.resize(self.width()+1, self.height()+1)
             self.resized = True
@@ -431,19 +444,19 @@ class MeasurementWidget(QWidget, BaseView):
         uic.loadUi(BASE_DIR_VIEW / 'GUI/Measurement_Widget.ui', self)
         self.experiment = experiment
 
+        from .camera_viewer_widget import CameraViewerWidget
         self.microscope_viewer = CameraViewerWidget(parent=self)
         self.microscope_viewer.imv.ui.histogram.hide()
         self.microscope_widget.layout().addWidget(self.microscope_viewer)
-        self.microscope_viewer.imv.setPredefinedGradient('thermal')
 
+        from .preview import gradient_lut
+        from .waterfall_item import WaterfallItem
         self.waterfall_viewer = CameraViewerWidget(parent=self)
         self.waterfall_viewer.imv.ui.histogram.hide()
         self.waterfall_widget.layout().addWidget(self.waterfall_viewer)
-        self.waterfall_viewer.imv.setPredefinedGradient('thermal')
-        self.microscope_timer = QTimer()
-        self.microscope_timer.timeout.connect(self.update_microscope_viewer)
-        self.waterfall_timer = QTimer()
-        self.waterfall_timer.timeout.connect(self.update_waterfall_viewer)
+        # Only the new lines of the waterfall are converted and drawn, instead of the whole image
+        self.waterfall_item = WaterfallItem(gradient_lut('thermal'))
+        self.waterfall_viewer.view.addItem(self.waterfall_item)
 
         # self.experiment.reset_waterfall()
         self.stop_button.clicked.connect(self.stop_measurement)
@@ -454,30 +467,33 @@ class MeasurementWidget(QWidget, BaseView):
         #self.more_menu.addAction('With new cartridge', self.preferences)
         #self.more_button.setMenu(self.more_menu)
         self.quit_button.clicked.connect(self.quit)
-        
+
+        # The experiment reports the file it saves to, so the label does not need to look at the data folder
+        self.experiment.parent.saving_file.connect(self.update_helptext_label)
         self.update_helptext_label()
         self.resized = False
-        self.microscope_timer.start(50)
-        self.waterfall_timer.start(50)
+        # Full frames are too large to be displayed on every refresh while recording
+        self.microscope_viewer.start_preview(self.experiment.microscope_feed, gradient='thermal')
+        self.microscope_viewer.preview_feed.new_frame.connect(self.update_microscope_viewer)
+        self.waterfall_feed = DisplayFeed(self.experiment.waterfall_feed, parent=self)
+        self.waterfall_feed.new_frame.connect(self.update_waterfall_viewer)
 
-    def update_helptext_label(self):
-        """
-        TODO: The naming in the GUI needs to change (because it shows incorrect file), but this should be part of a whole update of saving procedure.
-        """
-        try:
-            data_folder = self.experiment.prepare_folder()
-            files = [x for x in os.listdir(data_folder) if x.endswith(".h5")]
-            newest = max(files, key=lambda fname: os.path.getctime(os.path.join(data_folder, fname)))
-        except Exception as e:
-            newest = "Test_Experiment_001.hf"
+    @pyqtSlot()
+    @pyqtSlot(str)
+    def update_helptext_label(self, filename=None):
+        """ Shows the file where the measurement is saved, as chosen by the experiment when it started saving. """
+        filename = filename or self.experiment.current_file
         if self.experiment.active:
-            new_filename = self.experiment.get_filename("")
-            filename_split = new_filename.split(os.path.sep)
+            if filename is None or not self.experiment.saving:
+                # The experiment is still choosing the file, the label is updated through saving_file
+                location = "\n..."
+            else:
+                folder, name = os.path.split(filename)
+                location = f"{folder}{os.path.sep}\n{name}"
             self.helptext_label.setText(
                 f"Measurement ongoing"
                 f"\n\nData being saved to:\n"
-                f"{os.path.sep.join(filename_split[:-1])}{os.path.sep}"
-                f"\n{filename_split[-1]}"
+                f"{location}"
                 f"\n\nLaser power:\t{self.experiment.electronics.scattering_laser}"
                 f"\nExposure time:\t{self.experiment.camera_microscope.config['exposure']}"
                 f"\nGain:\t{self.experiment.camera_microscope.config['gain']}")
@@ -485,15 +501,12 @@ class MeasurementWidget(QWidget, BaseView):
 
             self.helptext_label.setText(
                 f"Measurement finished"
-                f"\n\nData was saved to {newest}"
+                f"\n\nData was saved to {os.path.basename(filename or '')}"
                 f"\n\nLaser power:\t{self.experiment.electronics.scattering_laser}"
                 f"\nExposure time:\t{self.experiment.camera_microscope.config['exposure']}"
                 f"\nGain:\t{self.experiment.camera_microscope.config['gain']}")
 
-    def update_microscope_viewer(self):
-        img = self.experiment.get_latest_image()
-        self.microscope_viewer.update_image(img)
-        self.microscope_viewer.view.autoRange()
+    def update_microscope_viewer(self, frame_id, preview):
         if not self.resized:
             self.resize(self.width()+1, self.height()+1)
             # self.waterfall_viewer.view.autoRange()
@@ -501,13 +514,9 @@ class MeasurementWidget(QWidget, BaseView):
             self.logger.info('resizing to force redraw')
 
 
-    def update_waterfall_viewer(self):
-        img = self.experiment.get_waterfall_image()
-
-        self.waterfall_viewer.update_image(img)
-        self.waterfall_viewer.view.autoRange()
-        # self.waterfall_viewer.do_auto_range(ignore_zeros=True)
-        self.waterfall_viewer.imv.setLevels(*self.experiment.waterfall_image_limits)
+    def update_waterfall_viewer(self, count, waterfall):
+        if self.waterfall_item.update_lines(waterfall, self.experiment.waterfall_image_limits):
+            self.waterfall_viewer.view.autoRange(padding=0)
 
     def stop_measurement(self):
         if not self.experiment.saving: return
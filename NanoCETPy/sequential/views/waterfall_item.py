@@ -0,0 +1,100 @@
+"""
+Waterfall Item
+==============
+Scrolling display of a :class:`~NanoCETPy.sequential.models.waterfall.WaterfallBuffer`.
+
+Giving the whole waterfall to an ImageView every time a line is added means the complete image is scaled, converted
+to colors and uploaded again for a single new line. The :class:`WaterfallItem` keeps the colored image in a persistent
+QImage used as a ring: every new line is converted and written in place over the oldest one, and scrolling is done
+when painting, by drawing the two parts of the ring in order. The whole image is only converted again when the levels
+move more than a tolerance, or when the size of the waterfall changes.
+"""
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QImage
+
+from .preview import apply_lut
+
+
+class WaterfallItem(pg.GraphicsObject):
+    """ Graphics item displaying a waterfall, with the position along x and the oldest line at the bottom. It has the
+    same coordinates as an ImageItem showing the waterfall image (rows, length).
+
+    :param lut: lookup table (n, 4) of RGBA uint8, see :func:`~NanoCETPy.sequential.views.preview.gradient_lut`
+    :param float tolerance: fraction of the range of the levels that they can move before the image is converted again
+    """
+    def __init__(self, lut, tolerance=0.05):
+        super().__init__()
+        self.lut = np.ascontiguousarray(lut[:, [2, 1, 0, 3]])  # QImage.Format_ARGB32 is stored as BGRA
+        self.tolerance = tolerance
+        self.levels = None
+        self.buffer = None
+        self.count = 0  # Lines of the buffer already displayed
+        self.head = 0  # Line of the ring where the next line is written, i.e. the oldest one
+        self.qimage = None
+        self.pixels = None
+        self.data = None
+
+    def boundingRect(self):
+        if self.qimage is None:
+            return QRectF()
+        return QRectF(0, 0, self.qimage.width(), self.qimage.height())
+
+    def paint(self, painter, *args):
+        if self.qimage is None:
+            return
+        width = self.qimage.width()
+        length = self.qimage.height()
+        head = self.head
+        painter.drawImage(QRectF(0, 0, width, length - head), self.qimage, QRectF(0, head, width, length - head))
+        if head:
+            painter.drawImage(QRectF(0, length - head, width, head), self.qimage, QRectF(0, 0, width, head))
+
+    def reset(self, rows, length):
+        """ Creates an empty image for a waterfall of the given size. """
+        self.prepareGeometryChange()
+        self.qimage = QImage(rows, length, QImage.Format_ARGB32)
+        self.qimage.fill(Qt.black)
+        pointer = self.qimage.bits()
+        pointer.setsize(self.qimage.byteCount())
+        # View on the memory of the QImage, lines can be padded at the end
+        self.pixels = np.frombuffer(pointer, dtype=np.uint8).reshape(length, -1, 4)[:, :rows]
+        self.data = np.zeros((length, rows), dtype=np.float32)
+        self.head = 0
+
+    def set_levels(self, levels):
+        """ Sets the levels and converts the whole image again. """
+        self.levels = tuple(levels)
+        if self.pixels is not None:
+            self.pixels[:] = apply_lut(self.data, self.levels, self.lut)
+            self.update()
+
+    def levels_moved(self, levels):
+        if self.levels is None:
+            return True
+        span = max(self.levels[1] - self.levels[0], 1e-12)
+        return any(abs(new - old) > self.tolerance * span for new, old in zip(levels, self.levels))
+
+    def update_lines(self, buffer, levels):
+        """ Displays the lines added to the buffer since the last update.
+
+        :param buffer: :class:`~NanoCETPy.sequential.models.waterfall.WaterfallBuffer`
+        :param levels: (min, max) levels, the image is only converted again if they moved beyond the tolerance
+        :returns: True if the image was reset because the buffer is a new one
+        """
+        reset = buffer is not self.buffer
+        if reset:
+            self.buffer = buffer
+            self.count = 0
+            self.reset(buffer.rows, buffer.length)
+        self.count, lines = buffer.lines_since(self.count)
+        index = (self.head + np.arange(len(lines))) % buffer.length
+        self.data[index] = lines
+        self.head = (self.head + len(lines)) % buffer.length
+        if self.levels_moved(levels):
+            self.set_levels(levels)
+        elif len(lines):
+            self.pixels[index] = apply_lut(lines, self.levels, self.lut)
+        self.update()
+        return reset
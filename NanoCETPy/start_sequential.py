@@ -23,41 +23,74 @@
 """
 import os
 import sys
+import time
+from contextlib import contextmanager
 
 import yaml
 from PyQt5 import QtGui
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QSplashScreen
 
 from experimentor.lib.log import get_logger, log_to_screen
-from NanoCETPy.sequential.models.demo import DemoExperiment
-from NanoCETPy.sequential.models.experiment import MainSetup
-from NanoCETPy.sequential.views.sequential_window import SequentialMainWindow
 
 from NanoCETPy import BASE_PATH
 
 
+class StartupReport:
+    """ Measures the duration of the phases of the startup, to make regressions in the startup time visible. """
+    def __init__(self, logger):
+        self.logger = logger
+        self.t0 = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        yield
+        self.phases.append((name, time.perf_counter() - t0))
+
+    def log(self):
+        phases = ', '.join(f'{name}: {duration:.2f}s' for name, duration in self.phases)
+        self.logger.info(f'Window shown {time.perf_counter() - self.t0:.2f}s after start ({phases})')
+
 
 def main():
     logger = get_logger()
     log_to_screen(logger=logger)
-    if len(sys.argv) > 1 and sys.argv[1] == 'demo':
-        experiment = DemoExperiment()
-    else:
-        experiment = MainSetup()
-    if not (config_filepath := BASE_PATH / 'config_user.yml').is_file():
-        config_filepath = BASE_PATH / 'resources/config_default.yml'
-    experiment.load_configuration(config_filepath, yaml.UnsafeLoader)
+    report = StartupReport(logger)
 
     # QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
     # QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
     os.environ["QT_AUTO_SCREEN_SCALE_FACTOR"] = "1"
-    app = QApplication([])
-    fontId = QtGui.QFontDatabase.addApplicationFont(str(BASE_PATH / 'resources' / 'Roboto-Regular.ttf'))
-    families = QtGui.QFontDatabase.applicationFontFamilies(fontId)
-    font = QtGui.QFont(families[0])
-    app.setFont(font)
-    main_window = SequentialMainWindow(experiment=experiment)
-    main_window.show()
+    with report.phase('qt'):
+        app = QApplication([])
+        splash = QSplashScreen(QtGui.QPixmap(str(BASE_PATH / 'sequential' / 'views' / 'GUI' / 'dispertech-logo.png')))
+        splash.show()
+        app.processEvents()
+
+    # The models pull in pypylon, pyvisa and numpy, they are imported once the splash screen is visible
+    with report.phase('import models'):
+        if len(sys.argv) > 1 and sys.argv[1] == 'demo':
+            from NanoCETPy.sequential.models.demo import DemoExperiment
+            experiment = DemoExperiment()
+        else:
+            from NanoCETPy.sequential.models.experiment import MainSetup
+            experiment = MainSetup()
+    with report.phase('configuration'):
+        if not (config_filepath := BASE_PATH / 'config_user.yml').is_file():
+            config_filepath = BASE_PATH / 'resources/config_default.yml'
+        experiment.load_configuration(config_filepath, yaml.UnsafeLoader)
+
+    with report.phase('import views'):
+        from NanoCETPy.sequential.views.sequential_window import SequentialMainWindow
+    with report.phase('window'):
+        fontId = QtGui.QFontDatabase.addApplicationFont(str(BASE_PATH / 'resources' / 'Roboto-Regular.ttf'))
+        families = QtGui.QFontDatabase.applicationFontFamilies(fontId)
+        font = QtGui.QFont(families[0])
+        app.setFont(font)
+        main_window = SequentialMainWindow(experiment=experiment)
+        main_window.show()
+        splash.finish(main_window)
+    report.log()
     app.exec()
     experiment.finalize()
 